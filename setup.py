@@ -35,7 +35,8 @@ setup(
         'click==6.7',
         'aio_dprcon>=0.1.6',
         'matrix-nio==0.18.1',
-        'django-echoices'
+        'django-echoices',
+        'numpy>=1.19'
     ],
     classifiers=[
         'Development Status :: 3 - Alpha',
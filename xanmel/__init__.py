@@ -4,27 +4,32 @@ import logging
 import logging.config
 import os
 from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
 
 import sys
 
 import copy
-from pkg_resources import resource_filename, require, DistributionNotFound
-
-import click
-import geoip2.database
-import asyncio
 # import uvloop
 
 import time
 import yaml
 import yaml.resolver
 
+from .bus import EventBus, event_type_name
 from .db import XanmelDB
+from .metrics import Metrics
+from .ratelimit import RateLimiter
+from .journal import EventJournal
 from .utils import current_time
 from .logcfg import logging_config
 
 logger = logging.getLogger(__name__)
 
+# Settings which are read only at startup
+RESTART_REQUIRED_SETTINGS = ['asyncio_debug', 'db_url', 'geoip_db', 'geoip_cache_size', 'event_bus', 'metrics',
+                             'journal', 'sharding', 'db_write_behind',
+                             'db_cache_size', 'db_pool', 'db_slow_query']
+
 
 # asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
@@ -54,32 +59,163 @@ class Xanmel:
         self.handlers = defaultdict(list)
         self.actions = {}
         self.loop = loop
-        # TODO: handle situation when geoip db isn't readable
-        self.geoip = geoip2.database.Reader(resource_filename('xanmel', 'GeoLite2-City.mmdb'))
+        # (phase name, seconds) in the order the phases were run
+        self.startup_phases = []
+        self.event_generators = True
+        self._geoip = None
+        # Supervisor or Worker when the sharded modules run in separate processes (see xanmel.ipc)
+        self.ipc = None
         self.cmd_root = CommandRoot(self)
         self.cmd_root.register_container(HelpCommands(), prefix='')
+        self.cmd_root.register_container(AdminCommands(), prefix='')
+        self.config_path = config_path
+        with self.startup_phase('config'):
+            try:
+                self.config = self.read_config()
+            except (OSError, IOError) as e:
+                print('Config file %s unreadable: %s' % (config_path, e))
+                sys.exit(1)
+            logging.config.dictConfig(logging_config(self.config['settings'].get('log_level', 'INFO')))
+            logger.info('Read configuration from %s', config_path)
+            loop.set_debug(self.config['settings']['asyncio_debug'])
+        with self.startup_phase('db'):
+            self.db = XanmelDB(self.config['settings'].get('db_url'), self.config['settings'].get('db_write_behind'),
+                               self.config['settings'].get('db_cache_size', 10000),
+                               self.config['settings'].get('db_pool'), self.config['settings'].get('db_slow_query'))
+        self.bus = EventBus(self, self.config['settings'].get('event_bus'))
+        self.metrics = Metrics(self, self.config['settings'].get('metrics'))
+        self.metrics.collectors.append(self.db.collect_metrics)
+        self.metrics.collectors.append(self.bus.collect_metrics)
+        self.metrics.histograms.extend(self.db.query_log.histograms())
+        journal_config = self.config['settings'].get('journal')
+        if journal_config and journal_config.get('path'):
+            self.journal = EventJournal(journal_config['path'], journal_config.get('max_pending', 10000))
+        else:
+            self.journal = None
+
+    @property
+    def geoip(self):
+        """
+        Cached GeoIP database reader, opened on the first use.
+        """
+        if self._geoip is None:
+            from .geoip import GeoIP, DEFAULT_CACHE_SIZE
+            # TODO: handle situation when geoip db isn't readable
+            path = self.config['settings'].get('geoip_db') or \
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'GeoLite2-City.mmdb')
+            with self.startup_phase('geoip'):
+                self._geoip = GeoIP(os.path.expanduser(path),
+                                    self.config['settings'].get('geoip_cache_size', DEFAULT_CACHE_SIZE))
+            self.metrics.collectors.append(self._geoip.collect_metrics)
+        return self._geoip
+
+    @contextmanager
+    def startup_phase(self, name):
+        started = time.perf_counter()
         try:
-            with open(os.path.expanduser(config_path), 'r') as config_file:
-                self.config = ordered_load(config_file)
-        except (OSError, IOError) as e:
-            print('Config file %s unreadable: %s' % (config_path, e))
-            sys.exit(1)
-        logging.config.dictConfig(logging_config(self.config['settings'].get('log_level', 'INFO')))
-        logger.info('Read configuration from %s', config_path)
-        loop.set_debug(self.config['settings']['asyncio_debug'])
-        self.db = XanmelDB(self.config['settings'].get('db_url'))
-
-    def load_modules(self):
+            yield
+        finally:
+            self.startup_phases.append((name, time.perf_counter() - started))
+
+    def read_config(self):
+        with open(os.path.expanduser(self.config_path), 'r') as config_file:
+            config = ordered_load(config_file)
+        if self.ipc is not None:
+            config['modules'] = self.ipc.shard_modules(config['modules'])
+        return config
+
+    def load_modules(self, event_generators=True):
+        self.event_generators = event_generators
         for module_path, module_config in self.config['modules'].items():
-            module_pkg_name, module_name = module_path.rsplit('.', 1)
+            if self.is_local_module(module_path):
+                self.load_module(module_path, module_config)
+            else:
+                self.ipc.load_remote_module(module_path, module_config)
+        if event_generators:
+            self.metrics.setup_event_generators()
+            self.db.setup_event_generators(self.loop)
+            if self.ipc is not None:
+                self.ipc.setup_event_generators()
+        with self.startup_phase('after load hooks'):
+            self.run_after_load_hooks()
+
+    def is_local_module(self, module_path):
+        return self.ipc is None or self.ipc.is_local(module_path)
+
+    def load_module(self, module_path, module_config):
+        module_pkg_name, module_name = module_path.rsplit('.', 1)
+        with self.startup_phase('%s: import' % module_path):
             module_pkg = importlib.import_module(module_pkg_name)
+        with self.startup_phase('%s: init' % module_path):
             module = getattr(module_pkg, module_name)(self, module_config)
+            module.path = module_path
             self.modules[module_path] = module
+        with self.startup_phase('%s: handlers' % module_path):
             self.load_handlers(module, module_pkg_name)
+        with self.startup_phase('%s: actions' % module_path):
             self.load_actions(module, module_pkg_name)
-            self.setup_event_generators(module)
+        if self.event_generators:
+            with self.startup_phase('%s: event generators' % module_path):
+                self.setup_event_generators(module)
+        with self.startup_phase('%s: tables' % module_path):
             self.db.create_tables(module_pkg_name)
-        self.run_after_load_hooks()
+        return module
+
+    async def unload_module(self, module_path):
+        module = self.modules.pop(module_path)
+        await module.stop()
+        for event, handlers in self.handlers.items():
+            self.handlers[event] = [i for i in handlers if i.module is not module]
+        for action_class, action in list(self.actions.items()):
+            if action.module is module:
+                del self.actions[action_class]
+
+    async def reload(self):
+        """
+        Re-read the config file and apply the changes. Only the modules whose config has changed are touched,
+        and a module may apply the change in place (see Module.reload). Otherwise it is replaced by a new instance.
+
+        Returns a list of human readable descriptions of the applied changes.
+        """
+        new_config = self.read_config()
+        changes = []
+        old_settings, new_settings = self.config['settings'], new_config['settings']
+        if old_settings != new_settings:
+            logging.config.dictConfig(logging_config(new_settings.get('log_level', 'INFO')))
+            ignored = [i for i in RESTART_REQUIRED_SETTINGS if old_settings.get(i) != new_settings.get(i)]
+            if ignored:
+                logger.warning('Changes of %s settings will take effect after restart', ', '.join(ignored))
+            self.config['settings'] = new_settings
+            changes.append('settings')
+        for module_path in list(self.modules):
+            if module_path not in new_config['modules']:
+                await self.unload_module(module_path)
+                changes.append('unloaded %s' % module_path)
+        for module_path, module_config in new_config['modules'].items():
+            if not self.is_local_module(module_path):
+                self.ipc.load_remote_module(module_path, module_config)
+                continue
+            module = self.modules.get(module_path)
+            if module is not None and module.config == module_config:
+                continue
+            if module is not None:
+                module_changes = await module.reload(module_config)
+                if module_changes is not None:
+                    module.config = module_config
+                    changes.extend('%s: %s' % (module_path, i) for i in module_changes)
+                    continue
+                await self.unload_module(module_path)
+                changes.append('reloaded %s' % module_path)
+            else:
+                changes.append('loaded %s' % module_path)
+            self.load_module(module_path, module_config).after_load()
+        self.config['modules'] = new_config['modules']
+        for module in self.modules.values():
+            module.after_reload()
+        if self.ipc is not None:
+            self.ipc.reload()
+        logger.info('Configuration reloaded: %s', ', '.join(changes) or 'no changes')
+        return changes
 
     def load_handlers(self, module, module_pkg_name):
         try:
@@ -114,6 +250,13 @@ class Xanmel:
     def teardown(self):
         for i in self.modules.values():
             i.teardown()
+        self.bus.stop()
+        self.db.teardown(self.loop)
+        self.metrics.teardown()
+        if self.ipc is not None:
+            self.ipc.stop()
+        if self.journal:
+            self.journal.close()
 
 
 class Module:
@@ -129,15 +272,59 @@ class Module:
 
     Each module has its own config section.
     """
+    path = None
+    # Methods which may be called from a worker process, see xanmel.ipc.RemoteModule. They can't return anything.
+    remote_methods = ()
 
     def __init__(self, xanmel, config):
         self.config = config
         self.xanmel = xanmel
         self.loop = xanmel.loop
+        self.tasks = []
+        self.command_containers = []
 
     def after_load(self):
         pass
 
+    def after_reload(self):
+        """
+        Called for every module after a configuration reload, when the changed modules are loaded.
+        """
+        pass
+
+    def register_container(self, container, prefix):
+        self.xanmel.cmd_root.register_container(container, prefix)
+        self.command_containers.append(container)
+
+    async def reload(self, config):
+        """
+        Apply a changed config section without replacing the module. Returns a list of descriptions of the applied
+        changes, or None if the module has to be replaced by a new instance.
+        """
+        return None
+
+    async def stop(self):
+        """
+        Stop the event generators and unregister the command containers of a module which is unloaded while
+        the bot is running.
+        """
+        for i in self.tasks:
+            i.cancel()
+        for i in self.command_containers:
+            self.xanmel.cmd_root.unregister_container(i)
+
+    def journal_ref(self):
+        return self.path, 'module'
+
+    def resolve_journal_ref(self, kind, *args):
+        """
+        Return the object referred by a journal record. Modules which put their own objects into event properties
+        should define journal_ref() on those objects and extend this method.
+        """
+        if kind == 'module':
+            return self
+        raise KeyError('Unknown journal reference %s' % kind)
+
     def setup_event_generators(self):
         pass  # pragma: no cover
 
@@ -158,8 +345,19 @@ class Event:
             logger.info(str(self))
         else:
             logger.debug(str(self))
-        for i in self.module.xanmel.handlers[type(self)]:
-            self.module.loop.create_task(i.handle(self))
+        self.module.xanmel.metrics.events[event_type_name(type(self))] += 1
+        if self.module.xanmel.journal:
+            self.module.xanmel.journal.record(self)
+        self.module.xanmel.bus.publish_nowait(self)
+        if self.module.xanmel.ipc is not None:
+            self.module.xanmel.ipc.forward(self)
+
+    def coalesce_key(self):
+        """
+        Events with the same non-None key are interchangeable, so only the latest of them has to be handled when
+        the event queue overflows.
+        """
+        return None
 
     def __str__(self):
         return '%s(%r)' % (type(self).__name__, self.properties)
@@ -176,36 +374,53 @@ class Action:
 
 class Handler:
     events = []
+    # Synchronous handlers never suspend in handle(), so they are run inline when an event is fired
+    synchronous = False
 
     def __init__(self, module):
         self.module = module
 
     async def run_action(self, action, **kwargs):
-        action = self.module.xanmel.actions[action]
-        await action.run(**kwargs)
+        metrics = self.module.xanmel.metrics
+        with metrics.timed(metrics.actions, event_type_name(action)):
+            await self.module.xanmel.actions[action].run(**kwargs)
 
     async def handle(self, event):
         pass  # pragma: no cover
 
 
 class ChatConfirmations:
+    # Unanswered questions expire after this number of seconds
+    ttl = 120
+
     def __init__(self):
-        self.confirmations = {}
+        self.confirmations = OrderedDict()
 
     def reset(self):
-        self.confirmations = {}
+        self.confirmations = OrderedDict()
+
+    def expire(self):
+        while self.confirmations:
+            key, (_, _, asked) = next(iter(self.confirmations.items()))
+            if time.time() - asked < self.ttl:
+                break
+            del self.confirmations[key]
 
     def __contains__(self, item):
+        self.expire()
         return item in self.confirmations
 
     def __getitem__(self, item):
-        return self.confirmations[item]
+        yes_cb, no_cb, _ = self.confirmations[item]
+        return yes_cb, no_cb
 
     def __delitem__(self, key):
         del self.confirmations[key]
 
     async def ask(self, user, prompt, yes_cb, no_cb, is_private=False):
-        self.confirmations[user.unique_id()] = (yes_cb, no_cb)
+        self.expire()
+        self.confirmations.pop(user.unique_id(), None)
+        self.confirmations[user.unique_id()] = (yes_cb, no_cb, time.time())
         await user.reply('{} /yes or /no'.format(prompt), is_private)
 
 
@@ -230,9 +445,23 @@ class ChatUser:
         else:
             await self.public_reply(message, **kwargs)
 
+    async def replies(self, messages, is_private, **kwargs):
+        if is_private:
+            await self.private_replies(messages, **kwargs)
+        else:
+            for i in messages:
+                await self.public_reply(i, **kwargs)
+
     async def private_reply(self, message, **kwargs):
         pass  # pragma: no cover
 
+    async def private_replies(self, messages, **kwargs):
+        """
+        Send several private messages at once. Chat users may pack them into fewer lines.
+        """
+        for i in messages:
+            await self.private_reply(i, **kwargs)
+
     async def public_reply(self, message, **kwargs):
         pass  # pragma: no cover
 
@@ -242,8 +471,11 @@ class CommandRoot:
         self.xanmel = xanmel
         self.children = {}
         self.merged_containers = []
-        self.throttling = defaultdict(lambda: defaultdict(list))
-        self.disabled_users = defaultdict(dict)
+        self.rate_limiters = {}
+        # The throttling settings the rate limiters were created with
+        self.throttling = None
+        # (user type, is admin) -> HelpIndex, reset when the command tree changes
+        self.help_cache = {}
 
     def copy(self):
         new_root = CommandRoot(self.xanmel)
@@ -251,7 +483,48 @@ class CommandRoot:
         new_root.merged_containers = copy.copy(self.merged_containers)
         return new_root
 
+    def get_rate_limiter(self, user_type):
+        """
+        Command rate limits are configured in the throttling section of the settings, per user type limits
+        override the default ones::
+
+            throttling:
+              burst: 5
+              rate: 0.5
+              penalty: 60
+              max_users: 10000
+              user_types:
+                xonotic: {burst: 3}
+        """
+        throttling = self.xanmel.config['settings'].get('throttling')
+        if throttling != self.throttling:
+            # The settings were reloaded
+            self.rate_limiters = {}
+            self.throttling = throttling
+        if user_type not in self.rate_limiters:
+            config = dict(throttling or {})
+            config.update((config.pop('user_types', None) or {}).get(user_type) or {})
+            self.rate_limiters[user_type] = RateLimiter(**config)
+        return self.rate_limiters[user_type]
+
+    def help_index(self, user):
+        key = (user.user_type, user.is_admin)
+        if key not in self.help_cache:
+            self.help_cache[key] = HelpIndex(self, user)
+        return self.help_cache[key]
+
+    def unregister_container(self, container):
+        self.help_cache = {}
+        if container in self.merged_containers:
+            self.merged_containers.remove(container)
+            for i in container.children.values():
+                if self.children.get(i.prefix) is i:
+                    del self.children[i.prefix]
+        elif self.children.get(container.prefix) is container:
+            del self.children[container.prefix]
+
     def register_container(self, container, prefix):
+        self.help_cache = {}
         container.root = self
         container.prefix = prefix
         if not prefix:
@@ -272,18 +545,8 @@ class CommandRoot:
         uid = user.unique_id()
         logger.debug('Running a command for user %s, message %s', uid, message)
 
-        if uid in self.disabled_users[ut]:
-            if time.time() - self.disabled_users[ut][uid] > 60:
-                del self.disabled_users[ut][uid]
-            else:
-                logger.info('User %s:%s throttled for flooding!', ut, uid)
-                return
-        self.throttling[ut][uid].append(time.time())
-        while time.time() - self.throttling[ut][uid][0] > 10:
-            self.throttling[ut][uid].pop(0)
-        if len(self.throttling[ut][uid]) > 5:
+        if not self.get_rate_limiter(ut).allow(uid):
             logger.info('User %s:%s throttled for flooding!', ut, uid)
-            self.disabled_users[ut][uid] = time.time()
             return
 
         message = message.lstrip()
@@ -437,6 +700,54 @@ class HelpCommands(CommandContainer):
     help_text = 'Commands for getting help'
 
 
+class HelpIndex:
+    """
+    Help texts of a command root as seen by users of the same type and admin status.
+    """
+
+    def __init__(self, root, user):
+        cmds = root.children
+        self.available = 'Available commands: ' + ', '.join(
+            sorted([i for i in cmds if cmds[i].is_allowed_for(user)]))
+        self.commands = {}
+        self.subcommands = {}
+        for prefix, child in cmds.items():
+            if isinstance(child, CommandContainer):
+                self.commands[prefix] = [
+                    '%s: %s' % (prefix, child.help_text),
+                    'Available commands: ' + ', '.join(
+                        sorted([i for i in child.children if child.children[i].is_allowed_for(user)]))
+                ]
+                for child_prefix, cmd in child.children.items():
+                    if cmd.is_allowed_for(user):
+                        self.subcommands[prefix, child_prefix] = '%s %s' % (prefix, cmd.format_help())
+                    else:
+                        self.subcommands[prefix, child_prefix] = 'Unavailable command %s %s' % (prefix, child_prefix)
+            elif child.is_allowed_for(user):
+                self.commands[prefix] = [child.format_help()]
+            else:
+                self.commands[prefix] = ['Unavailable command %s' % prefix]
+
+        self.full = ['Angle brackets designate <required> command parameters.',
+                     'Square brackets designate [optional] command parameters']
+        for i in root.merged_containers:
+            if i.is_allowed_for(user):
+                self.full.append('-- ' + i.help_text + ' --')
+                for child_prefix in sorted(i.children):
+                    if child_prefix in cmds:
+                        if cmds[child_prefix].is_allowed_for(user):
+                            self.full.append(cmds[child_prefix].format_help())
+        for child_prefix in sorted(cmds):
+            child = cmds[child_prefix]
+            if not isinstance(child, CommandContainer):
+                continue
+            if child.is_allowed_for(user):
+                self.full.append('-- %s: %s --' % (child_prefix, child.help_text))
+                for subchild_prefix in sorted(child.children):
+                    if child.children[subchild_prefix].is_allowed_for(user):
+                        self.full.append('%s %s' % (child_prefix, child.children[subchild_prefix].format_help()))
+
+
 class Help(ChatCommand):
     parent = HelpCommands
     prefix = 'help'
@@ -448,6 +759,7 @@ class Help(ChatCommand):
             help_base = 'help'
         else:
             help_base = '%s: help' % user.botnick
+        index = root.help_index(user)
         message = message.strip()
         if message:
             prefix = message.split(' ', 1)[0]
@@ -455,40 +767,25 @@ class Help(ChatCommand):
                 reply = ['Unknown command %s. Use "%s" to list available commands' % (prefix, help_base)]
             else:
                 child = root.children[prefix]
-                if isinstance(child, CommandContainer):
-                    rest = message[len(prefix):].strip()
-                    if not rest:
-                        cmds = child.children
-                        reply = ['%s: %s' % (prefix, child.help_text),
-                                 'Available commands: ' + ', '.join(
-                                     sorted([i for i in cmds if cmds[i].is_allowed_for(user)]))]
+                rest = message[len(prefix):].strip()
+                if isinstance(child, CommandContainer) and rest:
+                    child_prefix = rest.split(' ', 1)[0]
+                    if child_prefix not in child.children:
+                        reply = [
+                            'Unknown command %(prefix)s %(child_prefix)s. Use "%(help_base)s %(prefix)s" to list '
+                            'available commands' % {
+                                'prefix': prefix,
+                                'child_prefix': child_prefix,
+                                'help_base': help_base
+                            }
+                        ]
                     else:
-                        child_prefix = rest.split(' ', 1)[0]
-                        if child_prefix not in child.children:
-                            reply = [
-                                'Unknown command %(prefix)s %(child_prefix)s. Use "%(help_base)s %(prefix)s" to list '
-                                'available commands' % {
-                                    'prefix': prefix,
-                                    'child_prefix': child_prefix,
-                                    'help_base': help_base
-                                }
-                            ]
-                        else:
-                            cmd = child.children[child_prefix]
-                            if cmd.is_allowed_for(user):
-                                reply = ['%s %s' % (prefix, cmd.format_help())]
-                            else:
-                                reply = ['Unavailable command %s %s' % (prefix, child_prefix)]
+                        reply = [index.subcommands[prefix, child_prefix]]
                 else:
-                    if child.is_allowed_for(user):
-                        reply = [child.format_help()]
-                    else:
-                        reply = ['Unavailable command %s' % prefix]
+                    reply = index.commands[prefix]
         else:
-            cmds = root.children
-            reply = ['Available commands: ' + ', '.join(sorted([i for i in cmds if cmds[i].is_allowed_for(user)]))]
-        for i in reply:
-            await user.reply(i, is_private)
+            reply = [index.available]
+        await user.replies(reply, is_private)
 
 
 class FullHelp(ChatCommand):
@@ -497,27 +794,40 @@ class FullHelp(ChatCommand):
     help_text = 'Send a documentation for all commands in a private message'
 
     async def run(self, user, message, is_private=False, root=None):
-        reply = ['Angle brackets designate <required> command parameters.',
-                 'Square brackets designate [optional] command parameters']
-        for i in root.merged_containers:
-            if i.is_allowed_for(user):
-                reply.append('-- ' + i.help_text + ' --')
-                for child_prefix in sorted(i.children):
-                    if child_prefix in root.children:
-                        if root.children[child_prefix].is_allowed_for(user):
-                            reply.append(root.children[child_prefix].format_help())
-        for child_prefix in sorted(root.children):
-            child = root.children[child_prefix]
-            if not isinstance(child, CommandContainer):
-                continue
-            if child.is_allowed_for(user):
-                reply.append('-- %s: %s --' % (child_prefix, child.help_text))
-                for subchild_prefix in sorted(child.children):
-                    if child.children[subchild_prefix].is_allowed_for(user):
-                        reply.append('%s %s' % (child_prefix, child.children[subchild_prefix].format_help()))
-        for i in reply:
-            await asyncio.sleep(1)  # Sleep 1 second to prevent kicking for Excess Flood
-            await user.private_reply(i)
+        await user.private_replies(root.help_index(user).full)
+
+
+class AdminCommands(CommandContainer):
+    help_text = 'Bot administration commands'
+
+
+class ShowMetrics(ChatCommand):
+    parent = AdminCommands
+    prefix = 'metrics'
+    help_args = '[LIMIT]'
+    help_text = 'Show the slowest handlers and actions'
+    admin_required = True
+
+    async def run(self, user, message, is_private=False, root=None):
+        message = message.strip()
+        limit = int(message) if message.isdigit() else 5
+        await user.replies(list(user.module.xanmel.metrics.summary(limit)), is_private)
+
+
+class Reload(ChatCommand):
+    parent = AdminCommands
+    prefix = 'reload'
+    help_text = 'Re-read the config file and apply the changes'
+    admin_required = True
+
+    async def run(self, user, message, is_private=False, root=None):
+        try:
+            changes = await user.module.xanmel.reload()
+        except Exception as e:
+            logger.exception('Failed to reload configuration')
+            await user.reply('Reload failed: %s' % e, is_private)
+            return
+        await user.reply('Reloaded: %s' % (', '.join(changes) or 'no changes'), is_private)
 
 
 class Version(ChatCommand):
@@ -526,35 +836,15 @@ class Version(ChatCommand):
     help_text = 'Get the current version of the bot running'
 
     async def run(self, user, message, is_private=False, root=None):
+        from importlib import metadata
         try:
-            version = require('xanmel')[0].version
-        except DistributionNotFound:
+            version = metadata.version('xanmel')
+        except metadata.PackageNotFoundError:
             version = 'Unknown version (please install xanmel using setuptools)'
         await user.reply(version, is_private=is_private)
 
 
-@click.command()
-@click.option('-c', '--config', default=None, help='Path to config file', metavar='CONFIG')
-def main(config):
-    if config is None:
-        tried = []
-        for i in ['/etc/', os.getcwd()]:
-            fn = os.path.join(i, 'xanmel.yaml')
-            tried.append(fn)
-            if os.path.isfile(fn):
-                config = fn
-                break
-        if config is None:
-            print('Could not find config file. Tried the following paths: %s' % ', '.join(tried))
-            return 1
-    loop = asyncio.get_event_loop()
-    xanmel = Xanmel(loop=loop, config_path=config)
-    logger.info('Starting event loop...')
-
-    xanmel.load_modules()
-    try:
-        loop.run_forever()
-    except KeyboardInterrupt:
-        loop.stop()
-        loop.close()
-    return 0
+def main():
+    # The command line interface lives in a separate module, so importing xanmel doesn't import click
+    from .cli import main as cli_main
+    cli_main()
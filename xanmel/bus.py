@@ -0,0 +1,316 @@
+import asyncio
+import logging
+from collections import deque, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, COALESCE)
+
+DEFAULT_QUEUE_SIZE = 1024
+DEFAULT_WORKERS = 8
+
+
+def run_inline(coro):
+    """
+    Run a coroutine which is not supposed to suspend to completion without scheduling it on the event loop.
+    """
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError('Coroutine %r suspended while being run inline' % coro)
+
+
+def event_type_name(event_type):
+    return '%s.%s' % (event_type.__module__, event_type.__name__)
+
+
+class EventQueue:
+    """
+    A bounded queue of events of a single type, consumed by a fixed number of worker tasks.
+
+    When the queue is full the overflow policy decides what happens with a new event:
+
+      * block - the event waits for a free slot. Producers using EventBus.publish are suspended until then.
+        EventBus.publish_nowait can't suspend its caller, so its events wait in a backlog of at most queue_size
+        events, which is moved to the queue as slots get free. When the backlog is full its oldest event is dropped.
+      * drop_oldest - the oldest queued event is dropped.
+      * coalesce - the new event replaces a queued event with the same coalesce key, if there is one.
+        Otherwise the oldest queued event is dropped.
+    """
+
+    def __init__(self, bus, event_type, queue_size, policy, workers):
+        self.bus = bus
+        self.event_type = event_type
+        self.queue_size = queue_size
+        self.policy = policy
+        self.events = deque()
+        # Events of put_nowait waiting for a free slot with the block policy
+        self.backlog = deque()
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.finished.set()
+        self.unfinished = 0
+        self.in_progress = 0
+        self.waiting = 0
+        self.max_depth = 0
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.workers = [bus.loop.create_task(self.work()) for _ in range(workers)]
+
+    @property
+    def full(self):
+        return len(self.events) >= self.queue_size
+
+    def append(self, event):
+        self.events.append(event)
+        self.max_depth = max(self.max_depth, len(self.events))
+        self.not_empty.set()
+
+    def start_task(self):
+        self.unfinished += 1
+        self.finished.clear()
+
+    def task_done(self):
+        self.unfinished -= 1
+        if self.unfinished == 0:
+            self.finished.set()
+
+    def drop_oldest(self, event):
+        dropped = self.events.popleft()
+        self.dropped += 1
+        logger.info('Dropping %s - event queue is full', dropped)
+        self.events.append(event)
+
+    def coalesce(self, event):
+        key = event.coalesce_key()
+        if key is not None:
+            for ix, queued in enumerate(self.events):
+                if queued.coalesce_key() == key:
+                    self.events[ix] = event
+                    self.coalesced += 1
+                    return
+        self.drop_oldest(event)
+
+    def put_nowait(self, event):
+        if not self.full:
+            self.start_task()
+            self.append(event)
+        elif self.policy == DROP_OLDEST:
+            self.drop_oldest(event)
+        elif self.policy == COALESCE:
+            self.coalesce(event)
+        elif len(self.backlog) < self.queue_size:
+            self.start_task()
+            self.backlog.append(event)
+        else:
+            dropped = self.backlog.popleft()
+            self.dropped += 1
+            logger.info('Dropping %s - event queue and its backlog are full', dropped)
+            self.backlog.append(event)
+
+    async def put(self, event):
+        if not self.full:
+            self.put_nowait(event)
+            return
+        if self.policy != BLOCK:
+            self.put_nowait(event)
+            return
+        self.start_task()
+        self.waiting += 1
+        try:
+            while self.full:
+                self.not_full.clear()
+                await self.not_full.wait()
+        finally:
+            self.waiting -= 1
+        self.append(event)
+
+    async def get(self):
+        while not self.events:
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        event = self.events.popleft()
+        if self.backlog:
+            self.append(self.backlog.popleft())
+        if not self.full:
+            self.not_full.set()
+        return event
+
+    async def work(self):
+        while True:
+            event = await self.get()
+            self.in_progress += 1
+            try:
+                await self.bus.run_handlers(event)
+            finally:
+                self.in_progress -= 1
+                self.processed += 1
+                self.task_done()
+
+    def stats(self):
+        return OrderedDict([
+            ('depth', len(self.events)),
+            ('max_depth', self.max_depth),
+            ('in_progress', self.in_progress),
+            ('waiting', self.waiting + len(self.backlog)),
+            ('processed', self.processed),
+            ('dropped', self.dropped),
+            ('coalesced', self.coalesced),
+        ])
+
+
+class EventBus:
+    """
+    Delivers fired events to their handlers.
+
+    Synchronous handlers are run inline. Other handlers are run by the workers of a bounded per event type queue,
+    the handlers of an event one after another in the worker which took it, so dispatching an event creates no tasks.
+    A slow handler therefore delays the other handlers of its event; events of the same type are still handled
+    concurrently by the other workers. The number of concurrent invocations of a handler class may be limited
+    separately.
+
+    Configured in the event_bus section of the settings::
+
+        event_bus:
+          queue_size: 1024
+          workers: 8
+          overflow: block
+          events:
+            NewPlayerActive: {overflow: coalesce, queue_size: 16}
+          handler_concurrency:
+            JoinHandler: 4
+
+    Event types and handler classes are referred either by the class name or by the full dotted path.
+    """
+
+    def __init__(self, xanmel, config):
+        self.xanmel = xanmel
+        self.loop = xanmel.loop
+        self.config = config or {}
+        self.queues = {}
+        self.semaphores = {}
+        for policy in [self.config.get('overflow', BLOCK)] + \
+                [i.get('overflow', BLOCK) for i in (self.config.get('events') or {}).values()]:
+            if policy not in OVERFLOW_POLICIES:
+                raise ValueError('Unknown event bus overflow policy %s' % policy)
+
+    def lookup(self, section, cls):
+        values = self.config.get(section) or {}
+        name = event_type_name(cls)
+        if name in values:
+            return values[name]
+        return values.get(cls.__name__)
+
+    def event_config(self, event_type):
+        config = {
+            'queue_size': self.config.get('queue_size', DEFAULT_QUEUE_SIZE),
+            'workers': self.config.get('workers', DEFAULT_WORKERS),
+            'overflow': self.config.get('overflow', BLOCK)
+        }
+        config.update(self.lookup('events', event_type) or {})
+        return config
+
+    def get_queue(self, event_type):
+        if event_type not in self.queues:
+            config = self.event_config(event_type)
+            self.queues[event_type] = EventQueue(self, event_type,
+                                                 queue_size=int(config['queue_size']),
+                                                 policy=config['overflow'],
+                                                 workers=int(config['workers']))
+        return self.queues[event_type]
+
+    def get_semaphore(self, handler):
+        handler_class = type(handler)
+        if handler_class not in self.semaphores:
+            limit = self.lookup('handler_concurrency', handler_class)
+            self.semaphores[handler_class] = limit and asyncio.Semaphore(int(limit))
+        return self.semaphores[handler_class]
+
+    def run_sync_handlers(self, event):
+        has_async = False
+        for handler in self.xanmel.handlers[type(event)]:
+            if not handler.synchronous:
+                has_async = True
+                continue
+            try:
+                with self.xanmel.metrics.timed(self.xanmel.metrics.handlers, event_type_name(type(handler))):
+                    run_inline(handler.handle(event))
+            except Exception:
+                logger.exception('Handler %s failed to process %s', type(handler).__name__, event)
+        return has_async
+
+    def publish_nowait(self, event):
+        if self.run_sync_handlers(event):
+            self.get_queue(type(event)).put_nowait(event)
+
+    async def publish(self, event):
+        """
+        Same as publish_nowait, but waits for a free slot in the queue if its overflow policy is block.
+        """
+        if self.run_sync_handlers(event):
+            await self.get_queue(type(event)).put(event)
+
+    async def run_handler(self, handler, event):
+        semaphore = self.get_semaphore(handler)
+        metrics = self.xanmel.metrics
+        try:
+            if semaphore is None:
+                with metrics.timed(metrics.handlers, event_type_name(type(handler))):
+                    await handler.handle(event)
+            else:
+                async with semaphore:
+                    with metrics.timed(metrics.handlers, event_type_name(type(handler))):
+                        await handler.handle(event)
+        except Exception:
+            logger.exception('Handler %s failed to process %s', type(handler).__name__, event)
+
+    async def run_handlers(self, event):
+        for handler in self.xanmel.handlers[type(event)]:
+            if not handler.synchronous:
+                await self.run_handler(handler, event)
+
+    async def join(self):
+        """
+        Wait until all queued events are processed.
+        """
+        while any(i.unfinished for i in self.queues.values()):
+            for i in list(self.queues.values()):
+                await i.finished.wait()
+
+    def stats(self):
+        return OrderedDict([(event_type_name(k), v.stats())
+                            for k, v in sorted(self.queues.items(), key=lambda x: event_type_name(x[0]))])
+
+    def collect_metrics(self):
+        stats = self.stats()
+        return [
+            (metric, metric_type, help_text, ('event', {k: v[key] for k, v in stats.items()}))
+            for metric, metric_type, help_text, key in [
+                ('xanmel_event_queue_depth', 'gauge', 'Events in the event queue', 'depth'),
+                ('xanmel_event_queue_max_depth', 'gauge', 'Largest number of events in the event queue', 'max_depth'),
+                ('xanmel_event_queue_waiting', 'gauge', 'Events waiting for a free slot in the event queue',
+                 'waiting'),
+                ('xanmel_event_queue_dropped_total', 'counter', 'Events dropped because the event queue was full',
+                 'dropped'),
+                ('xanmel_event_queue_coalesced_total', 'counter', 'Events replacing a queued event with the same key',
+                 'coalesced'),
+            ]
+        ]
+
+    def stop(self):
+        """
+        Cancel all workers. Returns the cancelled tasks.
+        """
+        workers = []
+        for queue in self.queues.values():
+            for worker in queue.workers:
+                worker.cancel()
+                workers.append(worker)
+        return workers
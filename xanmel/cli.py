@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+
+import click
+
+from . import Xanmel
+from .db import XanmelDB
+from .journal import replay as replay_journal
+
+logger = logging.getLogger(__name__)
+
+
+@click.group(invoke_without_command=True)
+@click.option('-c', '--config', default=None, help='Path to config file', metavar='CONFIG')
+@click.option('--startup-profile', is_flag=True, help='Report the time spent in each startup phase and exit')
+@click.pass_context
+def main(ctx, config, startup_profile):
+    if config is None:
+        tried = []
+        for i in ['/etc/', os.getcwd()]:
+            fn = os.path.join(i, 'xanmel.yaml')
+            tried.append(fn)
+            if os.path.isfile(fn):
+                config = fn
+                break
+        if config is None:
+            print('Could not find config file. Tried the following paths: %s' % ', '.join(tried))
+            ctx.exit(1)
+    if ctx.invoked_subcommand is not None:
+        ctx.obj = config
+        return
+    loop = asyncio.get_event_loop()
+    xanmel = Xanmel(loop=loop, config_path=config)
+    if startup_profile:
+        xanmel.load_modules(event_generators=False)
+        print_startup_profile(xanmel)
+        xanmel.teardown()
+        return
+    logger.info('Starting event loop...')
+
+    sharding = xanmel.config['settings'].get('sharding') or {}
+    if sharding.get('workers'):
+        from .ipc import Supervisor
+        Supervisor(xanmel, sharding)
+    xanmel.load_modules()
+    loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(reload_config(xanmel)))
+    run_forever(xanmel)
+
+
+@main.command()
+@click.option('--shard', type=int, required=True, help='Number of the worker')
+@click.option('--socket', 'socket_path', required=True, help='Unix socket of the supervisor')
+@click.pass_obj
+def worker(config, shard, socket_path):
+    """
+    Run a part of the sharded modules for the supervisor. Started by the supervisor, see the sharding settings.
+    """
+    from .ipc import Worker
+    loop = asyncio.get_event_loop()
+    xanmel = Xanmel(loop=loop, config_path=config)
+    Worker(xanmel, xanmel.config['settings'].get('sharding') or {}, shard, socket_path)
+    xanmel.load_modules()
+    run_forever(xanmel)
+
+
+def run_forever(xanmel):
+    """
+    Run the event loop until SIGINT or SIGTERM, then tear down, which flushes the write-behind queue.
+    """
+    loop = xanmel.loop
+    for i in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(i, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        xanmel.teardown()
+        loop.close()
+
+
+async def reload_config(xanmel):
+    try:
+        await xanmel.reload()
+    except Exception:
+        logger.exception('Failed to reload configuration')
+
+
+def print_startup_profile(xanmel):
+    # The GeoIP database is opened lazily, include it in the profile anyway
+    xanmel.geoip
+    print('%-60s %10s' % ('Phase', 'Time, ms'))
+    for name, elapsed in xanmel.startup_phases:
+        print('%-60s %10.1f' % (name, elapsed * 1000))
+    print('%-60s %10.1f' % ('total', sum(i[1] for i in xanmel.startup_phases) * 1000))
+    # Includes the interpreter startup and the imports
+    print('%-60s %10.1f' % ('process CPU time', time.process_time() * 1000))
+
+
+def offline_xanmel(config, db=True):
+    """
+    Load the modules without journaling and without starting the event generators. With db=False the configured
+    database is replaced by a disconnected one, so the handlers don't write to it.
+    """
+    xanmel = Xanmel(loop=asyncio.get_event_loop(), config_path=config)
+    if xanmel.journal:
+        xanmel.journal.close()
+        xanmel.journal = None
+    if not db:
+        xanmel.metrics.collectors.remove(xanmel.db.collect_metrics)
+        xanmel.db.teardown(xanmel.loop)
+        xanmel.db = XanmelDB(None)
+        xanmel.metrics.collectors.append(xanmel.db.collect_metrics)
+    xanmel.load_modules(event_generators=False)
+    return xanmel
+
+
+@main.command()
+@click.argument('journal', type=click.Path(exists=True, dir_okay=False))
+@click.option('--speed', type=click.Choice(['recorded', 'max']), default='max',
+              help='Keep the recorded intervals between events or replay them as fast as possible')
+@click.option('--db', is_flag=True, help='Let the handlers write to the configured database')
+@click.pass_obj
+def replay(config, journal, speed, db):
+    """
+    Feed the events from JOURNAL to the handlers.
+
+    Event generators are not started, so the handlers run against disconnected servers and channels. The configured
+    database is not used unless --db is given.
+    """
+    xanmel = offline_xanmel(config, db=db)
+    loop = xanmel.loop
+    count, elapsed = loop.run_until_complete(replay_journal(xanmel, journal, speed))
+    print('Replayed %s events in %.3f s (%.1f events/s)' % (count, elapsed, count / elapsed if elapsed else 0))
+    for event_type, stats in xanmel.bus.stats().items():
+        print('%s: %s' % (event_type, ', '.join('%s=%s' % i for i in stats.items())))
+    xanmel.teardown()
+
+
+@main.command('bench-log')
+@click.option('--log', 'log_path', type=click.Path(exists=True, dir_okay=False), help='Raw log capture')
+@click.option('--cmd', 'cmd_path', type=click.Path(exists=True, dir_okay=False), help='Raw rcon command capture')
+@click.option('--server', default=None, help='Name of the server whose parsers are used, the first one by default')
+@click.option('--chunk-size', default=1400, help='Bytes fed to the parser at once')
+@click.option('--repeat', default=1, help='Number of times each capture is fed')
+@click.pass_obj
+def bench_log(config, log_path, cmd_path, server, chunk_size, repeat):
+    """
+    Measure the throughput of the xonotic rcon parsers and the event handlers on raw captures.
+    """
+    if not (log_path or cmd_path):
+        raise click.UsageError('At least one of --log and --cmd is required')
+    from .modules.xonotic import bench
+    xanmel = offline_xanmel(config, db=False)
+    bench.run(xanmel, server, log_path, cmd_path, chunk_size, repeat)
+    xanmel.teardown()
+
+
+@main.command()
+@click.option('--bench', is_flag=True, help='Time the computation on random records instead')
+@click.option('--records', default=500000, help='Number of random records for --bench')
+@click.option('--players', default=5000, help='Number of random players for --bench')
+@click.option('--maps', default=2000, help='Number of random maps for --bench')
+@click.pass_obj
+def ladders(config, bench, records, players, maps):
+    """
+    Build new snapshots of the XDF ladders: the global one, one per physics and one per server.
+    """
+    from .modules.xonotic import ladder
+    if bench:
+        result = ladder.benchmark(records, players, maps)
+        print('%(records)s records, %(players)s players, %(maps)s maps: %(seconds).3f s '
+              '(%(records_per_second).0f records/s)' % result)
+        return
+    xanmel = Xanmel(loop=asyncio.get_event_loop(), config_path=config)
+    if not xanmel.db.is_up:
+        raise click.ClickException('The database is not configured')
+    for i in ladder.build_all():
+        print('Ladder %s (%s): %s players' % (i.id, i.physics or i.server_id or 'global', i.max_position or 0))
+    xanmel.teardown()
+
+
+@main.command()
+@click.option('--list', 'list_only', is_flag=True, help='Only list the pending migrations')
+@click.option('--fake', is_flag=True, help='Record the pending migrations as applied without running them')
+@click.pass_obj
+def migrate(config, list_only, fake):
+    """
+    Apply the pending database schema migrations of the configured modules.
+    """
+    from .migrations import migrate as apply_migrations, pending_migrations
+    xanmel = Xanmel(loop=asyncio.get_event_loop(), config_path=config)
+    if not xanmel.db.is_up:
+        raise click.ClickException('The database is not configured')
+    packages = [i.rsplit('.', 1)[0] for i in xanmel.config['modules']]
+    if list_only:
+        for name, _ in pending_migrations(xanmel.db, packages):
+            print(name)
+    else:
+        for name in apply_migrations(xanmel.db, packages, fake):
+            print('Applied %s' % name)
+    xanmel.teardown()
+
+
+@main.command('bench-identification')
+@click.option('--rows', default=20000, help='Number of rows inserted')
+@click.option('--batch-size', default=500, help='Rows inserted with one statement')
+@click.option('--lookups', default=500, help='Number of lookups of each kind')
+@click.pass_obj
+def bench_identification(config, rows, batch_size, lookups):
+    """
+    Compare the insert throughput and the lookup latency of player_identification before and after its index
+    migration, on scratch tables in the configured database.
+    """
+    from .modules.xonotic import bench_identification as bench
+    xanmel = Xanmel(loop=asyncio.get_event_loop(), config_path=config)
+    if not xanmel.db.is_up:
+        raise click.ClickException('The database is not configured')
+    xanmel.db.create_tables('xanmel.modules.xonotic')
+    bench.print_report(xanmel.db.run_sync(lambda: bench.benchmark(rows, batch_size, lookups)))
+    xanmel.teardown()
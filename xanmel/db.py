@@ -1,16 +1,22 @@
+import asyncio
 import importlib
 import inspect
 import logging
+import time
+from collections import OrderedDict
 
 import peewee
-import peewee_async
+from playhouse.postgres_ext import BinaryJSONField
 from playhouse.db_url import connect, register_database
 
+from .querylog import InstrumentedManager, PooledPostgresqlDatabase, PostgresqlDatabase, QueryLog
+from .sqlite import SqliteManager, connect_sqlite
 
-register_database(peewee_async.PostgresqlDatabase, 'postgres')
-register_database(peewee_async.PooledPostgresqlDatabase, 'postgres+pool')
-register_database(peewee_async.PostgresqlDatabase, 'postgresql')
-register_database(peewee_async.PooledPostgresqlDatabase, 'postgresql+pool')
+
+register_database(PostgresqlDatabase, 'postgres')
+register_database(PooledPostgresqlDatabase, 'postgres+pool')
+register_database(PostgresqlDatabase, 'postgresql')
+register_database(PooledPostgresqlDatabase, 'postgresql+pool')
 
 
 logger = logging.getLogger(__name__)
@@ -23,14 +29,99 @@ class BaseModel(peewee.Model):
         database = database_proxy
 
 
+class IdentityMap:
+    """
+    LRU cache of model instances keyed by a natural key, e.g. (Map, server id, map name).
+
+    Instances are cached as they were when loaded or created. Only rows whose cached fields are changed
+    exclusively by this process are safe to keep here.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.objects = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model, fields):
+        return (model,) + tuple(sorted((k, v.get_id() if isinstance(v, peewee.Model) else v)
+                                       for k, v in fields.items()))
+
+    def get(self, model, **fields):
+        key = self.key(model, fields)
+        obj = self.objects.get(key)
+        if obj is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.objects.move_to_end(key)
+        return obj
+
+    def put(self, obj, **fields):
+        key = self.key(type(obj), fields)
+        self.objects[key] = obj
+        self.objects.move_to_end(key)
+        if len(self.objects) > self.size:
+            self.objects.popitem(last=False)
+
+    def clear(self):
+        self.objects.clear()
+
+
 class XanmelDB:
-    def __init__(self, db_url):
+    """
+    Rows added with insert() are written behind: they are queued and flushed with one INSERT per model when
+    batch_size rows are queued, or every interval seconds. Configured in the db_write_behind section of the settings::
+
+        db_write_behind:
+          batch_size: 500
+          interval: 2
+
+    sqlite:///path/to/xanmel.db urls use the embedded backend from xanmel.sqlite instead of peewee_async.
+
+    The connection pool of postgresql+pool urls is sized by the db_pool section, queries slower than
+    db_slow_query seconds are logged::
+
+        db_pool:
+          min_connections: 1
+          max_connections: 20
+        db_slow_query: 0.5
+    """
+
+    def __init__(self, db_url, write_behind=None, cache_size=10000, pool=None, slow_query=None):
+        self.is_sqlite = False
+        self.query_log = QueryLog(slow_query)
         if db_url:
-            self.db = connect(db_url)
-            self.mgr = peewee_async.Manager(database_proxy)
+            if '+pool' in db_url.split(':', 1)[0]:
+                self.db = connect(db_url, **(pool or {}))
+            else:
+                self.db = connect(db_url)
+            if isinstance(self.db, peewee.SqliteDatabase):
+                self.db = connect_sqlite(self.db.database)
+                self.mgr = SqliteManager(self.db, self.query_log)
+                self.is_sqlite = True
+            else:
+                self.mgr = InstrumentedManager(database_proxy, self.query_log)
             database_proxy.initialize(self.db)
         else:
             self.db = None
+        write_behind = write_behind or {}
+        self.batch_size = write_behind.get('batch_size', 500)
+        self.flush_interval = write_behind.get('interval', 2)
+        # (model, field names) -> list of rows
+        self.pending = OrderedDict()
+        # (model, field names) -> OrderedDict of key -> row, see upsert()
+        self.pending_upserts = OrderedDict()
+        self.pending_rows = 0
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self.flushes = 0
+        self.flush_time = 0
+        self.max_flush_time = 0
+        self.identity_map = IdentityMap(cache_size)
 
     def create_tables(self, module_pkg_name):
         if not self.is_up:
@@ -42,10 +133,171 @@ class XanmelDB:
         model_classes = []
         for model_name, model in inspect.getmembers(models, inspect.isclass):
             if issubclass(model, BaseModel) and model is not BaseModel:
+                if self.is_sqlite and any(isinstance(f, BinaryJSONField) for f in model._meta.sorted_fields):
+                    logger.warning('Model %s requires PostgreSQL, not creating its table', model_name)
+                    continue
                 logger.debug('Creating table for model %s', model_name)
                 model_classes.append(model)
-        self.db.create_tables(model_classes, safe=True)
+        from .migrations import migrate, pending_migrations
+        pending = pending_migrations(self, [module_pkg_name])
+        if pending:
+            existing = set(self.run_sync(self.db.get_tables))
+            if existing.isdisjoint(i._meta.table_name for i in model_classes):
+                # The tables are created with the current schema, there is nothing to migrate
+                migrate(self, [module_pkg_name], fake=True)
+            else:
+                # Data migrations may take long, they are left to xanmel migrate. The existing tables may not match
+                # the models until then.
+                logger.warning('Pending migrations: %s. Run xanmel migrate, until then only the missing tables of %s '
+                               'are created', ', '.join(i[0] for i in pending), module_pkg_name)
+                model_classes = [i for i in model_classes if i._meta.table_name not in existing]
+        self.run_sync(lambda: self.db.create_tables(model_classes, safe=True))
+
+    def run_sync(self, func):
+        """
+        Call func which uses the synchronous peewee API and return its result, blocking the event loop.
+        """
+        if self.is_sqlite:
+            # The connection belongs to the writer thread
+            return self.mgr.run_sync(func)
+        return func()
 
     @property
     def is_up(self):
         return self.db is not None
+
+    async def get_or_create(self, model, defaults=None, **fields):
+        """
+        Cached version of Manager.get_or_create. Returns an (instance, created) tuple.
+        """
+        obj = self.identity_map.get(model, **fields)
+        if obj is not None:
+            return obj, False
+        obj, created = await self.mgr.get_or_create(model, defaults, **fields)
+        self.identity_map.put(obj, **fields)
+        return obj, created
+
+    @staticmethod
+    def fill_defaults(model, fields):
+        for field, default in model._meta.defaults.items():
+            if field.name not in fields:
+                fields[field.name] = default() if callable(default) else default
+
+    def insert(self, model, **fields):
+        """
+        Queue a row for insertion. Field defaults are evaluated now rather than when the row is flushed.
+        """
+        if not self.is_up:
+            return
+        self.fill_defaults(model, fields)
+        self.pending.setdefault((model, tuple(sorted(fields))), []).append(fields)
+        self.pending_rows += 1
+        self.queued()
+
+    def upsert(self, model, key, **fields):
+        """
+        Queue a row for model.upsert(rows), which must return an INSERT ... ON CONFLICT query. Queued rows with the
+        same key are merged with model.merge(old, new) first, so a flush touches each key once.
+        """
+        if not self.is_up:
+            return
+        self.fill_defaults(model, fields)
+        rows = self.pending_upserts.setdefault((model, tuple(sorted(fields))), OrderedDict())
+        if key in rows:
+            rows[key] = model.merge(rows[key], fields)
+        else:
+            rows[key] = fields
+            self.pending_rows += 1
+            self.queued()
+
+    def queued(self):
+        if self.pending_rows >= self.batch_size and not self.flush_lock.locked():
+            asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        async with self.flush_lock:
+            while self.pending or self.pending_upserts:
+                if self.pending:
+                    (model, _), rows = self.pending.popitem(last=False)
+                    query_for = model.insert_many
+                else:
+                    (model, _), rows = self.pending_upserts.popitem(last=False)
+                    rows = list(rows.values())
+                    query_for = model.upsert
+                self.pending_rows -= len(rows)
+                started = time.perf_counter()
+                try:
+                    await self.mgr.execute(query_for(rows))
+                except Exception:
+                    logger.exception('Could not insert %s %s rows, retrying row by row', len(rows), model.__name__)
+                    failed = await self.retry_rows(model, query_for, rows)
+                    self.failed_rows += failed
+                    self.flushed_rows += len(rows) - failed
+                else:
+                    self.flushed_rows += len(rows)
+                elapsed = time.perf_counter() - started
+                self.flushes += 1
+                self.flush_time += elapsed
+                self.max_flush_time = max(self.max_flush_time, elapsed)
+
+    async def retry_rows(self, model, query_for, rows):
+        """
+        Insert the rows of a failed batch one at a time, so one bad row does not lose the others. Returns the number
+        of rows that failed again.
+        """
+        failed = 0
+        for row in rows:
+            try:
+                await self.mgr.execute(query_for([row]))
+            except Exception:
+                logger.exception('Could not insert %s row %r', model.__name__, row)
+                failed += 1
+        return failed
+
+    async def flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def setup_event_generators(self, loop):
+        if self.is_up:
+            self.flush_task = loop.create_task(self.flush_forever())
+
+    def collect_metrics(self):
+        return [
+            ('xanmel_db_pending_rows', 'gauge', 'Rows waiting in the write-behind queue', self.pending_rows),
+            ('xanmel_db_flushed_rows_total', 'counter', 'Rows written by the write-behind queue', self.flushed_rows),
+            ('xanmel_db_failed_rows_total', 'counter', 'Rows lost because their INSERT failed', self.failed_rows),
+            ('xanmel_db_flushes_total', 'counter', 'INSERT statements run by the write-behind queue', self.flushes),
+            ('xanmel_db_flush_seconds_total', 'counter', 'Time spent in write-behind INSERT statements',
+             self.flush_time),
+            ('xanmel_db_flush_seconds_max', 'gauge', 'The slowest write-behind INSERT statement', self.max_flush_time),
+            ('xanmel_db_cache_hits_total', 'counter', 'Rows found in the identity map', self.identity_map.hits),
+            ('xanmel_db_cache_misses_total', 'counter', 'Rows looked up in the database', self.identity_map.misses),
+            ('xanmel_db_slow_queries_total', 'counter', 'Queries slower than db_slow_query',
+             self.query_log.slow_queries),
+        ] + self.backend_metrics()
+
+    def backend_metrics(self):
+        if not self.is_up:
+            return []
+        if self.is_sqlite:
+            return [('xanmel_db_sqlite_commits_total', 'counter', 'Group commits of the SQLite writer thread',
+                     self.mgr.commits)]
+        pool_stats = self.mgr.pool_stats()
+        if pool_stats is None:
+            return []
+        size, free, max_size = pool_stats
+        return [
+            ('xanmel_db_pool_connections', 'gauge', 'Open database connections', size),
+            ('xanmel_db_pool_free_connections', 'gauge', 'Idle database connections', free),
+            ('xanmel_db_pool_max_connections', 'gauge', 'Size limit of the connection pool', max_size),
+        ]
+
+    def teardown(self, loop):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        if self.pending or self.pending_upserts:
+            loop.run_until_complete(self.flush())
+        if self.is_sqlite:
+            self.mgr.close()
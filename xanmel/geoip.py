@@ -0,0 +1,71 @@
+from collections import OrderedDict
+
+import geoip2.database
+import geoip2.errors
+import maxminddb
+
+try:
+    import maxminddb.extension  # noqa: F401
+except ImportError:
+    MMAP_MODE = maxminddb.MODE_MMAP
+else:
+    MMAP_MODE = maxminddb.MODE_MMAP_EXT
+
+DEFAULT_CACHE_SIZE = 4096
+
+
+class GeoIP:
+    """
+    Memory mapped GeoIP city database with an LRU cache of lookups keyed by IP address.
+
+    Values derived from a lookup result (see memoized) are cached along with it.
+    """
+
+    def __init__(self, path, cache_size=DEFAULT_CACHE_SIZE):
+        self.reader = geoip2.database.Reader(path, mode=MMAP_MODE)
+        self.cache_size = cache_size
+        # ip address -> [city response or None, {function: derived value}]
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, ip_address):
+        entry = self.cache.get(ip_address)
+        if entry is not None:
+            self.hits += 1
+            self.cache.move_to_end(ip_address)
+            return entry
+        self.misses += 1
+        try:
+            response = self.reader.city(ip_address)
+        except (ValueError, geoip2.errors.AddressNotFoundError):
+            response = None
+        entry = self.cache[ip_address] = [response, {}]
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return entry
+
+    def city(self, ip_address):
+        """
+        Unlike geoip2 Reader.city returns None for invalid and unknown addresses.
+        """
+        return self.entry(ip_address)[0]
+
+    def memoized(self, ip_address, func):
+        """
+        Return func(city response), computing it only once while the address stays in the cache.
+        """
+        response, derived = self.entry(ip_address)
+        if func not in derived:
+            derived[func] = func(response)
+        return derived[func]
+
+    def collect_metrics(self):
+        return [
+            ('xanmel_geoip_cache_hits_total', 'counter', 'GeoIP lookups served from the cache', self.hits),
+            ('xanmel_geoip_cache_misses_total', 'counter', 'GeoIP lookups read from the database', self.misses),
+            ('xanmel_geoip_cache_size', 'gauge', 'Cached GeoIP lookups', len(self.cache)),
+        ]
+
+    def close(self):
+        self.reader.close()
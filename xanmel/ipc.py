@@ -0,0 +1,426 @@
+"""
+Sharding of modules between worker processes.
+
+In the supervisor mode the main process runs all modules except the sharded ones, and spawns worker processes
+which run the sharded modules. The list configured for a sharded module (e.g. the xonotic servers) is split between
+the workers, so each worker owns a subset of the servers with their log listeners, parsers and players::
+
+    sharding:
+      workers: 4
+      modules:
+        xanmel.modules.xonotic.XonoticModule: servers
+
+An item is assigned to the worker by its index in the list, or by its shard option if it has one.
+
+Workers connect to the supervisor over a Unix socket. In a worker the other modules are replaced with RemoteModule
+stand-ins: their actions and remote_methods are run by the supervisor. Events fired in one process are forwarded
+to the other one if it has handlers for them. Command containers registered by the sharded modules are mirrored in
+the supervisor's command root, and the commands are run by the worker.
+
+Messages are length-prefixed pickled tuples. Modules, servers and players are pickled as journal references
+(see xanmel.journal), so they have to be resolvable on the receiving side.
+"""
+import asyncio
+import datetime
+import importlib
+import inspect
+import io
+import logging
+import os
+import pickle
+import sys
+import tempfile
+
+import pytz
+
+from . import Action, ChatCommand, CommandContainer, Module
+from .bus import event_type_name
+from .journal import RECORD_HEADER, EventJournal, JournalPickler, JournalUnpickler, load_event_type
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before restarting a worker process which has exited
+RESTART_DELAY = 10
+
+# Bytes buffered for a channel whose other side doesn't read, above which messages are dropped
+MAX_WRITE_BUFFER = 4 * 1024 * 1024
+
+
+def dumps(message):
+    buf = io.BytesIO()
+    JournalPickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump(message)
+    return buf.getvalue()
+
+
+def loads(data, xanmel):
+    return JournalUnpickler(io.BytesIO(data), xanmel).load()
+
+
+class Channel:
+    """
+    Connection between the supervisor and a worker.
+    """
+
+    def __init__(self, xanmel, reader, writer):
+        self.xanmel = xanmel
+        self.reader = reader
+        self.writer = writer
+        self.shard = None
+        # Names of the event types the other side has handlers for
+        self.event_types = set()
+        self.dropped = 0
+
+    def send(self, *message):
+        """
+        Queue a message without waiting for the other side. Messages are dropped while more than MAX_WRITE_BUFFER
+        bytes are waiting to be sent, so a stalled process can't make the buffer grow without bounds.
+        """
+        if self.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            self.dropped += 1
+            logger.info('Dropping %s message to shard %s - the channel is not read', message[0], self.shard)
+            return
+        try:
+            data = dumps(message)
+        except Exception:
+            logger.warning('Could not serialize %s message', message[0], exc_info=True)
+            return
+        self.writer.write(RECORD_HEADER.pack(len(data)) + data)
+
+    async def receive(self):
+        """
+        Returns the next message data, or None if the connection is closed.
+        """
+        try:
+            header = await self.reader.readexactly(RECORD_HEADER.size)
+            return await self.reader.readexactly(RECORD_HEADER.unpack(header)[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    def close(self):
+        self.writer.close()
+
+
+class RemoteModule(Module):
+    """
+    Stand-in for a module running in the supervisor. Calls of the module's remote_methods are forwarded to it.
+    """
+
+    def __init__(self, xanmel, config, module_class):
+        self.module_class = module_class
+        super().__init__(xanmel, config)
+
+    def __getattr__(self, name):
+        if name not in self.module_class.remote_methods:
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            self.xanmel.ipc.call(self.path, name, args, kwargs)
+
+        return call
+
+
+class RemoteAction:
+    def __init__(self, module, action_class):
+        self.module = module
+        self.action_class = action_class
+
+    async def run(self, **kwargs):
+        self.module.xanmel.ipc.call_action(self.action_class, kwargs)
+
+
+class RemoteCommand(ChatCommand):
+    def __init__(self, prefix, help_args, help_text, allowed_user_types, disallowed_user_types, admin_required):
+        self.prefix = prefix
+        self.help_args = help_args
+        self.help_text = help_text
+        self.allowed_user_types = allowed_user_types
+        self.disallowed_user_types = disallowed_user_types
+        self.admin_required = admin_required
+
+
+class RemoteCommandContainer(CommandContainer):
+    """
+    Mirror of a command container registered in a worker. Commands are run by the worker.
+    """
+
+    def __init__(self, channel, help_text, commands):
+        super().__init__()
+        self.channel = channel
+        self.help_text = help_text
+        for i in commands:
+            self.children[i[0]] = RemoteCommand(*i)
+
+    async def run(self, user, message, is_private=False, root=None):
+        self.channel.send('command', self.prefix, user, message, is_private)
+
+
+def describe_container(container):
+    return container.prefix, container.help_text, [
+        (prefix, i.help_args, i.help_text, i.allowed_user_types, i.disallowed_user_types, i.admin_required)
+        for prefix, i in container.children.items()
+    ]
+
+
+class IPCPeer:
+    def __init__(self, xanmel, config):
+        self.xanmel = xanmel
+        self.loop = xanmel.loop
+        # Module path -> name of the config list split between the workers
+        self.sharded = config.get('modules') or {}
+        self.channels = []
+        self.tasks = []
+        xanmel.ipc = self
+
+    def is_local(self, module_path):
+        raise NotImplementedError  # pragma: no cover
+
+    def shard_modules(self, modules_config):
+        return modules_config
+
+    def load_remote_module(self, module_path, module_config):
+        pass
+
+    def handled_event_types(self):
+        return sorted(event_type_name(event) for event, handlers in self.xanmel.handlers.items() if handlers)
+
+    def forward(self, event):
+        name = event_type_name(type(event))
+        for channel in self.channels:
+            if name in channel.event_types:
+                channel.send('event', name, event.timestamp.timestamp(), event.module, event.properties)
+
+    async def serve(self, channel):
+        while True:
+            data = await channel.receive()
+            if data is None:
+                break
+            try:
+                kind, *args = loads(data, self.xanmel)
+                getattr(self, 'on_' + kind)(channel, *args)
+            except Exception:
+                logger.warning('Could not handle a message from shard %s', channel.shard, exc_info=True)
+
+    def on_hello(self, channel, shard, event_types):
+        channel.event_types = set(event_types)
+
+    def on_event(self, channel, type_name, timestamp, module, properties):
+        event = load_event_type(type_name)(module, **properties)
+        event.timestamp = datetime.datetime.fromtimestamp(timestamp, tz=pytz.utc)
+        self.xanmel.bus.publish_nowait(event)
+
+    def reload(self):
+        pass
+
+    def setup_event_generators(self):
+        pass
+
+    def stop(self):
+        for i in self.tasks:
+            i.cancel()
+        for i in self.channels:
+            i.close()
+
+
+class Supervisor(IPCPeer):
+    def __init__(self, xanmel, config, socket_path=None):
+        super().__init__(xanmel, config)
+        self.workers = int(config['workers'])
+        # Messages are unpickled, so only the user running the bot may connect: the socket is created in a
+        # private directory and is only accessible by its owner
+        self.socket_dir = None
+        if socket_path is None:
+            self.socket_dir = tempfile.mkdtemp(prefix='xanmel-')
+            socket_path = os.path.join(self.socket_dir, 'supervisor.sock')
+        self.socket_path = socket_path
+        self.server = None
+        self.processes = {}
+        # shard -> mirrored command containers
+        self.containers = {}
+
+    def is_local(self, module_path):
+        return module_path not in self.sharded
+
+    async def start_server(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = await asyncio.start_unix_server(self.accept, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+
+    async def start(self):
+        await self.start_server()
+        for shard in range(self.workers):
+            self.tasks.append(self.loop.create_task(self.run_worker(shard)))
+
+    def setup_event_generators(self):
+        self.tasks.append(self.loop.create_task(self.start()))
+
+    async def run_worker(self, shard):
+        while True:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'xanmel', '-c', self.xanmel.config_path,
+                'worker', '--shard', str(shard), '--socket', self.socket_path)
+            self.processes[shard] = process
+            logger.info('Started worker %s, pid %s', shard, process.pid)
+            returncode = await process.wait()
+            logger.warning('Worker %s exited with code %s, restarting in %s seconds', shard, returncode, RESTART_DELAY)
+            await asyncio.sleep(RESTART_DELAY)
+
+    async def accept(self, reader, writer):
+        channel = Channel(self.xanmel, reader, writer)
+        self.channels.append(channel)
+        channel.send('hello', None, self.handled_event_types())
+        try:
+            await self.serve(channel)
+        finally:
+            logger.info('Worker %s disconnected', channel.shard)
+            self.channels.remove(channel)
+            self.unregister_containers(channel.shard)
+
+    def on_hello(self, channel, shard, event_types):
+        super().on_hello(channel, shard, event_types)
+        channel.shard = shard
+        logger.info('Worker %s connected', shard)
+
+    def unregister_containers(self, shard):
+        for i in self.containers.pop(shard, []):
+            self.xanmel.cmd_root.unregister_container(i)
+
+    def on_commands(self, channel, containers):
+        self.unregister_containers(channel.shard)
+        self.containers[channel.shard] = []
+        for prefix, help_text, commands in containers:
+            container = RemoteCommandContainer(channel, help_text, commands)
+            self.xanmel.cmd_root.register_container(container, prefix)
+            self.containers[channel.shard].append(container)
+
+    def on_action(self, channel, type_name, kwargs):
+        self.loop.create_task(self.run_action(type_name, kwargs))
+
+    async def run_action(self, type_name, kwargs):
+        metrics = self.xanmel.metrics
+        try:
+            with metrics.timed(metrics.actions, type_name):
+                await self.xanmel.actions[load_event_type(type_name)].run(**kwargs)
+        except Exception:
+            logger.exception('Remote action %s failed', type_name)
+
+    def on_call(self, channel, module_path, method, args, kwargs):
+        getattr(self.xanmel.modules[module_path], method)(*args, **kwargs)
+
+    def reload(self):
+        for i in self.channels:
+            i.send('reload')
+
+    def stop(self):
+        super().stop()
+        for i in self.processes.values():
+            if i.returncode is None:
+                i.terminate()
+        if self.server is not None:
+            self.server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        if self.socket_dir is not None:
+            os.rmdir(self.socket_dir)
+
+
+class Worker(IPCPeer):
+    def __init__(self, xanmel, config, shard, socket_path):
+        super().__init__(xanmel, config)
+        self.workers = int(config['workers'])
+        self.shard = shard
+        self.socket_path = socket_path
+        self.channel = None
+        xanmel.config['modules'] = self.shard_modules(xanmel.config['modules'])
+        # Each worker has its own journal file and metrics port
+        if xanmel.journal:
+            xanmel.journal.close()
+            xanmel.journal = EventJournal('%s.%s' % (xanmel.journal.path, shard),
+                                          xanmel.journal.pending.maxsize)
+        if xanmel.metrics.config.get('port'):
+            xanmel.metrics.config = dict(xanmel.metrics.config, port=int(xanmel.metrics.config['port']) + 1 + shard)
+
+    def shard_modules(self, modules_config):
+        """
+        Leave only the items of the sharded modules' lists which belong to this worker.
+        """
+        modules_config = modules_config.copy()
+        for module_path, key in self.sharded.items():
+            if module_path not in modules_config:
+                continue
+            module_config = modules_config[module_path] = modules_config[module_path].copy()
+            module_config[key] = [i for index, i in enumerate(module_config[key])
+                                  if i.get('shard', index) % self.workers == self.shard]
+        return modules_config
+
+    def is_local(self, module_path):
+        return module_path in self.sharded
+
+    def load_remote_module(self, module_path, module_config):
+        if module_path in self.xanmel.modules:
+            self.xanmel.modules[module_path].config = module_config
+            return
+        module_pkg_name, module_name = module_path.rsplit('.', 1)
+        module_pkg = importlib.import_module(module_pkg_name)
+        module = RemoteModule(self.xanmel, module_config, getattr(module_pkg, module_name))
+        module.path = module_path
+        self.xanmel.modules[module_path] = module
+        try:
+            actions_mod = importlib.import_module(module_pkg_name + '.actions')
+        except ImportError:
+            return
+        for _, member in inspect.getmembers(actions_mod, inspect.isclass):
+            if issubclass(member, Action):
+                self.xanmel.actions[member] = RemoteAction(module, member)
+
+    def call(self, module_path, method, args, kwargs):
+        if self.channel is None:
+            logger.info('Dropping %s call - not connected to the supervisor', method)
+            return
+        self.channel.send('call', module_path, method, args, kwargs)
+
+    def call_action(self, action_class, kwargs):
+        if self.channel is None:
+            logger.info('Dropping %s - not connected to the supervisor', action_class.__name__)
+            return
+        self.channel.send('action', event_type_name(action_class), kwargs)
+
+    def send_commands(self):
+        containers = []
+        for path, module in self.xanmel.modules.items():
+            if self.is_local(path):
+                containers.extend(describe_container(i) for i in module.command_containers if i.prefix)
+        self.channel.send('commands', containers)
+
+    async def connect(self):
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        self.channel = Channel(self.xanmel, reader, writer)
+        self.channel.shard = self.shard
+        self.channels.append(self.channel)
+        self.channel.send('hello', self.shard, self.handled_event_types())
+        self.send_commands()
+
+    async def run(self):
+        await self.connect()
+        await self.serve(self.channel)
+        logger.warning('Lost connection to the supervisor, exiting')
+        self.loop.stop()
+
+    def setup_event_generators(self):
+        self.tasks.append(self.loop.create_task(self.run()))
+
+    def on_command(self, channel, prefix, user, message, is_private):
+        container = self.xanmel.cmd_root.children.get(prefix)
+        if container is not None:
+            self.loop.create_task(container.run(user, message, is_private, root=self.xanmel.cmd_root))
+
+    def on_reload(self, channel):
+        self.loop.create_task(self.reload_config())
+
+    async def reload_config(self):
+        try:
+            await self.xanmel.reload()
+        except Exception:
+            logger.exception('Failed to reload configuration')
+        else:
+            self.send_commands()
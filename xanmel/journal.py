@@ -0,0 +1,172 @@
+import asyncio
+import datetime
+import importlib
+import io
+import logging
+import os
+import pickle
+import queue
+import struct
+import threading
+import time
+from collections import Counter
+
+import pytz
+
+from .bus import event_type_name
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'XNJ1'
+RECORD_HEADER = struct.Struct('<I')
+
+
+class JournalPickler(pickle.Pickler):
+    """
+    Pickles event properties. Objects which have a journal_ref() method (modules, servers, players) are stored
+    as references and resolved back into live objects on replay.
+    """
+
+    def persistent_id(self, obj):
+        journal_ref = getattr(obj, 'journal_ref', None)
+        if journal_ref is not None and not isinstance(obj, type):
+            return journal_ref()
+
+
+class JournalUnpickler(pickle.Unpickler):
+    def __init__(self, file, xanmel):
+        super().__init__(file)
+        self.xanmel = xanmel
+
+    def persistent_load(self, pid):
+        module_path, kind, *args = pid
+        return self.xanmel.modules[module_path].resolve_journal_ref(kind, *args)
+
+
+def dump_record(event):
+    buf = io.BytesIO()
+    JournalPickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump((
+        event_type_name(type(event)),
+        event.timestamp.timestamp(),
+        event.module,
+        event.properties
+    ))
+    return buf.getvalue()
+
+
+def load_event_type(name):
+    module_name, class_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class EventJournal:
+    """
+    Append-only journal of fired events.
+
+    Events are serialized when they are fired and written to the file by a background thread, so recording an event
+    never blocks the event loop. If the writer falls behind by more than max_pending records, new records are dropped.
+
+    The file starts with a magic header followed by length-prefixed pickled records of
+    (event type, timestamp, module, properties).
+    """
+
+    def __init__(self, path, max_pending=10000):
+        self.path = os.path.expanduser(path)
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.recorded = 0
+        self.dropped = 0
+        self.failed = Counter()
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.writer = threading.Thread(target=self.write_forever, name='xanmel-journal', daemon=True)
+        self.writer.start()
+
+    def record(self, event):
+        try:
+            data = dump_record(event)
+        except Exception:
+            event_type = type(event).__name__
+            if not self.failed[event_type]:
+                logger.warning('Could not serialize %s for the journal', event_type, exc_info=True)
+            self.failed[event_type] += 1
+            return
+        try:
+            self.pending.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.recorded += 1
+
+    def write_forever(self):
+        while True:
+            data = self.pending.get()
+            if data is None:
+                break
+            self.file.write(RECORD_HEADER.pack(len(data)))
+            self.file.write(data)
+            if self.pending.empty():
+                self.file.flush()
+        self.file.close()
+
+    def close(self):
+        self.pending.put(None)
+        self.writer.join()
+
+
+class JournalReader:
+    def __init__(self, path, xanmel):
+        self.path = os.path.expanduser(path)
+        self.xanmel = xanmel
+        self.skipped = Counter()
+
+    def __iter__(self):
+        """
+        Yields (event type, timestamp, module, properties) tuples.
+        """
+        event_types = {}
+        with open(self.path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a xanmel event journal' % self.path)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                data = f.read(RECORD_HEADER.unpack(header)[0])
+                try:
+                    type_name, timestamp, module, properties = JournalUnpickler(io.BytesIO(data), self.xanmel).load()
+                    if type_name not in event_types:
+                        event_types[type_name] = load_event_type(type_name)
+                except Exception:
+                    logger.debug('Skipping journal record', exc_info=True)
+                    self.skipped['unreadable'] += 1
+                    continue
+                yield event_types[type_name], timestamp, module, properties
+
+
+async def replay(xanmel, path, speed='max'):
+    """
+    Feed the journal events to the handlers. With the recorded speed the original intervals between events are
+    preserved, with the max speed events are published as fast as the event bus accepts them.
+
+    Returns a (number of events, elapsed seconds) tuple.
+    """
+    reader = JournalReader(path, xanmel)
+    count = 0
+    first_timestamp = None
+    start = time.time()
+    for event_type, timestamp, module, properties in reader:
+        if first_timestamp is None:
+            first_timestamp = timestamp
+        if speed == 'recorded':
+            delay = (timestamp - first_timestamp) - (time.time() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        event = event_type(module, **properties)
+        event.timestamp = datetime.datetime.fromtimestamp(timestamp, tz=pytz.utc)
+        await xanmel.bus.publish(event)
+        count += 1
+    await xanmel.bus.join()
+    if reader.skipped:
+        logger.info('Skipped %s unreadable journal records', sum(reader.skipped.values()))
+    return count, time.time() - start
@@ -0,0 +1,161 @@
+import bisect
+import logging
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last one counts the values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket containing the q-quantile. Values above the largest bucket are bounded by max.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self):
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            yield bound, seen
+
+
+def format_bound(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_label(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Metrics:
+    """
+    Latency histograms of handlers and actions and counts of fired events.
+
+    The optional HTTP endpoint serving them in the Prometheus text format is configured in the metrics section
+    of the settings::
+
+        metrics:
+          listen: 127.0.0.1
+          port: 9105
+    """
+
+    def __init__(self, xanmel, config):
+        self.xanmel = xanmel
+        self.config = config or {}
+        self.buckets = tuple(sorted(self.config.get('buckets', DEFAULT_BUCKETS)))
+        self.handlers = defaultdict(self.new_histogram)
+        self.actions = defaultdict(self.new_histogram)
+        self.events = Counter()
+        # Functions returning lists of (metric name, type, help, value) of other components. The value of a labelled
+        # metric is a (label name, dict of label value -> value) tuple
+        self.collectors = []
+        # (metric name, label name, help, dict of label value -> Histogram) of other components
+        self.histograms = []
+        self.runner = None
+
+    def new_histogram(self):
+        return Histogram(self.buckets)
+
+    @contextmanager
+    def timed(self, histograms, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            histograms[name].observe(time.perf_counter() - started)
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric, label, help_text, histograms in [
+            ('xanmel_handler_seconds', 'handler', 'Time spent in Handler.handle', self.handlers),
+            ('xanmel_action_seconds', 'action', 'Time spent in Action.run', self.actions)
+        ] + self.histograms:
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s histogram' % metric)
+            for name, histogram in sorted(histograms.items()):
+                name = format_label(name)
+                for bound, count in histogram.cumulative():
+                    lines.append('%s_bucket{%s="%s",le="%s"} %s' % (metric, label, name, format_bound(bound), count))
+                lines.append('%s_sum{%s="%s"} %r' % (metric, label, name, float(histogram.sum)))
+                lines.append('%s_count{%s="%s"} %s' % (metric, label, name, histogram.count))
+        lines.append('# HELP xanmel_events_total Fired events')
+        lines.append('# TYPE xanmel_events_total counter')
+        for name, count in sorted(self.events.items()):
+            lines.append('xanmel_events_total{event="%s"} %s' % (format_label(name), count))
+        for collector in self.collectors:
+            for metric, metric_type, help_text, value in collector():
+                lines.append('# HELP %s %s' % (metric, help_text))
+                lines.append('# TYPE %s %s' % (metric, metric_type))
+                if isinstance(value, tuple):
+                    label, values = value
+                    for name, labelled_value in sorted(values.items()):
+                        lines.append('%s{%s="%s"} %s' % (metric, label, format_label(name), labelled_value))
+                else:
+                    lines.append('%s %s' % (metric, value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, limit=5):
+        """
+        Short human readable report of the slowest handlers and actions by total time.
+        """
+        lines = []
+        for title, histograms in [('Handler', self.handlers), ('Action', self.actions)]:
+            top = sorted(histograms.items(), key=lambda x: x[1].sum, reverse=True)[:limit]
+            for name, h in top:
+                lines.append('%s %s: n=%s avg=%.3fs p95<=%.3fs max=%.3fs' % (
+                    title, name.rsplit('.', 1)[-1], h.count, h.sum / h.count, h.quantile(0.95), h.max))
+        lines.append('Events fired: %s' % sum(self.events.values()))
+        return lines
+
+    async def handle_request(self, request):
+        from aiohttp import web
+        return web.Response(body=self.render().encode('utf8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def start_server(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_request)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        host = self.config.get('listen', '127.0.0.1')
+        port = int(self.config['port'])
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info('Serving metrics on http://%s:%s/metrics', host, port)
+
+    def setup_event_generators(self):
+        if self.config.get('port'):
+            self.xanmel.loop.create_task(self.start_server())
+
+    def teardown(self):
+        if self.runner:
+            self.xanmel.loop.create_task(self.runner.cleanup())
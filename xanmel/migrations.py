@@ -0,0 +1,88 @@
+"""
+Schema migrations.
+
+create_tables only creates missing tables and indexes. Changes to existing tables are done by migrations: a module
+package may have a ``migrations`` submodule with a MIGRATIONS list of (name, function) tuples. The function gets the
+peewee database and runs in a transaction. Applied migrations are recorded in the xanmel_migration table.
+
+Pending migrations are applied with ``xanmel migrate``. They may rewrite big tables, so they are never run at
+startup: the bot logs the pending ones and only creates the missing tables of the module. When none of the module's
+tables exist yet they are created with the current schema and the migrations are recorded as applied. Migrations
+still check the schema before changing it, so they do nothing on tables created from scratch.
+"""
+import importlib
+import logging
+
+from peewee import CharField, DateTimeField
+
+from xanmel import current_time
+from xanmel.db import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+class AppliedMigration(BaseModel):
+    name = CharField(unique=True)
+    applied = DateTimeField(default=current_time)
+
+    class Meta:
+        db_table = 'xanmel_migration'
+
+
+def has_column(database, table, column):
+    return column in {i.name for i in database.get_columns(table)}
+
+
+def drop_indexes(database, table, columns):
+    """
+    Drop the indexes created by peewee for the index=True fields of table.
+    """
+    for column in columns:
+        database.execute_sql('DROP INDEX IF EXISTS %s_%s' % (table, column))
+
+
+def package_migrations(pkg_names):
+    """
+    (full name, function) of the migrations of the packages, in order.
+    """
+    migrations = []
+    for pkg_name in pkg_names:
+        try:
+            module = importlib.import_module(pkg_name + '.migrations')
+        except ImportError:
+            continue
+        for name, func in module.MIGRATIONS:
+            migrations.append(('%s.%s' % (pkg_name, name), func))
+    return migrations
+
+
+def pending_migrations(db, pkg_names):
+    migrations = package_migrations(pkg_names)
+    if not migrations:
+        return []
+
+    def pending():
+        AppliedMigration.create_table(safe=True)
+        applied = {i.name for i in AppliedMigration.select(AppliedMigration.name)}
+        return [i for i in migrations if i[0] not in applied]
+
+    return db.run_sync(pending)
+
+
+def migrate(db, pkg_names, fake=False):
+    """
+    Run the pending migrations of the packages. With fake=True only record them as applied. Returns the names of
+    the applied migrations.
+    """
+    names = []
+    for name, func in pending_migrations(db, pkg_names):
+        def apply():
+            with db.db.atomic():
+                if not fake:
+                    func(db.db)
+                AppliedMigration.create(name=name)
+
+        logger.info('Applying migration %s', name)
+        db.run_sync(apply)
+        names.append(name)
+    return names
@@ -37,4 +37,4 @@ class Excuse(ChatCommand):
 class FunModule(Module):
     def __init__(self, xanmel, config):
         super(FunModule, self).__init__(xanmel, config)
-        xanmel.cmd_root.register_container(FunCommands(), '')
+        self.register_container(FunCommands(), '')
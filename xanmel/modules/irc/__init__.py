@@ -12,6 +12,64 @@ from .events import *
 
 logger = logging.getLogger(__name__)
 
+IRC_MAX_LINE = 512
+# Longest user and host parts of the prefix the server adds when relaying our messages
+MAX_USER_LENGTH = 10
+MAX_HOST_LENGTH = 63
+
+
+def split_message(message, limit):
+    """
+    Split a message into parts of at most limit bytes in utf8, preferably on spaces.
+    """
+    parts = []
+    while len(message.encode('utf8')) > limit:
+        head = message.encode('utf8')[:limit].decode('utf8', 'ignore')
+        space = head.rfind(' ')
+        if space > 0 and message[len(head)] != ' ':
+            head = head[:space]
+        parts.append(head)
+        message = message[len(head):].lstrip(' ')
+    parts.append(message)
+    return parts
+
+
+def pack_lines(messages, limit, separator=' | '):
+    """
+    Join messages into as few lines of at most limit bytes as possible, keeping their order.
+    """
+    lines = []
+    for message in messages:
+        for part in split_message(message, limit):
+            if lines and len((lines[-1] + separator + part).encode('utf8')) <= limit:
+                lines[-1] += separator + part
+            else:
+                lines.append(part)
+    return lines
+
+
+class FloodController:
+    """
+    Token bucket allowing a burst of lines at once, then rate lines per period seconds.
+    """
+
+    def __init__(self, burst, rate, period):
+        self.burst = burst
+        self.rate = rate / period
+        self.tokens = burst
+        self.updated = time.time()
+
+    async def wait(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            logger.debug('FLOOD BURST! Slowing down.')
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self.updated = time.time()
+            self.tokens = 1
+        self.tokens -= 1
+
 
 class IRCChatUser(ChatUser):
     user_type = 'irc'
@@ -30,11 +88,16 @@ class IRCChatUser(ChatUser):
     async def private_reply(self, message, **kwargs):
         self.module.send('PRIVMSG', target=self.name, message=message)
 
+    async def private_replies(self, messages, **kwargs):
+        self.module.send_block('PRIVMSG', self.name, messages)
+
     async def public_reply(self, message, **kwargs):
         self.module.send('PRIVMSG', target=self.module.config['channel'], message=message)
 
 
 class IRCModule(Module):
+    remote_methods = ('send', 'send_block')
+
     def __init__(self, xanmel, config):
         self.connected = False
         self.joined = False
@@ -94,10 +157,26 @@ class IRCModule(Module):
 
     def send(self, command, **kwargs):
         # TODO: catch 40* errors here
+        self.enqueue([(command, kwargs)])
+
+    def send_block(self, command, target, messages):
+        """
+        Pack messages into as few lines as the IRC line length allows and queue them as a block, which is not
+        interleaved with other messages.
+        """
+        lines = pack_lines(messages, self.line_limit(command, target))
+        self.enqueue([(command, {'target': target, 'message': i}) for i in lines])
+
+    def line_limit(self, command, target):
+        prefix = ':%s!%s@%s %s %s :\r\n' % (self.config['nick'], 'u' * MAX_USER_LENGTH, 'h' * MAX_HOST_LENGTH,
+                                            command, target)
+        return IRC_MAX_LINE - len(prefix.encode('utf8'))
+
+    def enqueue(self, block):
         if not self.message_queue.full():
-            self.message_queue.put_nowait((command, kwargs))
+            self.message_queue.put_nowait(block)
         else:
-            logger.info('Dropping command %s(%s) - message queue is full', command, kwargs)
+            logger.info('Dropping commands %s - message queue is full', block)
 
     async def pong(self, message, **kwargs):
         self.client.send('PONG', message=message)
@@ -107,39 +186,18 @@ class IRCModule(Module):
         self.connected = False
 
     async def process_queue(self):
-        fb = int(self.config.get('flood_burst', 5))
-        fr = int(self.config.get('flood_rate', 4))
-        frd = int(self.config.get('flood_rate_delay', 20))
-
-        def __get_delay():
-            mean = frd / fr
-            upper = mean + mean / 4
-            lower = mean - mean / 4
-            return random.random() * (upper - lower) + lower
-        current_burst = 0
+        flood_controller = FloodController(burst=int(self.config.get('flood_burst', 5)),
+                                           rate=int(self.config.get('flood_rate', 4)),
+                                           period=int(self.config.get('flood_rate_delay', 20)))
         while True:
             if not self.client.protocol or not self.joined:
                 await asyncio.sleep(10)
                 continue
-            t = time.time()
-            cmd, kwargs = await self.message_queue.get()
-            if current_burst + 1 < fb:
+            block = await self.message_queue.get()
+            for cmd, kwargs in block:
+                await flood_controller.wait()
                 # logger.debug('SENDING %s(%s)', cmd, kwargs)
                 self.client.send(cmd, **kwargs)
-                if time.time() - t < 1:
-                    current_burst += 1
-                else:
-                    current_burst = 0
-            else:
-                logger.debug('FLOOD BURST! Slowing down.')
-                await asyncio.sleep(__get_delay())
-                self.client.send(cmd, **kwargs)
-                while time.time() - t < frd:
-                    cmd, kwargs = await self.message_queue.get()
-                    await asyncio.sleep(__get_delay())
-                    self.client.send(cmd, **kwargs)
-                logger.debug('End of flood delay')
-                current_burst = 0
 
     async def check_connection(self):
         while True:
@@ -183,8 +241,8 @@ class IRCModule(Module):
         self.client.on('PING', self.pong)
         self.client.on('PRIVMSG', self.process_message)
         self.client.on('NOTICE', self.process_notice)
-        self.loop.create_task(self.check_connection())
-        self.loop.create_task(self.process_queue())
+        self.tasks.append(self.loop.create_task(self.check_connection()))
+        self.tasks.append(self.loop.create_task(self.process_queue()))
 
     async def process_message(self, target, message, **kwargs):
         kwargs['chat_user'] = IRCChatUser(self,
@@ -209,6 +267,11 @@ class IRCModule(Module):
         if message.startswith('CHALLENGE'):
             self.challenge_reply = message.split(' ')[1]
 
+    async def stop(self):
+        await super().stop()
+        if self.client.protocol:
+            await self.client.disconnect()
+
     def teardown(self):
         self.loop.run_until_complete(self.client.disconnect())
         self.client.protocol = None
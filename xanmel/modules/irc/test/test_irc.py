@@ -1,4 +1,6 @@
-from xanmel.modules.irc import IRCChatUser
+import time
+
+from xanmel.modules.irc import IRCChatUser, FloodController, pack_lines
 from xanmel.modules.irc import actions
 from xanmel.modules.irc import events
 from xanmel.modules.irc.handlers import MentionMessageHandler, PrivateMessageHandler
@@ -129,3 +131,39 @@ def test_chat_user(xanmel, mocker, irc_module):
     assert log[0][1]['target'] == '#xanmel'
     assert log[1][1]['target'] == 'marryshelly'
     assert log[0][1]['message'] == log[1][1]['message'] == 'HELLO'
+
+
+def test_pack_lines():
+    assert pack_lines(['a', 'bb', 'ccc'], 8) == ['a | bb', 'ccc']
+    assert pack_lines(['hello world foo', 'x'], 11) == ['hello world', 'foo | x']
+    assert pack_lines(['\u0444\u0444\u0444'], 5) == ['\u0444\u0444', '\u0444']
+
+
+def test_private_replies(xanmel, irc_module):
+    chat_user = IRCChatUser(irc_module, 'johndoe', irc_user='~johndoe@127.0.0.1')
+    messages = ['%s: %s' % (i, 'x' * 100) for i in range(10)]
+    xanmel.loop.run_until_complete(chat_user.private_replies(messages))
+    assert irc_module.message_queue.qsize() == 1
+    block = irc_module.message_queue.get_nowait()
+    assert len(block) == 4
+    limit = irc_module.line_limit('PRIVMSG', 'johndoe')
+    for cmd, kwargs in block:
+        assert cmd == 'PRIVMSG'
+        assert kwargs['target'] == 'johndoe'
+        assert len(kwargs['message'].encode('utf8')) <= limit
+    assert ' | '.join(i[1]['message'] for i in block) == ' | '.join(messages)
+
+
+def test_flood_controller(xanmel, mocker, mocked_coro):
+    time_mock = mocker.patch.object(time, 'time')
+    time_mock.return_value = 1000
+    sleep = mocker.patch('asyncio.sleep', new=mocked_coro())
+    flood_controller = FloodController(burst=3, rate=4, period=20)
+    for i in range(3):
+        xanmel.loop.run_until_complete(flood_controller.wait())
+    assert not sleep.called
+    xanmel.loop.run_until_complete(flood_controller.wait())
+    assert sleep.call_args[0][0] == 5
+    time_mock.return_value = 1010
+    xanmel.loop.run_until_complete(flood_controller.wait())
+    assert sleep.call_count == 1
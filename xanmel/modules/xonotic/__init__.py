@@ -1,5 +1,8 @@
 from xanmel import Module
+from xanmel.modules.xonotic.archive import Archiver
 from xanmel.modules.xonotic.chat_commands import XonCommands
+from xanmel.modules.xonotic.players import Player
+from xanmel.modules.xonotic.ratings import MapRatings
 from xanmel.modules.xonotic.rcon import RconServer
 
 
@@ -7,17 +10,110 @@ class XonoticModule(Module):
     def __init__(self, xanmel, config):
         super(XonoticModule, self).__init__(xanmel, config)
         self.servers = []
+        self.raw_cmd_root = None
+        self.event_generators_started = False
+        self.map_ratings = MapRatings(xanmel.db)
+        self.archiver = Archiver(xanmel.db, config['archive']) if config.get('archive') else None
         for server in config['servers']:
             self.servers.append(RconServer(self, server))
 
     def after_load(self):
-        raw_root = self.xanmel.cmd_root.copy()
         for i in self.servers:
-            self.xanmel.cmd_root.register_container(i.command_container, i.config['cmd_prefix'])
-            i.local_cmd_root = raw_root.copy()
-            i.local_cmd_root.register_container(XonCommands(rcon_server=i), '')
+            self.register_container(i.command_container, i.config['cmd_prefix'])
+        self.build_local_cmd_roots()
+
+    def after_reload(self):
+        # Containers of the unloaded and the new modules
+        self.build_local_cmd_roots()
+
+    def build_local_cmd_roots(self):
+        """
+        In-game commands are the commands of all modules except the server containers, plus XonCommands.
+        """
+        self.raw_cmd_root = self.xanmel.cmd_root.copy()
+        for i in self.servers:
+            self.raw_cmd_root.unregister_container(i.command_container)
+        for i in self.servers:
+            self.build_local_cmd_root(i)
+
+    def build_local_cmd_root(self, server):
+        old_root = server.local_cmd_root
+        server.local_cmd_root = self.raw_cmd_root.copy()
+        server.local_cmd_root.register_container(XonCommands(rcon_server=server), '')
+        if old_root is not None:
+            server.local_cmd_root.rate_limiters = old_root.rate_limiters
+            server.local_cmd_root.throttling = old_root.throttling
+
+    def register_server_commands(self, server):
+        self.register_container(server.command_container, server.config['cmd_prefix'])
+        self.build_local_cmd_root(server)
+
+    def start_server(self, server):
+        if not server.disabled:
+            server.connect_task = self.loop.create_task(server.connect_forever(connect_log=True))
+
+    def stop_server(self, server):
+        server.stop()
+        if server.command_container in self.command_containers:
+            self.command_containers.remove(server.command_container)
+        self.xanmel.cmd_root.unregister_container(server.command_container)
+
+    async def reload(self, config):
+        """
+        Changes in the server list are applied in place: only added, removed and changed servers are
+        (re)connected, the other ones keep their connections and player state.
+        """
+        if {k: v for k, v in config.items() if k != 'servers'} != \
+                {k: v for k, v in self.config.items() if k != 'servers'}:
+            return None
+        changes = []
+        old_servers = {i.config['unique_id']: i for i in self.servers}
+        servers = []
+        for server_config in config['servers']:
+            server = old_servers.pop(server_config['unique_id'], None)
+            if server is not None and server.config == server_config:
+                servers.append(server)
+                continue
+            if server is not None:
+                self.stop_server(server)
+                changes.append('reloaded server %s' % server_config['name'])
+            else:
+                changes.append('added server %s' % server_config['name'])
+            server = RconServer(self, server_config)
+            servers.append(server)
+            self.register_server_commands(server)
+            if self.event_generators_started:
+                self.start_server(server)
+        for server in old_servers.values():
+            self.stop_server(server)
+            changes.append('removed server %s' % server.config['name'])
+        self.servers = servers
+        return changes
+
+    async def stop(self):
+        await super().stop()
+        for i in self.servers:
+            i.stop()
+
+    def resolve_journal_ref(self, kind, *args):
+        if kind not in ('server', 'player'):
+            return super().resolve_journal_ref(kind, *args)
+        server_id, *args = args
+        server = [i for i in self.servers if i.config['unique_id'] == server_id][0]
+        if kind == 'server':
+            return server
+        nickname, number1, number2, ip_address = args
+        player = server.players.players_by_number1.get(number1)
+        if player is None or player.number2 != number2:
+            # Replayed players are registered as if they joined, so later events refer to the same object
+            player = Player(server, nickname, number1, number2, ip_address)
+            server.players.join(player)
+        return player
 
     def setup_event_generators(self):
+        self.event_generators_started = True
         for i in self.servers:
-            if not i.disabled:
-                self.loop.create_task(i.connect_forever(connect_log=True))
+            self.start_server(i)
+        # With sharding only the first worker archives
+        if self.archiver is not None and self.xanmel.db.is_up and getattr(self.xanmel.ipc, 'shard', 0) == 0:
+            self.tasks.append(self.loop.create_task(self.archiver.run_forever()))
@@ -0,0 +1,96 @@
+"""
+Rolling archive of the append-only tables.
+
+map_rating, called_vote and player_identification only grow, so rows older than a configured age are moved to the
+*_archive tables with the same columns and ids. The bot only looks at the recent rows; statistics over the whole
+history read both tables, see history(). Configured in the archive section of the XonoticModule config::
+
+    archive:
+      after_days: 180
+      interval: 3600
+      batch_size: 1000
+
+Every interval seconds the old rows are moved in batches of batch_size rows, each batch in its own transaction.
+"""
+import asyncio
+import datetime
+import logging
+
+from xanmel import current_time
+from xanmel.modules.xonotic.models import CalledVote, CalledVoteArchive, MapRating, MapRatingArchive, \
+    PlayerIdentification, PlayerIdentificationArchive
+
+logger = logging.getLogger(__name__)
+
+# (table, archive table, the field compared with the cutoff)
+ARCHIVES = (
+    (MapRating, MapRatingArchive, MapRating.timestamp),
+    (CalledVote, CalledVoteArchive, CalledVote.timestamp),
+    (PlayerIdentification, PlayerIdentificationArchive, PlayerIdentification.last_seen),
+)
+
+ARCHIVE_MODELS = {model: archive_model for model, archive_model, _ in ARCHIVES}
+
+
+def history(model, query_for):
+    """
+    UNION ALL of query_for(model) and query_for(archive model), for queries over the archived rows as well.
+    """
+    return query_for(model).union_all(query_for(ARCHIVE_MODELS[model]))
+
+
+async def archive_batch(mgr, model, archive_model, field, cutoff, batch_size):
+    """
+    Move up to batch_size rows with field older than cutoff to archive_model. Returns the number of moved rows.
+    """
+    query = model.select(model.id).where(field < cutoff).order_by(model.id).limit(batch_size)
+    if mgr.database.for_update:
+        # player_identification rows may be upserted meanwhile, the upsert waits and inserts a new row
+        query = query.for_update()
+    async with mgr.atomic():
+        ids = [i.id for i in await mgr.execute(query)]
+        if not ids:
+            return 0
+        fields = model._meta.sorted_fields
+        await mgr.execute(archive_model.insert_from(
+            model.select(*fields).where(model.id.in_(ids)),
+            [archive_model._meta.fields[i.name] for i in fields]))
+        await mgr.execute(model.delete().where(model.id.in_(ids)))
+    return len(ids)
+
+
+class Archiver:
+    def __init__(self, db, config):
+        self.db = db
+        self.after = datetime.timedelta(days=config.get('after_days', 180))
+        self.interval = config.get('interval', 3600)
+        self.batch_size = config.get('batch_size', 1000)
+        # table name -> rows moved since the start
+        self.archived = {model._meta.table_name: 0 for model, _, _ in ARCHIVES}
+
+    async def run(self):
+        """
+        Move all rows older than the configured age. Returns the number of moved rows per table.
+        """
+        cutoff = current_time() - self.after
+        moved = {}
+        for model, archive_model, field in ARCHIVES:
+            table = model._meta.table_name
+            moved[table] = 0
+            while True:
+                count = await archive_batch(self.db.mgr, model, archive_model, field, cutoff, self.batch_size)
+                moved[table] += count
+                self.archived[table] += count
+                if count < self.batch_size:
+                    break
+            if moved[table]:
+                logger.info('Archived %s %s rows', moved[table], table)
+        return moved
+
+    async def run_forever(self):
+        while True:
+            try:
+                await self.run()
+            except Exception:
+                logger.exception('Could not archive old rows')
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,144 @@
+"""
+Throughput benchmark for the rcon log and command parsers.
+
+Raw captures (see the raw_log and raw_cmd_log server options) are fed to the parsers of a server in datagram sized
+chunks. Events fired by the parsers go through the event bus to the registered handlers. xanmel bench-log runs it
+with the database off (see xanmel.cli.offline_xanmel). The server connection and the IRC client are replaced by
+stubs which discard everything sent to them.
+"""
+import time
+from collections import Counter, OrderedDict
+
+from xanmel.bus import event_type_name
+
+
+class ParserStats:
+    def __init__(self):
+        self.calls = Counter()
+        self.matched = Counter()
+        self.time = Counter()
+
+    def wrap(self, parser_class):
+        stats = self
+        name = parser_class.__name__
+
+        def parse(self, lines):
+            before = len(lines)
+            started = time.perf_counter()
+            rest = super(timed_class, self).parse(lines)
+            stats.time[name] += time.perf_counter() - started
+            stats.calls[name] += 1
+            if len(rest) != before or self.started:
+                stats.matched[name] += 1
+            return rest
+
+        timed_class = type(name, (parser_class,), {'parse': parse})
+        return timed_class
+
+    def instrument(self, combined_parser):
+        combined_parser.parsers = [self.wrap(i) for i in combined_parser.parsers]
+
+
+def stub_server(server):
+    async def discard(*args, **kwargs):
+        return None
+
+    server.send = lambda command: None
+    server.prvm_edictget = discard
+    server.execute = discard
+    server.execute_with_retry = discard
+    server.update_server_stats = discard
+    server.raw_log = None
+
+
+def stub_irc(xanmel):
+    for module in xanmel.modules.values():
+        if hasattr(module, 'message_queue'):
+            module.send = lambda command, **kwargs: None
+            module.send_block = lambda command, target, messages: None
+
+
+def read_chunks(path, chunk_size):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)], data.count(b'\n')
+
+
+async def feed(xanmel, parser, chunks):
+    feed_time = handler_time = 0
+    for chunk in chunks:
+        started = time.perf_counter()
+        parser.feed(chunk)
+        feed_time += time.perf_counter() - started
+        started = time.perf_counter()
+        await xanmel.bus.join()
+        handler_time += time.perf_counter() - started
+    return feed_time, handler_time
+
+
+async def benchmark(xanmel, server, log_path=None, cmd_path=None, chunk_size=1400, repeat=1):
+    """
+    Returns an ordered dict with the benchmark results.
+    """
+    stub_server(server)
+    stub_irc(xanmel)
+    events = Counter()
+    publish_nowait = xanmel.bus.publish_nowait
+
+    def count_events(event):
+        events[event_type_name(type(event))] += 1
+        publish_nowait(event)
+
+    xanmel.bus.publish_nowait = count_events
+    parser_stats = ParserStats()
+    result = OrderedDict([('lines', 0), ('feed_time', 0), ('handler_time', 0)])
+    for path, parser in [(log_path, server.log_parser), (cmd_path, server.cmd_parser)]:
+        if not path:
+            continue
+        parser_stats.instrument(parser)
+        chunks, lines = read_chunks(path, chunk_size)
+        for _ in range(repeat):
+            feed_time, handler_time = await feed(xanmel, parser, chunks)
+            result['lines'] += lines
+            result['feed_time'] += feed_time
+            result['handler_time'] += handler_time
+    xanmel.bus.publish_nowait = publish_nowait
+    total_time = result['feed_time'] + result['handler_time']
+    result['events'] = sum(events.values())
+    result['lines_per_second'] = result['lines'] / total_time if total_time else 0
+    result['events_per_second'] = result['events'] / total_time if total_time else 0
+    result['parsers'] = OrderedDict([
+        (name, OrderedDict([('calls', parser_stats.calls[name]),
+                            ('matched', parser_stats.matched[name]),
+                            ('time', parser_stats.time[name])]))
+        for name, _ in parser_stats.time.most_common()
+    ])
+    result['event_types'] = OrderedDict(events.most_common())
+    return result
+
+
+def print_report(result):
+    print('Lines: %s, events: %s' % (result['lines'], result['events']))
+    print('Parsing: %.3f s, handlers: %.3f s' % (result['feed_time'], result['handler_time']))
+    print('%.1f lines/s, %.1f events/s' % (result['lines_per_second'], result['events_per_second']))
+    print()
+    print('%-32s %10s %10s %10s' % ('Parser', 'Calls', 'Matched', 'Time, ms'))
+    for name, stats in result['parsers'].items():
+        print('%-32s %10s %10s %10.1f' % (name, stats['calls'], stats['matched'], stats['time'] * 1000))
+    print()
+    for name, count in result['event_types'].items():
+        print('%-60s %10s' % (name, count))
+
+
+def run(xanmel, server_name, log_path, cmd_path, chunk_size, repeat):
+    module = xanmel.modules['xanmel.modules.xonotic.XonoticModule']
+    if server_name is None:
+        server = module.servers[0]
+    else:
+        servers = [i for i in module.servers if i.config['name'] == server_name]
+        if not servers:
+            raise ValueError('No server named %s' % server_name)
+        server = servers[0]
+    result = xanmel.loop.run_until_complete(benchmark(xanmel, server, log_path, cmd_path, chunk_size, repeat))
+    print_report(result)
+    return result
@@ -0,0 +1,121 @@
+"""
+Insert and lookup benchmark of the player_identification indexes.
+
+The same random rows are written into two scratch copies of the table. The first one has the indexes from before
+the 0001_player_identification_indexes migration and gets a new row for every join. The second one has the current
+indexes and is upserted in batches like the write-behind queue does it. Then the rows of random keys, IP addresses
+and nicknames are looked up the way the web interface does it, most recent first. Inserts per second count the
+joins written, not the table rows.
+"""
+import datetime
+import random
+import time
+from collections import OrderedDict
+
+from .migrations import OLD_IDENTIFICATION_INDEXES
+from .models import PlayerIdentification
+
+LOOKUPS = ('crypto_idfp', 'ip_address', 'nickname')
+
+
+def scratch_model(name, old_indexes):
+    class Meta:
+        db_table = name
+        indexes = () if old_indexes else PlayerIdentification._meta.indexes
+
+    model = type(name, (PlayerIdentification,), {'Meta': Meta, '__module__': __name__})
+    if old_indexes:
+        for column in OLD_IDENTIFICATION_INDEXES:
+            model._meta.columns[column].index = True
+        model._meta.columns['key_hash'].unique = False
+    return model
+
+
+def random_rows(count, seed):
+    """
+    Joins of count // 20 players, each from a few IP addresses of its network.
+    """
+    rnd = random.Random(seed)
+    players = max(count // 20, 1)
+    started = datetime.datetime(2020, 1, 1)
+    rows = []
+    for i in range(count):
+        player = rnd.randrange(players)
+        seen = started + datetime.timedelta(seconds=i)
+        rows.append({
+            'crypto_idfp': 'key%s' % player if player % 4 else None,
+            'ip_address': '10.%s.%s.%s' % (player % 256, player // 256 % 256, rnd.randrange(4)),
+            'raw_nickname': '^1player%s' % player,
+            'nickname': 'player%s' % player,
+            'first_seen': seen,
+            'last_seen': seen,
+            'seen_count': 1,
+            'country': ['DE', 'RU', 'US', 'FR', 'BR'][player % 5],
+            'city': 'city%s' % (player % 500),
+            'subdivisions': 'region%s' % (player % 50),
+            'continent': ['Europe', 'North America', 'South America'][player % 3],
+            'latitude': player % 180 - 90.0,
+            'longitude': player % 360 - 180.0,
+            'asn': str(player % 1000),
+            'asn_cidr': '10.%s.0.0/16' % (player % 256),
+            'asn_country_code': 'DE',
+            'network_name': 'net%s' % (player % 1000),
+            'network_cidr': '10.%s.0.0/16' % (player % 256),
+            'network_country_code': 'DE',
+        })
+        rows[-1]['key_hash'] = PlayerIdentification.key_hash_for(rows[-1])
+    return rows
+
+
+def write_batch(model, rows, upsert):
+    if not upsert:
+        model.insert_many(rows).execute()
+        return
+    merged = OrderedDict()
+    for row in rows:
+        old = merged.get(row['key_hash'])
+        merged[row['key_hash']] = model.merge(old, row) if old else row
+    model.upsert(list(merged.values())).execute()
+
+
+def run_one(model, rows, batch_size, lookups, seed, upsert):
+    result = OrderedDict()
+    model.create_table()
+    try:
+        started = time.perf_counter()
+        for start in range(0, len(rows), batch_size):
+            with model._meta.database.atomic():
+                write_batch(model, rows[start:start + batch_size], upsert)
+        elapsed = time.perf_counter() - started
+        result['rows'] = model.select().count()
+        result['inserts_per_second'] = len(rows) / elapsed if elapsed else 0
+        rnd = random.Random(seed)
+        for column in LOOKUPS:
+            field = model._meta.columns[column]
+            values = [rnd.choice(rows)[column] for _ in range(lookups)]
+            started = time.perf_counter()
+            for value in values:
+                list(model.select().where(field == value).order_by(model.last_seen.desc()).limit(10))
+            result['%s_lookup_ms' % column] = (time.perf_counter() - started) / lookups * 1000
+    finally:
+        model.drop_table()
+    return result
+
+
+def benchmark(rows=20000, batch_size=500, lookups=500, seed=0):
+    """
+    Returns {'before': results, 'after': results} for the old and the current indexes.
+    """
+    data = random_rows(rows, seed)
+    before = scratch_model('bench_identification_before', True)
+    after = scratch_model('bench_identification_after', False)
+    return OrderedDict([
+        ('before', run_one(before, data, batch_size, lookups, seed, False)),
+        ('after', run_one(after, data, batch_size, lookups, seed, True)),
+    ])
+
+
+def print_report(result):
+    print('%-24s %14s %14s' % ('', 'Before', 'After'))
+    for key in result['before']:
+        print('%-24s %14.3f %14.3f' % (key, result['before'][key], result['after'][key]))
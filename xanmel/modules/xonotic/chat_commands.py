@@ -9,6 +9,7 @@ from xanmel.modules.xonotic.cointoss import CointosserState, CointosserException
 
 from .colors import Color
 from .events import PlayerRatedMap
+from .ratings import format_rating
 
 logger = logging.getLogger(__name__)
 
@@ -142,6 +143,30 @@ class Maps(ChatCommand):
         await user.reply(rcon_server.config['out_prefix'] + reply, is_private)
 
 
+class MapRatingCommand(ChatCommand):
+    prefix = 'maprating'
+    parent = XonCommands
+    help_args = '[MAPNAME]'
+    help_text = 'Shows the rating of the current map or MAPNAME'
+
+    async def run(self, user, message, is_private=True, root=None):
+        rcon_server = self.parent.properties['rcon_server']
+        map_name = message.strip().split(' ')[0] or rcon_server.status.get('map')
+        if not rcon_server.db.is_up or rcon_server.server_db_obj is None or not map_name:
+            reply = 'Map ratings are not available'
+        else:
+            rating = await rcon_server.module.map_ratings.get_by_name(rcon_server.server_db_obj, map_name)
+            if rating is None:
+                reply = 'Map %s has never been played on this server' % map_name
+            else:
+                reply = format_rating(map_name, *rating)
+                if user.user_type == 'irc':
+                    reply = Color.dp_to_irc(reply.encode('utf8')).decode('utf8')
+        if user.user_type == 'irc':
+            reply = rcon_server.config['out_prefix'] + reply
+        await user.reply(reply, is_private)
+
+
 class Bet(ChatCommand):
     prefix = 'bet'
     parent = XonCommands
@@ -58,6 +58,9 @@ class NewPlayerActive(Event):
     def __str__(self):
         return '%s new player active' % self.properties['server'].config['out_prefix']
 
+    def coalesce_key(self):
+        return self.properties['server']
+
 
 class MapChange(Event):
     log = False
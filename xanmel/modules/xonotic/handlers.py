@@ -4,14 +4,14 @@ import time
 import uuid
 
 from decimal import Decimal
-from peewee import fn
 
 import xanmel.modules.irc.events as irc_events
 from xanmel import Handler
 from xanmel import current_time
 from xanmel.modules.irc.actions import ChannelMessage, ChannelMessages
 from xanmel.modules.xonotic.cointoss import CointosserState
-from xanmel.modules.xonotic.models import CalledVote, MapRating, Map, AccountTransaction, PlayerAccount, CTSRecord, AnonCTSRecord
+from xanmel.modules.xonotic.models import CalledVote, Map, AccountTransaction, PlayerAccount, CTSRecord, AnonCTSRecord
+from xanmel.modules.xonotic.ratings import format_rating
 from .chat_user import XonoticChatUser
 from .events import *
 from .rcon_log import GAME_TYPES
@@ -108,23 +108,10 @@ class RatingReportHandler(Handler):
         db = server.module.xanmel.db
         if not db.is_up:
             return
-        await asyncio.sleep(10)
-        map, _ = await db.mgr.get_or_create(Map, server=server.server_db_obj, name=map_name)
-        result = await db.mgr.execute(
-            MapRating.select(fn.Sum(MapRating.vote).alias('rating'),
-                             fn.Count(MapRating.id).alias('total')).where(MapRating.map == map))
-        total_votes = result[0].total
-        rating = result[0].rating
-        if total_votes == 0 or rating is None:
-            message = '^3%(map_name)s ^7has not yet been rated - Use ^7/^2+++^7,^2++^7,^2+^7,^1-^7,^1--^7,^1--- ^7to rate the map.'
-        else:
-            if rating >= 0:
-                message = '^3%(map_name)s ^7has ^2%(rating)s ^7points. ^5[%(total_votes)s votes]^7 - Use ^7/^2+++^7,^2++^7,^2+^7,^1-^7,^1--^7,^1--- ^7to rate the map.'
-            else:
-                message = '^3%(map_name)s ^7has ^1%(rating)s ^7points. ^5[%(total_votes)s votes]^7 - Use ^7/^2+++^7,^2++^7,^2+^7,^1-^7,^1--^7,^1--- ^7to rate the map.'
-        msg_args = {'map_name': map_name, 'rating': rating, 'total_votes': total_votes}
-        in_game_message = message % msg_args
-        server.say(in_game_message)
+        async with server.map_voter.lock:
+            map, _ = await db.get_or_create(Map, server=server.server_db_obj, name=map_name)
+            rating, total_votes = await server.module.map_ratings.get(map)
+        server.say(format_rating(map_name, rating, total_votes))
 
 
 class PlayerRatedMapHandler(Handler):
@@ -268,6 +255,7 @@ class NewDuelHandler(Handler):
 
 class DuelFailureHandler(Handler):
     events = [DuelEndedPrematurely]
+    synchronous = True
 
     async def handle(self, event):
         server = event.properties['server']
@@ -321,14 +309,16 @@ class DuelSuccessHandler(Handler):
                 message = '%s ^1lost %.2f!^7' % (player.nickname.decode('utf8'), -change)
             change = Decimal("%.2f" % change)
             server.say(message)
-            account = await server.db.mgr.get(PlayerAccount, player=player.player_db_obj)
-            await server.db.mgr.create(AccountTransaction, account=account, change=change,
-                                       description='Betting: %s vs %s' % (
-                                           Color.dp_to_none(ordering[0].nickname).decode('utf8'),
-                                           Color.dp_to_none(ordering[1].nickname).decode('utf8')
-                                       ))
-            account.balance += change
-            await server.db.mgr.update(account)
+            # The ledger row is written in the same transaction as the balance, not behind
+            async with server.db.mgr.atomic():
+                account = await server.db.mgr.get(PlayerAccount, player=player.player_db_obj)
+                await server.db.mgr.create(AccountTransaction, account=account, change=change,
+                                           description='Betting: %s vs %s' % (
+                                               Color.dp_to_none(ordering[0].nickname).decode('utf8'),
+                                               Color.dp_to_none(ordering[1].nickname).decode('utf8')
+                                           ))
+                account.balance += change
+                await server.db.mgr.update(account)
 
         server.betting_odds = None
         server.betting_session = None
@@ -515,6 +505,7 @@ class GameEndedHandler(Handler):
 
 class IRCMessageHandler(Handler):
     events = [irc_events.ChannelMessage]
+    synchronous = True
 
     async def handle(self, event):
         irc_nick = Color.irc_to_none(event.properties['nick'].encode('utf8')).decode('utf8')
@@ -546,9 +537,9 @@ class VoteAcceptedHandler(Handler):
         if not db.is_up:
             return
         ts = current_time()
-        cur_map, _ = await db.mgr.get_or_create(Map, server=server.server_db_obj, name=server.status.get('map'))
+        cur_map, _ = await db.get_or_create(Map, server=server.server_db_obj, name=server.status.get('map'))
         if 'map_name' in vote:
-            next_map, _ = await db.mgr.get_or_create(Map, server=server.server_db_obj, name=vote['map_name'])
+            next_map, _ = await db.get_or_create(Map, server=server.server_db_obj, name=vote['map_name'])
         else:
             next_map = None
         if vote['player'].player_db_obj:
@@ -566,25 +557,26 @@ class VoteAcceptedHandler(Handler):
                 'vote_type': 'endmatch',
                 'time_since_round_start': time_from_start
             })
-            await db.mgr.create(CalledVote, **vote_data)
+            db.insert(CalledVote, **vote_data)
         if vote['type'] in ('gotomap', 'nextmap'):
             vote_data.update({
                 'map': next_map,
                 'vote_type': 'gotomap',
                 'time_since_round_start': 0
             })
-            await db.mgr.create(CalledVote, **vote_data)
+            db.insert(CalledVote, **vote_data)
         if vote['type'] == 'restart' and server.status.get('map'):
             vote_data.update({
                 'map': next_map,
                 'vote_type': 'restart',
                 'time_since_round_start': time_from_start
             })
-            await db.mgr.create(CalledVote, **vote_data)
+            db.insert(CalledVote, **vote_data)
 
 
 class CointossNotificationHandler(Handler):
     events = [DuelPairFormed]
+    synchronous = True
 
     async def handle(self, event):
         server = event.properties['server']
@@ -629,6 +621,7 @@ class CointossGameComplete(Handler):
 
 class CointossGameStarted(Handler):
     events = [GameStarted]
+    synchronous = True
 
     async def handle(self, event):
         server = event.properties['server']
@@ -650,8 +643,8 @@ class RecordSetHandlerSaveToDB(Handler):
         db = server.module.xanmel.db
         if not db.is_up:
             return
-        map, _ = await db.mgr.get_or_create(Map, server=server.server_db_obj, name=map_name)
-        await db.mgr.create(
+        map, _ = await db.get_or_create(Map, server=server.server_db_obj, name=map_name)
+        db.insert(
             CTSRecord,
             server=server.server_db_obj,
             map=map,
@@ -674,7 +667,7 @@ class BackupAnonRecordSetHandler(Handler):
         db = server.module.xanmel.db
         if not db.is_up:
             return
-        await db.mgr.create(
+        db.insert(
             AnonCTSRecord,
             server=server.server_db_obj,
             nickname=nickname.decode('utf8'),
@@ -0,0 +1,136 @@
+"""
+XDF ladders computed from the time records with NumPy.
+
+A ladder is a snapshot (XDFLadder) of the players ordered by points (XDFLadderPosition). Only the best record of a
+player on each map counts. With the classic algorithm a record ranked ``rank`` among ``n`` records of its map is
+worth ``100 * (n - rank + 1) / n`` points, so the first place always gets 100 points and the last one 100 / n.
+
+The records of a ladder are loaded into arrays once and everything else, including the per map ranking, is done
+with array operations.
+"""
+import time
+
+import numpy as np
+
+from xanmel import current_time
+from xanmel.modules.xonotic.models import LadderAlgo, LadderType, XDFLadder, XDFLadderPosition, XDFServer, \
+    XDFTimeRecord
+
+# Positions inserted with one statement
+BATCH_SIZE = 1000
+
+
+def best_records(map_codes, player_codes, times, ids):
+    """
+    Keep the best record of each player on each map. Returns the (map, player) arrays sorted by map and time.
+    """
+    order = np.lexsort((ids, times, player_codes, map_codes))
+    map_codes, player_codes, times, ids = map_codes[order], player_codes[order], times[order], ids[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (map_codes[1:] != map_codes[:-1]) | (player_codes[1:] != player_codes[:-1])
+    map_codes, player_codes, times, ids = map_codes[first], player_codes[first], times[first], ids[first]
+    order = np.lexsort((ids, times, map_codes))
+    return map_codes[order], player_codes[order]
+
+
+def map_ranks(map_codes):
+    """
+    Rank of each record within its map and the number of records on the map, for records sorted by map.
+    """
+    if not len(map_codes):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, map_codes[1:] != map_codes[:-1]])
+    sizes = np.diff(np.r_[starts, len(map_codes)])
+    group = np.repeat(np.arange(len(starts)), sizes)
+    return np.arange(len(map_codes)) - starts[group] + 1, sizes[group]
+
+
+def compute_classic(map_codes, player_codes, times, ids, players):
+    """
+    Points, number of maps and number of first places of each of the players (indexes of player_codes).
+    """
+    map_codes, player_codes = best_records(map_codes, player_codes, times, ids)
+    rank, size = map_ranks(map_codes)
+    points = 100.0 * (size - rank + 1) / size
+    return (np.round(np.bincount(player_codes, weights=points, minlength=players), 5),
+            np.bincount(player_codes, minlength=players),
+            np.bincount(player_codes[rank == 1], minlength=players))
+
+
+def positions(points):
+    """
+    1-based positions of the players by points, players with equal points share a position.
+    """
+    order = np.argsort(-points, kind='stable')
+    ordered = -points[order]
+    return order, np.searchsorted(ordered, ordered, side='left') + 1
+
+
+def record_query(ladder_type, server=None, physics=None):
+    query = XDFTimeRecord.select(XDFTimeRecord.id, XDFTimeRecord.map, XDFTimeRecord.player, XDFTimeRecord.time)
+    if ladder_type == LadderType.SERVER:
+        query = query.where(XDFTimeRecord.server == server)
+    elif ladder_type == LadderType.PHYSICS:
+        query = query.join(XDFServer).where(XDFServer.physics == physics)
+    return query.tuples()
+
+
+def load_records(query):
+    """
+    Arrays of map codes, player codes, times and record ids, and the player ids indexed by the player codes.
+    """
+    rows = list(query)
+    if not rows:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0), empty, empty
+    ids, maps, players, times = zip(*rows)
+    _, map_codes = np.unique(np.array(maps, dtype=object).astype(str), return_inverse=True)
+    player_ids, player_codes = np.unique(np.array(players, dtype=np.int64), return_inverse=True)
+    return map_codes, player_codes, np.array(times, dtype=float), np.array(ids, dtype=np.int64), player_ids
+
+
+def build_ladder(ladder_type, server=None, physics=None, algo=LadderAlgo.CLASSIC):
+    """
+    Compute a ladder and store it as a new XDFLadder snapshot.
+    """
+    map_codes, player_codes, times, ids, player_ids = load_records(record_query(ladder_type, server, physics))
+    points, maps, first_places = compute_classic(map_codes, player_codes, times, ids, len(player_ids))
+    order, position = positions(points)
+    with XDFLadder._meta.database.atomic():
+        ladder = XDFLadder.create(timestamp=current_time(), algo=algo.value, type=ladder_type.value, server=server,
+                                  physics=physics, max_position=int(position[-1]) if len(position) else None)
+        rows = [{'ladder': ladder.id, 'player': int(player_ids[i]), 'points': float(points[i]), 'position': int(pos),
+                 'data': {'maps': int(maps[i]), 'first_places': int(first_places[i])}}
+                for i, pos in zip(order, position)]
+        for start in range(0, len(rows), BATCH_SIZE):
+            XDFLadderPosition.insert_many(rows[start:start + BATCH_SIZE]).execute()
+    return ladder
+
+
+def build_all():
+    """
+    Build the global ladder and the ladders of every physics and server.
+    """
+    ladders = [build_ladder(LadderType.GLOBAL)]
+    for i in XDFServer.get_physics_list():
+        ladders.append(build_ladder(LadderType.PHYSICS, physics=i.physics))
+    for i in XDFServer.select():
+        ladders.append(build_ladder(LadderType.SERVER, server=i))
+    return ladders
+
+
+def benchmark(records=500000, players=5000, maps=2000, seed=0):
+    """
+    Time compute_classic on random records.
+    """
+    rng = np.random.default_rng(seed)
+    map_codes = rng.integers(0, maps, records)
+    player_codes = rng.integers(0, players, records)
+    times = rng.uniform(1, 600, records)
+    ids = np.arange(records)
+    started = time.perf_counter()
+    points, _, _ = compute_classic(map_codes, player_codes, times, ids, players)
+    positions(points)
+    elapsed = time.perf_counter() - started
+    return {'records': records, 'players': players, 'maps': maps, 'seconds': elapsed,
+            'records_per_second': records / elapsed if elapsed else 0}
@@ -0,0 +1,115 @@
+"""
+Read side of the XDF time records for leaderboards.
+
+Rows are plain tuples of LEADERBOARD_COLUMNS rather than model instances. Large result sets are streamed in pages
+ordered by (map, position, id), each page continuing after the last row of the previous one, so only one page is in
+memory at a time no matter how many records a server has. The positions must be computed (see
+XDFTimeRecord.update_server_pos and update_global_pos), records without a position are left out.
+
+TopRecords keeps the first rows of each map's leaderboard. add_record() inserts a new record, updates the positions
+and drops the cached leaderboards of its map. There is no shared instance: whoever serves the leaderboards owns a
+TopRecords and must insert the records through its add_record(), otherwise its cached leaderboards go stale.
+"""
+from collections import OrderedDict
+
+from xanmel.modules.xonotic.models import XDFTimeRecord
+
+LEADERBOARD_COLUMNS = (XDFTimeRecord.id, XDFTimeRecord.map, XDFTimeRecord.player, XDFTimeRecord.server,
+                       XDFTimeRecord.server_pos, XDFTimeRecord.global_pos, XDFTimeRecord.time,
+                       XDFTimeRecord.timestamp)
+
+# Index of the position column in the rows for server and global leaderboards
+SERVER_POS = 4
+GLOBAL_POS = 5
+
+
+def position_field(server):
+    return XDFTimeRecord.server_pos if server is not None else XDFTimeRecord.global_pos
+
+
+def leaderboard_query(server=None, maps=None):
+    # NULL positions would break the keyset comparisons of page() and stream()
+    query = XDFTimeRecord.select(*LEADERBOARD_COLUMNS).where(position_field(server).is_null(False))
+    if server is not None:
+        query = query.where(XDFTimeRecord.server == server)
+    if maps is not None:
+        query = query.where(XDFTimeRecord.map.in_(maps))
+    return query
+
+
+def page(map_name, server=None, after=None, limit=50):
+    """
+    Rows of one map's leaderboard following the row ``after`` (the first page when it's None).
+    """
+    pos_field = position_field(server)
+    query = leaderboard_query(server).where(XDFTimeRecord.map == map_name)
+    if after is not None:
+        pos = after[SERVER_POS if server is not None else GLOBAL_POS]
+        query = query.where((pos_field > pos) | ((pos_field == pos) & (XDFTimeRecord.id > after[0])))
+    return list(query.order_by(pos_field, XDFTimeRecord.id).limit(limit).tuples())
+
+
+def stream(server=None, maps=None, page_size=1000):
+    """
+    Yield the rows of every map's leaderboard ordered by map and position.
+    """
+    pos_field = position_field(server)
+    pos_index = SERVER_POS if server is not None else GLOBAL_POS
+    after = None
+    while True:
+        query = leaderboard_query(server, maps)
+        if after is not None:
+            map_name, pos, record_id = after[1], after[pos_index], after[0]
+            query = query.where((XDFTimeRecord.map > map_name) |
+                                ((XDFTimeRecord.map == map_name) &
+                                 ((pos_field > pos) | ((pos_field == pos) & (XDFTimeRecord.id > record_id)))))
+        rows = list(query.order_by(XDFTimeRecord.map, pos_field, XDFTimeRecord.id).limit(page_size).tuples())
+        yield from rows
+        if len(rows) < page_size:
+            return
+        after = rows[-1]
+
+
+class TopRecords:
+    """
+    LRU cache of the first ``limit`` rows of the leaderboards, keyed by (server id or None, map).
+    """
+
+    def __init__(self, limit=10, size=1000):
+        self.limit = limit
+        self.size = size
+        self.boards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(map_name, server):
+        return getattr(server, 'id', server), map_name
+
+    def get(self, map_name, server=None):
+        key = self.key(map_name, server)
+        rows = self.boards.get(key)
+        if rows is not None:
+            self.hits += 1
+            self.boards.move_to_end(key)
+            return rows
+        self.misses += 1
+        rows = tuple(page(map_name, server, limit=self.limit))
+        self.boards[key] = rows
+        if len(self.boards) > self.size:
+            self.boards.popitem(last=False)
+        return rows
+
+    def invalidate(self, map_name):
+        for key in [i for i in self.boards if i[1] == map_name]:
+            del self.boards[key]
+
+    def add_record(self, **fields):
+        """
+        Create an XDFTimeRecord, place it with XDFTimeRecord.update_record_pos and drop the stale leaderboards.
+        """
+        fields.setdefault('server_pos', 0)
+        with XDFTimeRecord._meta.database.atomic():
+            record = XDFTimeRecord.update_record_pos(XDFTimeRecord.create(**fields))
+        self.invalidate(record.map)
+        return record
@@ -0,0 +1,79 @@
+from peewee import Case, CharField, DateTimeField, IntegerField, fn
+from playhouse.migrate import SchemaMigrator, migrate
+
+from xanmel.migrations import drop_indexes, has_column
+
+from .models import IdentificationKey, PlayerIdentification
+
+# Single column indexes of playeridentification before 0001_player_identification_indexes
+OLD_IDENTIFICATION_INDEXES = ('crypto_idfp', 'stats_id', 'ip_address', 'nickname', 'country', 'city', 'subdivisions',
+                              'continent', 'latitude', 'longitude', 'asn', 'asn_cidr', 'asn_country_code',
+                              'network_name', 'network_cidr', 'network_country_code')
+
+IDENTIFICATION_LOOKUPS = ('crypto_idfp', 'ip_address', 'nickname')
+
+# Key hashes set with one statement
+UPDATE_BATCH = 1000
+
+
+def player_identification_indexes(database):
+    table = PlayerIdentification._meta.table_name
+    if not has_column(database, table, 'timestamp'):
+        return
+    drop_indexes(database, table, OLD_IDENTIFICATION_INDEXES)
+    for column in IDENTIFICATION_LOOKUPS:
+        database.execute_sql('CREATE INDEX IF NOT EXISTS %s_%s_timestamp ON %s (%s, timestamp)' % (
+            table, column, table, column))
+
+
+def compact_player_identification(database):
+    """
+    Merge the rows with the same IdentificationKey into the most recent one, which gets the first and last
+    timestamps and the number of merged rows. The merge is done by two set based statements, only the key hashes
+    are computed in Python, a batch of rows at a time.
+    """
+    table = PlayerIdentification._meta.table_name
+    if not has_column(database, table, 'timestamp'):
+        return
+    migrator = SchemaMigrator.from_database(database)
+    migrate(
+        migrator.rename_column(table, 'timestamp', 'first_seen'),
+        migrator.add_column(table, 'last_seen', DateTimeField(null=True)),
+        migrator.add_column(table, 'seen_count', IntegerField(default=1)),
+        migrator.add_column(table, 'key_hash', CharField(max_length=40, null=True)),
+    )
+    model = PlayerIdentification
+    key_fields = [getattr(model, i) for i in IdentificationKey.fields]
+    keys = (model.select(fn.max(model.id).alias('id'), fn.min(model.first_seen).alias('first_seen'),
+                         fn.max(model.first_seen).alias('last_seen'), fn.count(model.id).alias('seen_count'))
+            .group_by(*key_fields)
+            .alias('keys'))
+    (model.update(first_seen=keys.c.first_seen, last_seen=keys.c.last_seen, seen_count=keys.c.seen_count)
+     .from_(keys)
+     .where(model.id == keys.c.id)
+     .execute())
+    # Only the kept rows got last_seen
+    model.delete().where(model.last_seen.is_null()).execute()
+    last_id = 0
+    while True:
+        rows = list(model.select(model.id, *key_fields).where(model.id > last_id).order_by(model.id)
+                    .limit(UPDATE_BATCH).tuples())
+        if not rows:
+            break
+        hashes = [(row[0], model.key_hash_for(dict(zip(IdentificationKey.fields, row[1:])))) for row in rows]
+        (model.update(key_hash=Case(model.id, hashes))
+         .where(model.id.between(rows[0][0], rows[-1][0]))
+         .execute())
+        last_id = rows[-1][0]
+    drop_indexes(database, table, ['%s_timestamp' % i for i in IDENTIFICATION_LOOKUPS])
+    migrate(
+        migrator.add_not_null(table, 'last_seen'),
+        migrator.add_not_null(table, 'key_hash'),
+    )
+    model._schema.create_indexes(safe=True)
+
+
+MIGRATIONS = [
+    ('0001_player_identification_indexes', player_identification_indexes),
+    ('0002_compact_player_identification', compact_player_identification),
+]
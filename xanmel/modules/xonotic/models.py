@@ -1,6 +1,9 @@
+import hashlib
 import http.client
 import json
+import operator
 from collections import defaultdict
+from functools import reduce
 from urllib.parse import quote
 
 from echoices.enums import EChoice
@@ -23,6 +26,29 @@ class Player(BaseModel):
     raw_nickname = CharField()
     nickname = CharField()
 
+    @classmethod
+    def resolve_query(cls, crypto_idfp, stats_id):
+        """
+        Query for the player with the crypto_idfp or the stats id, with the id and balance of its account as the
+        account_id and account_balance attributes (None if it has no account). A match by stats id is preferred.
+        Returns None if both are None.
+        """
+        conditions = []
+        order_by = []
+        if crypto_idfp:
+            conditions.append(cls.crypto_idfp == crypto_idfp)
+        if stats_id is not None:
+            conditions.append(cls.stats_id == stats_id)
+            order_by.append(Case(None, [(cls.stats_id == stats_id, 0)], 1))
+        if not conditions:
+            return None
+        return (cls.select(cls, PlayerAccount.id.alias('account_id'), PlayerAccount.balance.alias('account_balance'))
+                .join(PlayerAccount, JOIN.LEFT_OUTER, on=(PlayerAccount.player == cls.id))
+                .where(reduce(operator.or_, conditions))
+                .order_by(*order_by, cls.id, PlayerAccount.id)
+                .limit(1)
+                .objects())
+
 
 class Map(BaseModel):
     name = CharField(index=True)
@@ -33,7 +59,8 @@ class Map(BaseModel):
 class MapRating(BaseModel):
     map = ForeignKeyField(Map)
     player = ForeignKeyField(Player)
-    timestamp = DateTimeField(default=current_time)
+    # Rows are archived by timestamp, see xanmel.modules.xonotic.archive
+    timestamp = DateTimeField(default=current_time, index=True)
     vote = IntegerField()
     message = CharField()
 
@@ -44,10 +71,31 @@ class MapRating(BaseModel):
         return 'MapRating(nickname=%r, map=%r, vote=%r)' % (self.player, self.map, self.vote)
 
 
+class MapRatingArchive(MapRating):
+    """
+    map_rating rows moved out of the table by xanmel.modules.xonotic.archive.
+    """
+    class Meta:
+        db_table = 'map_rating_archive'
+
+
+class MapRatingSummary(BaseModel):
+    """
+    Totals of map_rating per map, updated when votes are stored.
+    """
+    map = ForeignKeyField(Map, unique=True)
+    rating = IntegerField(default=0)
+    total = IntegerField(default=0)
+
+    class Meta:
+        db_table = 'map_rating_summary'
+
+
 class CalledVote(BaseModel):
     map = ForeignKeyField(Map)
     player = ForeignKeyField(Player)
-    timestamp = DateTimeField(default=current_time)
+    # Rows are archived by timestamp, see xanmel.modules.xonotic.archive
+    timestamp = DateTimeField(default=current_time, index=True)
     vote_type = CharField(index=True)
     time_since_round_start = IntegerField()
 
@@ -58,6 +106,14 @@ class CalledVote(BaseModel):
         return 'CalledVote(nickname=%r, map=%r, vote_type=%r)' % (self.player, self.map, self.vote_type)
 
 
+class CalledVoteArchive(CalledVote):
+    """
+    called_vote rows moved out of the table by xanmel.modules.xonotic.archive.
+    """
+    class Meta:
+        db_table = 'called_vote_archive'
+
+
 class CTSRecord(BaseModel):
     server = ForeignKeyField(Server)
     map = ForeignKeyField(Map)
@@ -136,47 +192,71 @@ class XDFTimeRecord(BaseModel):
     def get_map_list(cls):
         return cls.select(cls.map).distinct()
 
+    @classmethod
+    def rank(cls, pos_field, max_pos_field, partition_by, *conditions):
+        """
+        Recompute pos_field and max_pos_field within partition_by with a single UPDATE ... FROM statement. Only the
+        rows whose positions changed are written. Records with the same time are ordered by id.
+        """
+        ranked = (cls.select(cls.id,
+                             fn.row_number().over(partition_by=partition_by, order_by=[cls.time.asc(), cls.id.asc()])
+                             .alias('pos'),
+                             fn.count(cls.id).over(partition_by=partition_by).alias('max_pos'))
+                  .join(XDFServer, on=(cls.server == XDFServer.id)))
+        if conditions:
+            ranked = ranked.where(*conditions)
+        ranked = ranked.alias('ranked')
+        return (cls.update({pos_field: ranked.c.pos, max_pos_field: ranked.c.max_pos})
+                .from_(ranked)
+                .where(cls.id == ranked.c.id,
+                       (pos_field.is_null()) | (pos_field != ranked.c.pos) |
+                       (max_pos_field.is_null()) | (max_pos_field != ranked.c.max_pos))
+                .execute())
+
     @classmethod
     def update_server_pos(cls, server, maps=None):
-        if maps is None:
-            maps = [i.map for i in cls.get_map_list()]
-        for map_name in maps:
-            records = cls.select().where(cls.map == map_name, cls.server == server).order_by(cls.time.asc(), cls.server_pos.asc())
-            max_pos = records.count()
-            for pos, i in enumerate(records, start=1):
-                if i.server_pos != pos or i.server_max_pos != max_pos:
-                    i.server_pos = pos
-                    i.server_max_pos = max_pos
-                    i.save()
+        conditions = [cls.server == server]
+        if maps is not None:
+            conditions.append(cls.map.in_(maps))
+        return cls.rank(cls.server_pos, cls.server_max_pos, [cls.map], *conditions)
 
     @classmethod
     def update_global_physics_pos(cls, maps=None):
-        for physics in XDFServer.get_physics_list():
-            servers = XDFServer.select().where(XDFServer.physics == physics.physics)
-            if maps is None:
-                maps = [i.map for i in cls.get_map_list()]
-            for map_name in maps:
-                records = cls.select().where(cls.server.in_(servers), cls.map == map_name).order_by(cls.time.asc(),
-                                                                                                    cls.server_pos.asc())
-                max_pos = records.count()
-                for pos, i in enumerate(records, start=1):
-                    if i.global_max_pos != pos or i.global_physics_max_pos != max_pos:
-                        i.global_physics_pos = pos
-                        i.global_physics_max_pos = max_pos
-                        i.save()
+        conditions = [] if maps is None else [cls.map.in_(maps)]
+        return cls.rank(cls.global_physics_pos, cls.global_physics_max_pos, [XDFServer.physics, cls.map], *conditions)
 
     @classmethod
     def update_global_pos(cls, maps=None):
-        if maps is None:
-            maps = [i.map for i in cls.get_map_list()]
-        for map_name in maps:
-            records = cls.select().where(cls.map == map_name).order_by(cls.time.asc(), cls.server_pos.asc())
-            max_pos = records.count()
-            for pos, i in enumerate(records, start=1):
-                if i.global_pos != pos or i.global_max_pos != max_pos:
-                    i.global_pos = pos
-                    i.global_max_pos = max_pos
-                    i.save()
+        conditions = [] if maps is None else [cls.map.in_(maps)]
+        return cls.rank(cls.global_pos, cls.global_max_pos, [cls.map], *conditions)
+
+    @classmethod
+    def update_record_pos(cls, record):
+        """
+        Set the positions of a new record and shift the slower records of its map, without recomputing the others.
+        Records with the same time are ordered by id, as in rank().
+        """
+        servers = XDFServer.select(XDFServer.id).where(XDFServer.physics == record.server.physics)
+        scopes = [
+            (cls.server_pos, cls.server_max_pos, [cls.server == record.server_id]),
+            (cls.global_physics_pos, cls.global_physics_max_pos, [cls.server.in_(servers)]),
+            (cls.global_pos, cls.global_max_pos, []),
+        ]
+        with cls._meta.database.atomic():
+            for pos_field, max_pos_field, conditions in scopes:
+                conditions = [cls.map == record.map, cls.id != record.id] + conditions
+                others = cls.select().where(*conditions)
+                pos = others.where((cls.time < record.time) |
+                                   ((cls.time == record.time) & (cls.id < record.id))).count() + 1
+                max_pos = others.count() + 1
+                (cls.update({pos_field: Case(None, [(pos_field >= pos, pos_field + 1)], pos_field),
+                             max_pos_field: max_pos})
+                 .where(*conditions)
+                 .execute())
+                setattr(record, pos_field.name, pos)
+                setattr(record, max_pos_field.name, max_pos)
+            record.save(only=[i[j] for i in scopes for j in (0, 1)])
+        return record
 
     @classmethod
     def get_record_for(cls, map, player, server):
@@ -188,6 +268,9 @@ class XDFTimeRecord(BaseModel):
 
     @classmethod
     def get_records_for(cls, server):
+        """
+        All records of the server as model instances by map and player. Use leaderboard.stream for big servers.
+        """
         maps = defaultdict(dict)
         q = cls.select().where(cls.server == server).order_by(cls.server_pos.desc())
         for i in q:
@@ -214,6 +297,11 @@ class XDFNewsFeed(BaseModel):
     time_record = ForeignKeyField(XDFTimeRecord, null=True)
     speed_record = ForeignKeyField(XDFSpeedRecord, null=True)
 
+    class Meta:
+        indexes = (
+            (('timestamp', 'id'), False),
+        )
+
     @property
     def server(self):
         if self.event_type == EventType.TIME_RECORD.value:
@@ -230,12 +318,35 @@ class XDFNewsFeed(BaseModel):
 
     @classmethod
     def filter_feed(cls):
-        q = (cls.select()
-             .join(XDFTimeRecord, JOIN_LEFT_OUTER, on=(cls.time_record == XDFTimeRecord.id))
-             .join(XDFSpeedRecord, JOIN_LEFT_OUTER, on=(cls.speed_record == XDFSpeedRecord.id))
-             .order_by(cls.timestamp.desc()))
+        """
+        The feed, newest first, with the records, their servers and players loaded by the same query.
+        """
+        time_server, time_player = XDFServer.alias(), XDFPlayer.alias()
+        speed_server, speed_player = XDFServer.alias(), XDFPlayer.alias()
+        q = (cls.select(cls, XDFTimeRecord, time_server, time_player, XDFSpeedRecord, speed_server, speed_player)
+             .join(XDFTimeRecord, JOIN.LEFT_OUTER, on=(cls.time_record == XDFTimeRecord.id))
+             .join(time_server, JOIN.LEFT_OUTER, on=(XDFTimeRecord.server == time_server.id))
+             .switch(XDFTimeRecord)
+             .join(time_player, JOIN.LEFT_OUTER, on=(XDFTimeRecord.player == time_player.id))
+             .switch(cls)
+             .join(XDFSpeedRecord, JOIN.LEFT_OUTER, on=(cls.speed_record == XDFSpeedRecord.id))
+             .join(speed_server, JOIN.LEFT_OUTER, on=(XDFSpeedRecord.server == speed_server.id))
+             .switch(XDFSpeedRecord)
+             .join(speed_player, JOIN.LEFT_OUTER, on=(XDFSpeedRecord.player == speed_player.id))
+             .order_by(cls.timestamp.desc(), cls.id.desc()))
         return q
 
+    @classmethod
+    def page(cls, after=None, limit=50):
+        """
+        Up to limit feed items older than the item ``after`` (the newest ones when it's None). Uses the
+        (timestamp, id) index, so a page costs the same however deep in the history it is.
+        """
+        q = cls.filter_feed()
+        if after is not None:
+            q = q.where((cls.timestamp < after.timestamp) | ((cls.timestamp == after.timestamp) & (cls.id < after.id)))
+        return list(q.limit(limit))
+
 
 class LadderAlgo(EChoice):
     CLASSIC = (0, 'Classic')
@@ -243,14 +354,14 @@ class LadderAlgo(EChoice):
 
 class LadderType(EChoice):
     GLOBAL = (0, 'Global')
-    # PHYSICS = (1, 'Physics')
+    PHYSICS = (1, 'Physics')
     SERVER = (2, 'Server')
 
 
 class XDFLadder(BaseModel):
     timestamp = DateTimeField(null=True)
     algo = SmallIntegerField(choices=LadderAlgo.choices())
-    type = SmallIntegerField(choices=LadderAlgo.choices())
+    type = SmallIntegerField(choices=LadderType.choices())
     server = ForeignKeyField(XDFServer, null=True)
     physics = CharField(index=True, null=True)
     max_position = IntegerField(null=True)
@@ -311,28 +422,68 @@ class IdentificationKey:
 class PlayerIdentification(BaseModel):
     server = ForeignKeyField(Server, null=True)
     player = ForeignKeyField(Player, null=True)
-    crypto_idfp = CharField(index=True, null=True)
-    stats_id = IntegerField(index=True, null=True)
-    ip_address = CharField(index=True)
+    crypto_idfp = CharField(null=True)
+    stats_id = IntegerField(null=True)
+    ip_address = CharField()
     raw_nickname = CharField()
-    nickname = CharField(index=True)
-    timestamp = DateTimeField(default=current_time)
-    country = CharField(max_length=3, index=True, null=True)
-    city = CharField(index=True, null=True)
-    subdivisions = CharField(index=True, null=True)
-    continent = CharField(index=True, null=True)
-    latitude = FloatField(null=True, index=True)
-    longitude = FloatField(null=True, index=True)
-    asn = CharField(null=True, index=True)
-    asn_cidr = CharField(null=True, index=True)
-    asn_country_code = CharField(max_length=3, index=True, null=True)
-    network_name = CharField(index=True, null=True)
-    network_cidr = CharField(index=True, null=True)
-    network_country_code = CharField(max_length=3, index=True, null=True)
+    nickname = CharField()
+    first_seen = DateTimeField(default=current_time)
+    last_seen = DateTimeField(default=current_time, index=True)
+    seen_count = IntegerField(default=1)
+    # See key_hash_for
+    key_hash = CharField(max_length=40, unique=True)
+    country = CharField(max_length=3, null=True)
+    city = CharField(null=True)
+    subdivisions = CharField(null=True)
+    continent = CharField(null=True)
+    latitude = FloatField(null=True)
+    longitude = FloatField(null=True)
+    asn = CharField(null=True)
+    asn_cidr = CharField(null=True)
+    asn_country_code = CharField(max_length=3, null=True)
+    network_name = CharField(null=True)
+    network_cidr = CharField(null=True)
+    network_country_code = CharField(max_length=3, null=True)
+
+    class Meta:
+        # Rows are upserted on every join but only looked up by key, IP address or nickname, most recent first
+        indexes = (
+            (('crypto_idfp', 'last_seen'), False),
+            (('ip_address', 'last_seen'), False),
+            (('nickname', 'last_seen'), False),
+        )
 
     def to_key(self):
         return IdentificationKey(self)
 
+    @classmethod
+    def key_hash_for(cls, fields):
+        """
+        Hash of the IdentificationKey fields. There is one row per IdentificationKey, a unique index on the hash
+        enforces that, as unique indexes on the nullable fields themselves would not.
+        """
+        key = [fields.get(i) for i in IdentificationKey.fields]
+        return hashlib.sha1(json.dumps(key).encode('utf8')).hexdigest()
+
+    @classmethod
+    def merge(cls, old, new):
+        """
+        Merge two queued rows with the same key hash.
+        """
+        return dict(new, first_seen=old['first_seen'], seen_count=old['seen_count'] + new['seen_count'])
+
+    @classmethod
+    def upsert(cls, rows):
+        """
+        INSERT ... ON CONFLICT query for rows with distinct key hashes. Existing rows get the new last_seen and
+        non-key fields, and their seen_count is increased.
+        """
+        kept = {'id', 'key_hash', 'first_seen', 'seen_count'} | set(IdentificationKey.fields)
+        update = {i: getattr(EXCLUDED, i.column_name) for i in cls._meta.sorted_fields
+                  if i.name not in kept and i.name in rows[0]}
+        update[cls.seen_count] = cls.seen_count + EXCLUDED.seen_count
+        return cls.insert_many(rows).on_conflict(conflict_target=[cls.key_hash], update=update)
+
     @classmethod
     def geolocate(cls, geo_response):
         if geo_response is not None:
@@ -360,3 +511,14 @@ class PlayerIdentification(BaseModel):
             }
         else:
             return {}
+
+
+class PlayerIdentificationArchive(PlayerIdentification):
+    """
+    player_identification rows not seen for a long time, moved out of the table by xanmel.modules.xonotic.archive.
+    A key seen again gets a new row in player_identification, so the key hash is not unique here.
+    """
+    key_hash = CharField(max_length=40, index=True)
+
+    class Meta:
+        db_table = 'playeridentification_archive'
@@ -7,11 +7,7 @@ import asyncio
 import datetime
 import random
 
-import geoip2.errors
 import math
-import aiohttp
-import peewee
-import ipwhois
 
 from xanmel.modules.xonotic.colors import Color
 from xanmel.utils import current_time
@@ -65,23 +61,30 @@ class Player:
         self.account = None
         self.crypto_idfp = None
         if not self.is_bot:
-            try:
-                self.geo_response = self.server.module.xanmel.geoip.city(self.ip_address)
-            except (ValueError, geoip2.errors.AddressNotFoundError):
-                self.geo_response = None
+            self.geo_response = self.server.module.xanmel.geoip.city(self.ip_address)
 
     @property
     def active(self):
         return self in self.server.players.active
 
+    def journal_ref(self):
+        return (self.server.module.path, 'player', self.server.config['unique_id'],
+                self.nickname, self.number1, self.number2, self.ip_address)
+
     async def get_db_obj_anon(self):
+        db = self.server.db
         raw_nickname = self.nickname.decode('utf8')
         nickname = Color.dp_to_none(self.nickname).decode('utf8')
-        query = await self.server.db.mgr.execute(DBPlayer.select().where(DBPlayer.raw_nickname == raw_nickname))
+        player_obj = db.identity_map.get(DBPlayer, raw_nickname=raw_nickname)
+        if player_obj is not None:
+            return player_obj
+        query = await db.mgr.execute(DBPlayer.select().where(DBPlayer.raw_nickname == raw_nickname))
         if len(query) == 1:
-            return query[0]
+            player_obj = query[0]
         else:
-            return await self.server.db.mgr.create(DBPlayer, raw_nickname=raw_nickname, nickname=nickname)
+            player_obj = await db.mgr.create(DBPlayer, raw_nickname=raw_nickname, nickname=nickname)
+        db.identity_map.put(player_obj, raw_nickname=raw_nickname)
+        return player_obj
 
     async def get_elo(self):
         self.crypto_idfp = await self.server.prvm_edictget(self.number2, 'crypto_idfp')
@@ -93,6 +96,7 @@ class Player:
         self.elo_url = 'https://stats.xonotic.org/skill?hashkey={}'.format(quoted_crypto_idfp)
         retries_left = 3
         logger.debug('Starting to get elo for %r (%r)', self.nickname, self.elo_url)
+        import aiohttp
         async with aiohttp.ClientSession() as session:
             while retries_left > 0:
                 async with session.get(
@@ -149,26 +153,50 @@ class Player:
             return None
 
     async def update_db(self):
+        """
+        Find or create the player row by crypto_idfp or stats id and make sure it has an account. The player row
+        is cached by crypto_idfp, so a known player costs one query for the account, whose balance may change;
+        an unknown one costs one joined query. Rows are created or changed in one transaction.
+        """
         crypto_idfp = self.get_crypto_idfp()
         stats_id = self.elo_basic['player_id']
-        nickname = Color.dp_to_none(self.nickname).decode('utf8')
-        raw_nickname = self.nickname.decode('utf8')
-        try:
-            player_obj = await self.server.db.mgr.get(
-                DBPlayer, DBPlayer.stats_id == stats_id or DBPlayer.crypto_idfp == crypto_idfp)
-        except peewee.DoesNotExist:
-            player_obj = await self.server.db.mgr.create(DBPlayer, crypto_idfp=crypto_idfp, stats_id=stats_id,
-                                                         nickname=nickname, raw_nickname=raw_nickname)
+        fields = {
+            'crypto_idfp': crypto_idfp,
+            'nickname': Color.dp_to_none(self.nickname).decode('utf8'),
+            'raw_nickname': self.nickname.decode('utf8'),
+        }
+        mgr = self.server.db.mgr
+        identity_map = self.server.db.identity_map
+        player_obj = crypto_idfp and identity_map.get(DBPlayer, crypto_idfp=crypto_idfp)
+        account = None
+        if player_obj:
+            accounts = await mgr.execute(PlayerAccount.select().where(PlayerAccount.player == player_obj)
+                                         .order_by(PlayerAccount.id).limit(1))
+            account = accounts[0] if accounts else None
         else:
-            player_obj.crypto_idfp = crypto_idfp
-            player_obj.nickname = nickname
-            player_obj.raw_nickname = raw_nickname
-            await self.server.db.mgr.update(player_obj)
-
-        try:
-            self.account = await self.server.db.mgr.get(PlayerAccount, PlayerAccount.player == player_obj)
-        except peewee.DoesNotExist:
-            self.account = await self.server.db.mgr.create(PlayerAccount, player=player_obj)
+            query = DBPlayer.resolve_query(crypto_idfp, stats_id)
+            rows = await mgr.execute(query) if query is not None else []
+            if rows:
+                player_obj = rows[0]
+                if player_obj.account_id is not None:
+                    account = PlayerAccount(id=player_obj.account_id, player=player_obj,
+                                            balance=player_obj.account_balance)
+        if stats_id is not None and player_obj and player_obj.stats_id is None:
+            fields['stats_id'] = stats_id
+        changed = player_obj and any(getattr(player_obj, k) != v for k, v in fields.items())
+        if not player_obj or changed or account is None:
+            async with mgr.atomic():
+                if not player_obj:
+                    player_obj = await mgr.create(DBPlayer, stats_id=stats_id, **fields)
+                elif changed:
+                    for k, v in fields.items():
+                        setattr(player_obj, k, v)
+                    await mgr.update(player_obj)
+                if account is None:
+                    account = await mgr.create(PlayerAccount, player=player_obj)
+        if crypto_idfp:
+            identity_map.put(player_obj, crypto_idfp=crypto_idfp)
+        self.account = account
         self.player_db_obj = player_obj
 
     async def get_whois(self, ip_address):
@@ -178,6 +206,7 @@ class Player:
             except:
                 return {}
         import time
+        import ipwhois
         t = time.time()
         whois = ipwhois.IPWhois(ip_address)
         try:
@@ -191,16 +220,16 @@ class Player:
         if self.server.db.is_up:
             whois_response = await self.get_whois(self.ip_address)
             data = PlayerIdentification.whois(whois_response)
-            data.update(PlayerIdentification.geolocate(self.geo_response))
-            await self.server.db.mgr.create(PlayerIdentification,
-                                            server=self.server.server_db_obj,
-                                            player=self.player_db_obj,
-                                            crypto_idfp=self.get_crypto_idfp(),
-                                            stats_id=self.elo_basic and self.elo_basic.get('player_id'),
-                                            ip_address=self.ip_address,
-                                            raw_nickname=self.nickname.decode('utf8'),
-                                            nickname=Color.dp_to_none(self.nickname).decode('utf8'),
-                                            **data)
+            data.update(self.server.module.xanmel.geoip.memoized(self.ip_address, PlayerIdentification.geolocate))
+            data.update(server=self.server.server_db_obj,
+                        player=self.player_db_obj,
+                        crypto_idfp=self.get_crypto_idfp(),
+                        stats_id=self.elo_basic and self.elo_basic.get('player_id'),
+                        ip_address=self.ip_address,
+                        raw_nickname=self.nickname.decode('utf8'),
+                        nickname=Color.dp_to_none(self.nickname).decode('utf8'))
+            key_hash = PlayerIdentification.key_hash_for(data)
+            self.server.db.upsert(PlayerIdentification, key_hash, key_hash=key_hash, **data)
 
     def get_mode_stats(self):
         def __format_num(n):
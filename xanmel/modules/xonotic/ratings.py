@@ -0,0 +1,86 @@
+import asyncio
+
+import peewee
+from peewee import fn
+
+from .archive import history
+from .models import Map, MapRating, MapRatingSummary
+
+
+class MapRatings:
+    """
+    Cache of map rating totals backed by the map_rating_summary table.
+
+    A map which has no summary row yet is backfilled from map_rating and its archive on the first lookup. After that
+    votes are added to the cache and the summary row at once, so a lookup never scans map_rating again.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        # map id -> [rating, total votes]
+        self.cache = {}
+        self.backfill_lock = asyncio.Lock()
+
+    async def get(self, map_obj):
+        """
+        Returns a (rating, total votes) tuple.
+        """
+        if map_obj.id not in self.cache:
+            async with self.backfill_lock:
+                if map_obj.id not in self.cache:
+                    self.cache[map_obj.id] = await self.load(map_obj)
+        return tuple(self.cache[map_obj.id])
+
+    async def load(self, map_obj):
+        mgr = self.db.mgr
+        try:
+            summary = await mgr.get(MapRatingSummary, map=map_obj)
+        except peewee.DoesNotExist:
+            votes = history(MapRating, lambda model: model.select(model.vote).where(model.map == map_obj)).alias('votes')
+            result = await mgr.execute(
+                MapRating.select(fn.Sum(votes.c.vote).alias('rating'), fn.Count(votes.c.vote).alias('total'))
+                .from_(votes))
+            summary, _ = await mgr.get_or_create(MapRatingSummary, map=map_obj, defaults={
+                'rating': result[0].rating or 0,
+                'total': result[0].total
+            })
+        return [summary.rating, summary.total]
+
+    async def get_by_name(self, server_db_obj, map_name):
+        """
+        Returns (rating, total votes) of a map, or None if the map has never been played on the server.
+        """
+        map_obj = self.db.identity_map.get(Map, server=server_db_obj, name=map_name)
+        if map_obj is None:
+            try:
+                map_obj = await self.db.mgr.get(Map, server=server_db_obj, name=map_name)
+            except peewee.DoesNotExist:
+                return None
+            self.db.identity_map.put(map_obj, server=server_db_obj, name=map_name)
+        return await self.get(map_obj)
+
+    async def add(self, map_obj, votes):
+        """
+        Add votes to the map totals. Must be called before the votes are inserted into map_rating, otherwise
+        they may be counted twice by the backfill.
+        """
+        await self.get(map_obj)
+        rating, total = sum(votes), len(votes)
+        self.cache[map_obj.id][0] += rating
+        self.cache[map_obj.id][1] += total
+        await self.db.mgr.execute(
+            MapRatingSummary.update(rating=MapRatingSummary.rating + rating, total=MapRatingSummary.total + total)
+            .where(MapRatingSummary.map == map_obj))
+
+
+def format_rating(map_name, rating, total_votes):
+    if total_votes == 0:
+        return '^3%(map_name)s ^7has not yet been rated - Use ^7/^2+++^7,^2++^7,^2+^7,^1-^7,^1--^7,^1--- ^7to rate ' \
+               'the map.' % {'map_name': map_name}
+    if rating >= 0:
+        message = '^3%(map_name)s ^7has ^2%(rating)s ^7points. ^5[%(total_votes)s votes]^7 - Use ' \
+                  '^7/^2+++^7,^2++^7,^2+^7,^1-^7,^1--^7,^1--- ^7to rate the map.'
+    else:
+        message = '^3%(map_name)s ^7has ^1%(rating)s ^7points. ^5[%(total_votes)s votes]^7 - Use ' \
+                  '^7/^2+++^7,^2++^7,^2+^7,^1-^7,^1--^7,^1--- ^7to rate the map.'
+    return message % {'map_name': map_name, 'rating': rating, 'total_votes': total_votes}
@@ -5,7 +5,6 @@ import time
 import asyncio
 import logging
 
-import aiohttp
 import peewee
 from aio_dprcon.client import RconClient
 from aio_dprcon.protocol import RCON_SECURE_TIME
@@ -27,30 +26,34 @@ class MapVoter:
         self.server = server
         self.map_name = ''
         self.votes = {}  # number2 -> vote
+        # Held while the votes are stored, so the rating report of a restarted map includes them
+        self.lock = asyncio.Lock()
 
     async def store(self, new_map_name):
         db = self.server.module.xanmel.db
         ts = current_time()
         map_name = self.map_name
         self.map_name = new_map_name
+        votes, self.votes = self.votes, {}
         if not db.is_up:
             return
-        if len(self.votes) == 0:
+        if len(votes) == 0:
             return
-        map, _ = await db.mgr.get_or_create(Map, server=self.server.server_db_obj, name=map_name)
-        logger.debug('GOING TO STORE VOTES %s:%r', ts, self.votes)
-        for vote in self.votes.values():
+        async with self.lock:
+            map, _ = await db.get_or_create(Map, server=self.server.server_db_obj, name=map_name)
+            logger.debug('GOING TO STORE VOTES %s:%r', ts, votes)
+            await self.server.module.map_ratings.add(map, [i['vote'] for i in votes.values()])
+        for vote in votes.values():
             if vote['player'].player_db_obj is None:
                 player = await vote['player'].get_db_obj_anon()
             else:
                 player = vote['player'].player_db_obj
-            await db.mgr.create(
+            db.insert(
                 MapRating,
                 map=map,
                 player=player,
                 vote=vote['vote'],
                 message=vote['message'])
-        self.votes = {}
 
 
 class RconServer(RconClient):
@@ -70,6 +73,8 @@ class RconServer(RconClient):
         self.log_parser = RconLogParser(self)
         self.cmd_parser = RconCmdParser(self)
         self.disabled = config.get('disabled', False)
+        self.connect_task = None
+        self.stopped = False
         self.players = PlayerManager()
         self.current_map = ''
         self.current_gt = ''
@@ -82,6 +87,10 @@ class RconServer(RconClient):
             self.raw_log = open(config['raw_log'], 'ab')
         else:
             self.raw_log = None
+        if config.get('raw_cmd_log'):
+            self.raw_cmd_log = open(config['raw_cmd_log'], 'ab')
+        else:
+            self.raw_cmd_log = None
         self.map_list = []
         self.dyn_fraglimit_lock = asyncio.Lock()
         self.game_start_timestamp = 0
@@ -105,6 +114,32 @@ class RconServer(RconClient):
     def host(self):
         return self.status.get('host')
 
+    def journal_ref(self):
+        return self.module.path, 'server', self.config['unique_id']
+
+    def stop(self):
+        """
+        Disconnect from the server, when it's removed or replaced on config reload. Queued events and running
+        handlers may still refer to the server, commands they send are dropped.
+        """
+        self.stopped = True
+        if self.connect_task:
+            self.connect_task.cancel()
+        for transport in (self.cmd_transport, self.log_transport):
+            if transport:
+                transport.close()
+        self.cmd_transport = self.cmd_protocol = self.log_transport = self.log_protocol = None
+        for f in (self.raw_log, self.raw_cmd_log):
+            if f:
+                f.close()
+        self.raw_log = self.raw_cmd_log = None
+
+    def send(self, command):
+        if self.stopped:
+            logger.debug('Dropping %r - server %s is stopped', command, self.config['name'])
+            return
+        super().send(command)
+
     def on_server_connected(self):
         super().on_server_connected()
         self.loop.create_task(asyncio.wait([self.update_maplist(),
@@ -120,6 +155,10 @@ class RconServer(RconClient):
         if self.raw_log:
             self.raw_log.write(data)
 
+    def custom_cmd_callback(self, data, addr):
+        if self.raw_cmd_log:
+            self.raw_cmd_log.write(data)
+
     async def update_maplist(self):
         self.cvars['g_maplist'] = None
         await self.execute_with_retry('g_maplist', lambda: bool(self.cvars['g_maplist']))
@@ -173,13 +212,18 @@ class RconServer(RconClient):
     async def update_server_name(self):
         if not self.db.is_up:
             return
+        srv = self.db.identity_map.get(Server, id=self.config['unique_id'])
+        if srv is not None and srv.name == self.status['host']:
+            self.server_db_obj = srv
+            return
         try:
-            srv = await self.db.mgr.get(Server, id=self.config['unique_id'])
+            srv = srv or await self.db.mgr.get(Server, id=self.config['unique_id'])
         except peewee.DoesNotExist:
             srv = await self.db.mgr.create(Server, id=self.config['unique_id'], config_name=self.config['name'], name=self.status['host'])
         else:
             srv.name = self.status['host']
             await self.db.mgr.update(srv)
+        self.db.identity_map.put(srv, id=self.config['unique_id'])
         self.server_db_obj = srv
 
     def say_ircmsg(self, message: Union[str, list, tuple], nick: str=None) -> None:
@@ -0,0 +1,46 @@
+import datetime
+
+from xanmel import current_time
+from xanmel.modules.xonotic.archive import Archiver
+from xanmel.modules.xonotic.models import CalledVote, CalledVoteArchive, Map, MapRating, MapRatingArchive, Player, \
+    PlayerIdentification, PlayerIdentificationArchive, Server
+from xanmel.modules.xonotic.ratings import MapRatings
+
+
+def test_archive(event_loop, xonotic_db):
+    db = xonotic_db
+    now = current_time()
+    old = now - datetime.timedelta(days=200)
+
+    def fill():
+        server = Server.create(config_name='test')
+        map_obj = Map.create(name='dance', server=server)
+        player = Player.create(raw_nickname='test', nickname='test')
+        for timestamp, vote in [(old, 1), (old, -1), (old, 3), (now, 2)]:
+            MapRating.create(map=map_obj, player=player, timestamp=timestamp, vote=vote, message='+')
+            CalledVote.create(map=map_obj, player=player, timestamp=timestamp, vote_type='gotomap',
+                              time_since_round_start=10)
+        for nickname, last_seen in [('old', old), ('new', now)]:
+            fields = {'ip_address': '127.0.0.1', 'raw_nickname': nickname, 'nickname': nickname}
+            PlayerIdentification.create(last_seen=last_seen, key_hash=PlayerIdentification.key_hash_for(fields),
+                                        **fields)
+        return map_obj
+
+    map_obj = db.run_sync(fill)
+    archiver = Archiver(db, {'after_days': 180, 'batch_size': 2})
+    assert event_loop.run_until_complete(archiver.run()) == {
+        'map_rating': 3, 'called_vote': 3, 'playeridentification': 1}
+    assert event_loop.run_until_complete(archiver.run()) == {
+        'map_rating': 0, 'called_vote': 0, 'playeridentification': 0}
+    assert archiver.archived['map_rating'] == 3
+
+    def counts():
+        return [(i.select().count(), j.select().count()) for i, j in [
+            (MapRating, MapRatingArchive), (CalledVote, CalledVoteArchive),
+            (PlayerIdentification, PlayerIdentificationArchive)]]
+
+    assert db.run_sync(counts) == [(1, 3), (1, 3), (1, 1)]
+    assert db.run_sync(lambda: sorted(i.vote for i in MapRatingArchive.select())) == [-1, 1, 3]
+    assert db.run_sync(lambda: PlayerIdentificationArchive.get().nickname) == 'old'
+    # The backfill counts the archived votes
+    assert event_loop.run_until_complete(MapRatings(db).get(map_obj)) == (5, 4)
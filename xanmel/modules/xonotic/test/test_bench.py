@@ -0,0 +1,49 @@
+import asyncio
+import sqlite3
+
+import yaml
+
+from xanmel.cli import offline_xanmel
+from xanmel.db import database_proxy
+from xanmel.modules.xonotic import bench
+
+
+def test_benchmark(xanmel, xon_module, example_scores, tmpdir):
+    capture = tmpdir.join('raw.log')
+    capture.write_binary(b':join:4:1:127.0.0.1:^xF90sleet^7\n' + example_scores + b'\n:part:4\n')
+    server = xon_module.servers[0]
+    result = xanmel.loop.run_until_complete(bench.benchmark(xanmel, server, log_path=str(capture), chunk_size=64))
+    assert result['lines'] == example_scores.count(b'\n') + 3
+    assert result['event_types']['xanmel.modules.xonotic.events.Join'] == 1
+    assert result['event_types']['xanmel.modules.xonotic.events.GameEnded'] == 1
+    assert result['events'] == sum(result['event_types'].values())
+    assert result['parsers']['JoinParser']['matched'] == 1
+    assert result['parsers']['ScoresParser']['matched'] >= 1
+    assert server.players.players_by_number1 == {}
+
+
+def test_offline_db(event_loop, example_scores, tmpdir):
+    db_path = tmpdir.join('xanmel.db')
+    config = yaml.safe_load(open('xanmel.yaml'))
+    config['settings']['db_url'] = 'sqlite:///%s' % db_path
+    config_path = tmpdir.join('xanmel.yaml')
+    config_path.write(yaml.safe_dump(config))
+    capture = tmpdir.join('raw.log')
+    capture.write_binary(b':join:4:1:127.0.0.1:^xF90sleet^7\n' + example_scores + b'\n:part:4\n')
+    xanmel = offline_xanmel(str(config_path), db=False)
+    try:
+        assert not xanmel.db.is_up
+        server = xanmel.modules['xanmel.modules.xonotic.XonoticModule'].servers[0]
+        assert server.db is xanmel.db
+        result = event_loop.run_until_complete(bench.benchmark(xanmel, server, log_path=str(capture)))
+        assert result['event_types']['xanmel.modules.xonotic.events.GameEnded'] == 1
+        assert xanmel.db.pending_rows == 0
+    finally:
+        xanmel.teardown()
+        database_proxy.initialize(None)
+        tasks = asyncio.all_tasks(event_loop)
+        for i in tasks:
+            i.cancel()
+        event_loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    # Not even the tables were created
+    assert sqlite3.connect(str(db_path)).execute('SELECT count(*) FROM sqlite_master').fetchone() == (0,)
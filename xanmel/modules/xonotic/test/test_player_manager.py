@@ -1,3 +1,6 @@
+from decimal import Decimal
+
+from xanmel.modules.xonotic.models import Player as DBPlayer, PlayerAccount
 from xanmel.modules.xonotic.players import PlayerManager, Player
 
 
@@ -63,3 +66,40 @@ def test_get_elo(xon_server):
     pm = PlayerManager()
     pm.join(Player(xon_server, b'test', 1, 2, '127.0.0.1'))
 
+
+def test_update_db(xon_server, xonotic_db, event_loop, mocker):
+    db = xonotic_db
+    xon_server.db = db
+    execute = mocker.spy(db.mgr, 'execute')
+    create = mocker.spy(db.mgr, 'create')
+    update = mocker.spy(db.mgr, 'update')
+
+    def join(nickname, crypto_idfp, stats_id):
+        player = Player(xon_server, nickname, 1, 2, '127.0.0.1')
+        player.crypto_idfp = crypto_idfp
+        player.elo_basic = {'player_id': stats_id}
+        execute.reset_mock()
+        create.reset_mock()
+        update.reset_mock()
+        event_loop.run_until_complete(player.update_db())
+        return player
+
+    player = join(b'test', 'key1', None)
+    assert (execute.call_count, create.call_count, update.call_count) == (1, 2, 0)
+    assert player.account.balance == Decimal(1000)
+    # Cached by crypto_idfp, only the account is read
+    assert join(b'test', 'key1', None).player_db_obj.id == player.player_db_obj.id
+    assert (execute.call_count, create.call_count, update.call_count) == (1, 0, 0)
+    db.identity_map.clear()
+    renamed = join(b'^1test', 'key1', 7)
+    assert (execute.call_count, create.call_count, update.call_count) == (1, 0, 1)
+    assert renamed.account.id == player.account.id
+    assert renamed.account.balance == Decimal('1000.00')
+    assert isinstance(renamed.account.balance, Decimal)
+    assert db.run_sync(lambda: DBPlayer.get_by_id(player.player_db_obj.id)).stats_id == 7
+    db.identity_map.clear()
+    assert join(b'test', 'key2', 7).player_db_obj.id == player.player_db_obj.id
+    # No stats id doesn't match the players without one
+    other = join(b'other', 'key3', None)
+    assert other.player_db_obj.id != player.player_db_obj.id
+    assert db.run_sync(lambda: (DBPlayer.select().count(), PlayerAccount.select().count())) == (2, 2)
@@ -0,0 +1,54 @@
+import asynctest
+import peewee
+
+from xanmel.db import IdentityMap
+from xanmel.modules.xonotic.models import Map, MapRatingSummary, Server
+from xanmel.modules.xonotic.ratings import MapRatings
+
+
+def mock_db(mocker, summary=None, totals=(None, 0)):
+    db = mocker.MagicMock()
+    db.identity_map = IdentityMap()
+    db.mgr.get = asynctest.CoroutineMock(side_effect=peewee.DoesNotExist if summary is None else None,
+                                         return_value=summary)
+    db.mgr.execute = asynctest.CoroutineMock(return_value=[mocker.MagicMock(rating=totals[0], total=totals[1])])
+    db.mgr.get_or_create = asynctest.CoroutineMock(
+        side_effect=lambda model, defaults, **kwargs: (MapRatingSummary(**kwargs, **defaults), True))
+    return db
+
+
+def test_backfill(xanmel, mocker):
+    db = mock_db(mocker, totals=(5, 3))
+    ratings = MapRatings(db)
+    map_obj = Map(id=1, name='dance')
+    assert xanmel.loop.run_until_complete(ratings.get(map_obj)) == (5, 3)
+    assert xanmel.loop.run_until_complete(ratings.get(map_obj)) == (5, 3)
+    assert db.mgr.get.call_count == 1
+    assert db.mgr.execute.call_count == 1
+    assert db.mgr.get_or_create.call_args[1]['defaults'] == {'rating': 5, 'total': 3}
+
+
+def test_add(xanmel, mocker):
+    db = mock_db(mocker, summary=MapRatingSummary(rating=-2, total=4))
+    ratings = MapRatings(db)
+    map_obj = Map(id=1, name='dance')
+    xanmel.loop.run_until_complete(ratings.add(map_obj, [3, 1, -1]))
+    assert xanmel.loop.run_until_complete(ratings.get(map_obj)) == (1, 7)
+    assert db.mgr.execute.call_count == 1
+    db.mgr.get = asynctest.CoroutineMock(side_effect=peewee.DoesNotExist)
+    assert xanmel.loop.run_until_complete(ratings.get_by_name(Server(id=1), 'stormkeep')) is None
+
+
+def test_maprating_command(xanmel, xon_module, dummy_chat_user, irc_module, mocker):
+    rcon_server = xon_module.servers[0]
+    chat_user = dummy_chat_user(module=irc_module, name='test')
+    chat_user.user_type = 'irc'
+    xanmel.loop.run_until_complete(xanmel.cmd_root.run(chat_user, 'xon maprating dance', is_private=False))
+    assert chat_user.public_reply.call_args[0][0] == 'exe > Map ratings are not available'
+    mocker.patch.object(xanmel.db, 'db', object())
+    rcon_server.server_db_obj = Server(id=1)
+    xanmel.db.identity_map.put(Map(id=1, name='dance'), server=1, name='dance')
+    xon_module.map_ratings.cache[1] = [12, 7]
+    xanmel.loop.run_until_complete(xanmel.cmd_root.run(chat_user, 'xon maprating dance', is_private=False))
+    assert chat_user.public_reply.call_args[0][0].startswith(
+        'exe > \x0307dance \x0fhas \x030912 \x0fpoints. \x0311[7 votes]\x0f')
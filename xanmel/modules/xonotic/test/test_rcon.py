@@ -1,3 +1,5 @@
+from unittest import mock
+
 from aioresponses import aioresponses
 
 
@@ -8,3 +10,15 @@ from aioresponses import aioresponses
 #         m.get('http://stats.xonotic.org/server/7975/topscorers?last=20', status=200, payload={})
 #         event_loop.run_until_complete(xon_server.update_server_stats())
 #     assert len(xon_server.server_rating) == 20
+
+
+def test_send_after_stop(xon_module):
+    server = xon_module.servers[0]
+    server.cmd_protocol = mock.MagicMock()
+    server.say('hello')
+    assert server.cmd_protocol.send.call_count == 3
+    protocol = server.cmd_protocol
+    server.stop()
+    server.say('hello')
+    server.send('status')
+    assert protocol.send.call_count == 3
@@ -0,0 +1,212 @@
+import datetime
+import random
+from collections import defaultdict
+from decimal import Decimal
+
+import numpy as np
+import peewee
+import pytest
+
+from xanmel.db import database_proxy
+from xanmel.modules.xonotic import ladder, leaderboard
+from xanmel.modules.xonotic.models import EventType, LadderType, XDFLadder, XDFLadderPosition, XDFNewsFeed, \
+    XDFPlayer, XDFServer, XDFSpeedRecord, XDFTimeRecord
+
+POSITION_FIELDS = ['server_pos', 'server_max_pos', 'global_physics_pos', 'global_physics_max_pos', 'global_pos',
+                   'global_max_pos']
+
+
+@pytest.fixture
+def xdf_db():
+    db = peewee.SqliteDatabase(':memory:')
+    database_proxy.initialize(db)
+    db.create_tables([XDFServer, XDFPlayer, XDFTimeRecord, XDFSpeedRecord, XDFNewsFeed, XDFLadder])
+    servers = [XDFServer.create(name=str(i), admins='', color='', logo='', logo_hires='', physics=physics)
+               for i, physics in enumerate(['xdf', 'xdf', 'cpma'])]
+    players = [XDFPlayer.create(raw_nickname=str(i), nickname=str(i)) for i in range(10)]
+    yield servers, players
+    database_proxy.initialize(None)
+
+
+def positions():
+    return {i.id: tuple(getattr(i, j) for j in POSITION_FIELDS) for i in XDFTimeRecord.select()}
+
+
+def recompute(servers):
+    for server in servers:
+        XDFTimeRecord.update_server_pos(server)
+    XDFTimeRecord.update_global_physics_pos()
+    XDFTimeRecord.update_global_pos()
+
+
+def test_recompute(xdf_db):
+    servers, players = xdf_db
+    for server, player, time in [(0, 0, 12), (0, 1, 10), (1, 2, 11), (2, 3, 9), (0, 4, 10)]:
+        XDFTimeRecord.create(map='dance', server=servers[server], player=players[player], server_pos=0,
+                             time=Decimal(time))
+    XDFTimeRecord.create(map='other', server=servers[0], player=players[0], server_pos=0, time=Decimal(1))
+    recompute(servers)
+    by_player = {i.player_id: i for i in XDFTimeRecord.select().where(XDFTimeRecord.map == 'dance')}
+    assert [by_player[players[i].id].server_pos for i in (0, 1, 4)] == [3, 1, 2]
+    assert by_player[players[0].id].server_max_pos == 3
+    assert [by_player[players[i].id].global_physics_pos for i in (0, 1, 2, 4)] == [4, 1, 3, 2]
+    assert by_player[players[3].id].global_physics_max_pos == 1
+    assert [by_player[players[i].id].global_pos for i in (0, 1, 2, 3, 4)] == [5, 2, 4, 1, 3]
+    assert XDFTimeRecord.update_global_pos() == 0
+    assert XDFTimeRecord.update_global_pos(maps=['dance']) == 0
+
+
+def test_update_record_pos(xdf_db):
+    servers, players = xdf_db
+    rnd = random.Random(1)
+    for i in range(40):
+        XDFTimeRecord.create(map=rnd.choice(['dance', 'other']), server=rnd.choice(servers),
+                             player=rnd.choice(players), server_pos=0, time=Decimal(rnd.randint(1, 1000)))
+    recompute(servers)
+    for i in range(10):
+        record = XDFTimeRecord.create(map='dance', server=rnd.choice(servers), player=rnd.choice(players),
+                                      server_pos=0, time=Decimal(rnd.randint(1, 1000)) + Decimal('0.5'))
+        XDFTimeRecord.update_record_pos(record)
+    incremental = positions()
+    recompute(servers)
+    assert positions() == incremental
+
+
+def test_update_record_pos_ties(xdf_db):
+    servers, players = xdf_db
+    rnd = random.Random(3)
+    for i in range(30):
+        XDFTimeRecord.create(map='dance', server=rnd.choice(servers), player=rnd.choice(players), server_pos=0,
+                             time=Decimal(rnd.randint(1, 10)))
+    recompute(servers)
+    for i in range(10):
+        record = XDFTimeRecord.create(map='dance', server=rnd.choice(servers), player=rnd.choice(players),
+                                      server_pos=0, time=Decimal(rnd.randint(1, 10)))
+        XDFTimeRecord.update_record_pos(record)
+    incremental = positions()
+    recompute(servers)
+    assert positions() == incremental
+
+
+def classic_points(records):
+    best = {}
+    for map_name, player, time, record_id in records:
+        key = (map_name, player)
+        if key not in best or (time, record_id) < best[key][:2]:
+            best[key] = (time, record_id)
+    by_map = defaultdict(list)
+    for (map_name, player), (time, record_id) in best.items():
+        by_map[map_name].append((time, record_id, player))
+    points = defaultdict(float)
+    for i in by_map.values():
+        i.sort()
+        for rank, (_, _, player) in enumerate(i, start=1):
+            points[player] += 100 * (len(i) - rank + 1) / len(i)
+    return points
+
+
+def test_compute_classic():
+    rnd = random.Random(2)
+    records = [(rnd.randrange(20), rnd.randrange(30), rnd.randint(1, 50), i) for i in range(500)]
+    map_codes, player_codes, times, ids = (np.array(i) for i in zip(*records))
+    points, maps, first_places = ladder.compute_classic(map_codes, player_codes, times, ids, 30)
+    expected = classic_points(records)
+    assert np.allclose(points, [expected[i] for i in range(30)])
+    assert maps.sum() == len({(i[0], i[1]) for i in records})
+    assert first_places.sum() == 20
+    order, position = ladder.positions(np.array([10.0, 30.0, 10.0, 20.0]))
+    assert list(order) == [1, 3, 0, 2]
+    assert list(position) == [1, 2, 3, 3]
+
+
+def test_build_ladder(xdf_db, mocker):
+    servers, players = xdf_db
+    mocker.patch.object(XDFLadderPosition.data, 'index', False)
+    XDFLadderPosition.create_table()
+    for server, player, time in [(0, 0, 12), (0, 1, 10), (1, 1, 9), (2, 2, 11), (0, 0, 20)]:
+        XDFTimeRecord.create(map='dance', server=servers[server], player=players[player], server_pos=0,
+                             time=Decimal(time))
+    XDFTimeRecord.create(map='other', server=servers[0], player=players[0], server_pos=0, time=Decimal(1))
+    built = ladder.build_all()
+    assert sorted((i.type, i.physics or '', i.server_id or 0, i.max_position) for i in built) == [
+        (LadderType.GLOBAL.value, '', 0, 3),
+        (LadderType.PHYSICS.value, 'cpma', 0, 1),
+        (LadderType.PHYSICS.value, 'xdf', 0, 2),
+        (LadderType.SERVER.value, '', servers[0].id, 2),
+        (LadderType.SERVER.value, '', servers[1].id, 1),
+        (LadderType.SERVER.value, '', servers[2].id, 1),
+    ]
+    global_positions = XDFLadderPosition.select().where(XDFLadderPosition.ladder == built[0]).order_by(
+        XDFLadderPosition.position)
+    assert [(i.player_id, i.points, i.position) for i in global_positions] == [
+        (players[0].id, Decimal('133.33333'), 1), (players[1].id, Decimal('100'), 2),
+        (players[2].id, Decimal('66.66667'), 3)]
+
+
+def test_ladder_benchmark():
+    result = ladder.benchmark(records=1000, players=50, maps=20)
+    assert result['records'] == 1000
+    assert result['records_per_second'] > 0
+
+
+def test_leaderboard(xdf_db):
+    servers, players = xdf_db
+    rnd = random.Random(3)
+    for i in range(60):
+        XDFTimeRecord.create(map=rnd.choice(['a', 'b', 'c']), server=rnd.choice(servers), player=rnd.choice(players),
+                             server_pos=0, time=Decimal(rnd.randint(1, 20)))
+    recompute(servers)
+    # Not placed yet
+    XDFTimeRecord.create(map='a', server=servers[1], player=players[0], server_pos=0, time=Decimal(1))
+    for server in [None, servers[0]]:
+        pos_field = leaderboard.position_field(server)
+        query = XDFTimeRecord.select().where(pos_field.is_null(False)).order_by(
+            XDFTimeRecord.map, pos_field, XDFTimeRecord.id)
+        if server is not None:
+            query = query.where(XDFTimeRecord.server == server)
+        assert [i[0] for i in leaderboard.stream(server, page_size=7)] == [i.id for i in query]
+        first = leaderboard.page('a', server, limit=4)
+        second = leaderboard.page('a', server, after=first[-1], limit=4)
+        assert [i[0] for i in first + second] == [i.id for i in query.where(XDFTimeRecord.map == 'a')][:8]
+
+
+def test_top_records(xdf_db):
+    servers, players = xdf_db
+    top = leaderboard.TopRecords(limit=2)
+    top.add_record(map='a', server=servers[0], player=players[0], time=Decimal(10))
+    top.add_record(map='b', server=servers[0], player=players[0], time=Decimal(10))
+    assert [i[2] for i in top.get('a')] == [players[0].id]
+    assert top.get('a', servers[0]) is top.get('a', servers[0].id)
+    top.get('b')
+    assert (top.hits, top.misses) == (1, 3)
+    record = top.add_record(map='a', server=servers[1], player=players[1], time=Decimal(5))
+    assert (record.server_pos, record.global_pos, record.global_max_pos) == (1, 1, 2)
+    assert set(top.boards) == {(None, 'b')}
+    assert [(i[2], i[leaderboard.GLOBAL_POS]) for i in top.get('a')] == [(players[1].id, 1), (players[0].id, 2)]
+
+
+def test_news_feed(xdf_db, mocker):
+    servers, players = xdf_db
+    started = datetime.datetime(2020, 1, 1)
+    for i in range(25):
+        # Every timestamp is shared by two items
+        timestamp = started + datetime.timedelta(minutes=i // 2)
+        if i % 3:
+            record = XDFTimeRecord.create(map='m%s' % i, server=servers[i % 3], player=players[i % 10], server_pos=1,
+                                          time=Decimal(i))
+            XDFNewsFeed.create(timestamp=timestamp, event_type=EventType.TIME_RECORD.value, time_record=record)
+        else:
+            record = XDFSpeedRecord.create(map='m%s' % i, server=servers[i % 3], player=players[i % 10], speed=i)
+            XDFNewsFeed.create(timestamp=timestamp, event_type=EventType.SPEED_RECORD.value, speed_record=record)
+    execute_sql = mocker.spy(database_proxy.obj, 'execute_sql')
+    items = []
+    after = None
+    while True:
+        page = XDFNewsFeed.page(after, limit=10)
+        items.extend((i.id, i.server.name, i.map) for i in page)
+        if not page:
+            break
+        after = page[-1]
+    assert execute_sql.call_count == 4
+    expected = XDFNewsFeed.select().order_by(XDFNewsFeed.timestamp.desc(), XDFNewsFeed.id.desc())
+    assert items == [(i.id, i.server.name, i.map) for i in expected]
@@ -0,0 +1,115 @@
+"""
+Per-query timing of the database layer.
+
+Every query run through InstrumentedManager (or SqliteManager) is reported to a QueryLog with a label like
+``Map.select``, the time it took and the time spent waiting for a connection from the pool. Queries slower than the
+threshold are logged by the xanmel.querylog logger.
+"""
+import contextvars
+import logging
+import time
+from collections import defaultdict
+
+import peewee
+import peewee_async
+
+from .metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Seconds the current task waited for pool connections since the last reset
+pool_wait = contextvars.ContextVar('pool_wait', default=0)
+
+
+def query_label(query, operation=None):
+    model = getattr(query, 'model', None)
+    if operation is None:
+        if isinstance(query, peewee.SelectBase):
+            operation = 'select'
+        elif isinstance(query, peewee.Insert):
+            operation = 'insert'
+        elif isinstance(query, peewee.Update):
+            operation = 'update'
+        elif isinstance(query, peewee.Delete):
+            operation = 'delete'
+        else:
+            operation = 'sql'
+    return '%s.%s' % (model.__name__ if model is not None else 'raw', operation)
+
+
+class QueryLog:
+    def __init__(self, slow_threshold=None):
+        self.slow_threshold = slow_threshold
+        self.queries = defaultdict(Histogram)
+        self.pool_waits = defaultdict(Histogram)
+        self.slow_queries = 0
+
+    def observe(self, label, duration, wait=0, query=None):
+        self.queries[label].observe(duration)
+        self.pool_waits[label].observe(wait)
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            self.slow_queries += 1
+            logger.warning('Slow query %s: %.3fs, waited %.3fs for a connection: %s',
+                           label, duration, wait, query.sql() if isinstance(query, peewee.Query) else '')
+
+    def histograms(self):
+        """
+        (metric name, label name, help, histograms) tuples for Metrics.histograms
+        """
+        return [
+            ('xanmel_db_query_seconds', 'query', 'Time spent in database queries', self.queries),
+            ('xanmel_db_pool_wait_seconds', 'query', 'Time spent waiting for a database connection', self.pool_waits),
+        ]
+
+
+class InstrumentedConnection(peewee_async.AsyncPostgresqlConnection):
+    async def acquire(self):
+        started = time.perf_counter()
+        try:
+            return await super().acquire()
+        finally:
+            pool_wait.set(pool_wait.get() + time.perf_counter() - started)
+
+
+class PostgresqlDatabase(peewee_async.PostgresqlDatabase):
+    def init_async(self, conn_cls=InstrumentedConnection, **kwargs):
+        super().init_async(conn_cls, **kwargs)
+
+
+class PooledPostgresqlDatabase(peewee_async.PooledPostgresqlDatabase):
+    def init_async(self, conn_cls=InstrumentedConnection, **kwargs):
+        super().init_async(conn_cls, **kwargs)
+
+
+class InstrumentedManager(peewee_async.Manager):
+    def __init__(self, database, query_log):
+        super().__init__(database)
+        self.query_log = query_log
+
+    async def timed(self, label, query, coro):
+        pool_wait.set(0)
+        started = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            wait = pool_wait.get()
+            self.query_log.observe(label, time.perf_counter() - started - wait, wait, query)
+
+    async def execute(self, query):
+        return await self.timed(query_label(query), query, super().execute(query))
+
+    async def count(self, query, clear_limit=False):
+        return await self.timed(query_label(query, 'count'), query, super().count(query, clear_limit))
+
+    async def scalar(self, query, as_tuple=False):
+        return await self.timed(query_label(query, 'scalar'), query, super().scalar(query, as_tuple))
+
+    def pool_stats(self):
+        """
+        (size, free connections, max size) of the connection pool, or None when it isn't connected.
+        """
+        conn = self.database._async_conn
+        pool = getattr(conn, 'pool', None)
+        if pool is None:
+            return None
+        return pool.size, pool.freesize, pool.maxsize
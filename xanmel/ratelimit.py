@@ -0,0 +1,54 @@
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter keyed by user id.
+
+    Each user may run up to burst commands at once, the bucket is refilled with rate tokens per second.
+    A user who runs out of tokens is ignored for penalty seconds.
+
+    Buckets are kept in the LRU order and at most max_users of them are stored. Buckets which are full again and
+    aren't penalized are no different from new ones, so they are evicted as soon as they reach the LRU end.
+    """
+
+    def __init__(self, burst=5, rate=0.5, penalty=60, max_users=10000):
+        self.burst = burst
+        self.rate = rate
+        self.penalty = penalty
+        self.max_users = max_users
+        self.refill_time = burst / rate
+        # user id -> [tokens, last update, penalized until]
+        self.buckets = OrderedDict()
+
+    def evict(self, now):
+        while self.buckets:
+            tokens, updated, penalized_until = next(iter(self.buckets.values()))
+            if len(self.buckets) < self.max_users and \
+                    (now - updated < self.refill_time or now < penalized_until):
+                break
+            self.buckets.popitem(last=False)
+
+    def allow(self, key):
+        """
+        Take a token from the user's bucket. Returns False if the user is penalized or out of tokens.
+        """
+        now = time.time()
+        self.evict(now)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now, 0]
+        else:
+            self.buckets.move_to_end(key)
+        tokens, updated, penalized_until = bucket
+        if now < penalized_until:
+            return False
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] = now + self.penalty
+            return False
+        bucket[0] = tokens - 1
+        return True
@@ -0,0 +1,231 @@
+"""
+Embedded SQLite backend.
+
+SqliteManager implements the part of the peewee_async.Manager interface used by xanmel. Queries are run by a single
+thread which owns the connection, so the event loop never waits for the disk. Queries queued while the thread is
+busy are run in one transaction and committed together (group commit), each in its own savepoint so a failed query
+doesn't affect the others. Their results are delivered after the commit. The time a query waited in the queue is
+reported to the QueryLog as its pool wait.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+import peewee
+
+from .querylog import QueryLog, query_label
+
+logger = logging.getLogger(__name__)
+
+PRAGMAS = [('journal_mode', 'wal'), ('synchronous', 'normal'), ('foreign_keys', 1)]
+
+# Max number of queries committed at once
+MAX_BATCH = 256
+
+
+def connect_sqlite(path):
+    return peewee.SqliteDatabase(path, pragmas=PRAGMAS, check_same_thread=False)
+
+
+class Transaction:
+    def __init__(self, manager):
+        self.manager = manager
+        self.depth = None
+
+    async def __aenter__(self):
+        manager = self.manager
+        task = asyncio.current_task()
+        if manager.owner is not task:
+            await manager.lock.acquire()
+            manager.owner = task
+        manager.depth += 1
+        self.depth = manager.depth
+        try:
+            await manager.submit('begin', self.depth)
+        except Exception:
+            self.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.manager.submit('end', (self.depth, exc_type is None))
+        finally:
+            self.release()
+
+    def release(self):
+        manager = self.manager
+        manager.depth -= 1
+        if manager.depth == 0:
+            manager.owner = None
+            manager.lock.release()
+
+
+class SqliteManager:
+    def __init__(self, database, query_log=None):
+        self.database = database
+        self.query_log = query_log or QueryLog()
+        self.queue = queue.Queue()
+        # The task running an explicit transaction (see atomic) and its nesting depth
+        self.owner = None
+        self.depth = 0
+        self.lock = asyncio.Lock()
+        # Writer thread state: the open group transaction and the explicit transaction and savepoints
+        self.group = None
+        self.transactions = []
+        self.commits = 0
+        self.thread = threading.Thread(target=self.run_forever, name='xanmel-sqlite', daemon=True)
+        self.thread.start()
+
+    # Event loop side
+
+    async def submit(self, kind, arg, label=None, query=None):
+        task = asyncio.current_task()
+        while self.owner is not None and self.owner is not task:
+            async with self.lock:
+                pass
+        future = concurrent.futures.Future()
+        future.queued = time.perf_counter()
+        self.queue.put((kind, arg, future))
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            if label is not None and hasattr(future, 'finished'):
+                self.query_log.observe(label, future.finished - future.started, future.started - future.queued, query)
+
+    def run_sync(self, func):
+        """
+        Run func in the writer thread and wait for the result, blocking the caller.
+        """
+        future = concurrent.futures.Future()
+        self.queue.put(('query', func, future))
+        return future.result()
+
+    async def run(self, func, label=None, query=None):
+        return await self.submit('query', func, label, query)
+
+    async def execute(self, query):
+        if isinstance(query, peewee.SelectBase):
+            return await self.run(lambda: list(query.execute()), query_label(query), query)
+        return await self.run(query.execute, query_label(query), query)
+
+    async def get(self, source, *args, **kwargs):
+        if isinstance(source, peewee.SelectBase):
+            return await self.run(source.get, query_label(source), source)
+        return await self.run(lambda: source.get(*args, **kwargs), '%s.select' % source.__name__)
+
+    async def create(self, model, **data):
+        return await self.run(lambda: model.create(**data), '%s.insert' % model.__name__)
+
+    async def get_or_create(self, model, defaults=None, **kwargs):
+        def get_or_create():
+            try:
+                return model.get(**kwargs), False
+            except model.DoesNotExist:
+                return model.create(**dict(defaults or {}, **kwargs)), True
+
+        return await self.run(get_or_create, '%s.get_or_create' % model.__name__)
+
+    async def update(self, obj, only=None):
+        return await self.run(lambda: obj.save(only=only), '%s.update' % type(obj).__name__)
+
+    async def delete(self, obj):
+        return await self.run(obj.delete_instance, '%s.delete' % type(obj).__name__)
+
+    async def count(self, query):
+        return await self.run(query.count, query_label(query, 'count'), query)
+
+    async def scalar(self, query, as_tuple=False):
+        return await self.run(lambda: query.scalar(as_tuple), query_label(query, 'scalar'), query)
+
+    def atomic(self):
+        """
+        Async context manager running the queries of the current task in a transaction. Queries of other tasks
+        wait until it's finished. May be nested, the inner blocks use savepoints.
+        """
+        return Transaction(self)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    # Writer thread side
+
+    def run_forever(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < MAX_BATCH:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            self.process(batch)
+        self.database.close()
+
+    def process(self, batch):
+        # (future, result, exception, run in the group transaction), delivered after the commit
+        done = []
+        for kind, arg, future in batch:
+            try:
+                if kind == 'begin':
+                    self.commit_group(done)
+                    transaction = self.database.transaction() if arg == 1 else self.database.savepoint()
+                    transaction.__enter__()
+                    self.transactions.append(transaction)
+                    result = None
+                elif kind == 'end':
+                    depth, commit = arg
+                    transaction = self.transactions.pop()
+                    if commit:
+                        transaction.__exit__(None, None, None)
+                    else:
+                        transaction.__exit__(Exception, Exception('rollback'), None)
+                    result = None
+                else:
+                    if not self.transactions and self.group is None:
+                        self.group = self.database.transaction()
+                        self.group.__enter__()
+                    future.started = time.perf_counter()
+                    try:
+                        with self.database.savepoint():
+                            result = arg()
+                    finally:
+                        future.finished = time.perf_counter()
+            except Exception as e:
+                done.append((future, None, e, self.group is not None))
+            else:
+                done.append((future, result, None, self.group is not None))
+        self.commit_group(done)
+
+    def commit_group(self, done):
+        error = None
+        if self.group is not None:
+            group, self.group = self.group, None
+            try:
+                group.__exit__(None, None, None)
+                self.commits += 1
+            except Exception as e:
+                logger.exception('Group commit failed')
+                error = e
+                self.database.rollback()
+        for future, result, exception, in_group in done:
+            if error is not None and in_group:
+                result, exception = None, error
+            try:
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
+            except concurrent.futures.InvalidStateError:
+                pass
+        done.clear()
@@ -5,6 +5,7 @@ import pytest
 import random
 
 from xanmel import Xanmel, ChatUser
+from xanmel.db import XanmelDB, database_proxy
 
 
 @pytest.fixture()
@@ -57,7 +58,28 @@ def xanmel(event_loop, mocker):
     xanmel.db.es = None
     mocker.patch.object(xanmel, 'setup_event_generators')
     xanmel.load_modules()
-    return xanmel
+    yield xanmel
+    workers = xanmel.bus.stop()
+    for module in xanmel.modules.values():
+        for task in module.tasks:
+            task.cancel()
+            workers.append(task)
+    if workers:
+        event_loop.run_until_complete(asyncio.gather(*workers, return_exceptions=True))
+
+
+@pytest.fixture
+def sqlite_xanmel_db(event_loop, tmpdir):
+    db = XanmelDB('sqlite:///%s' % tmpdir.join('xanmel.db'))
+    yield db
+    db.teardown(event_loop)
+    database_proxy.initialize(None)
+
+
+@pytest.fixture
+def xonotic_db(sqlite_xanmel_db):
+    sqlite_xanmel_db.create_tables('xanmel.modules.xonotic')
+    return sqlite_xanmel_db
 
 
 @pytest.fixture
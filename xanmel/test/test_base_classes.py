@@ -1,7 +1,7 @@
 import asyncio
 import asynctest
 
-from xanmel import Xanmel
+from xanmel import Xanmel, Handler
 from xanmel.modules.irc.events import MentionMessage
 from xanmel.modules.irc.handlers import MentionMessageHandler
 from xanmel.modules.irc.actions import ChannelMessage
@@ -48,8 +48,7 @@ def test_event(xanmel, mocker):
         i.handle = asynctest.CoroutineMock()
     event = MentionMessage(irc_module)
     event.fire()
-    pending = asyncio.all_tasks(loop=irc_module.loop)
-    xanmel.loop.run_until_complete(asyncio.gather(*pending))
+    xanmel.loop.run_until_complete(xanmel.bus.join())
     for i in handlers:
         assert i.handle.call_count == 1
 
@@ -62,3 +61,43 @@ def test_run_action(xanmel, mocker):
     xanmel.loop.run_until_complete(h.run_action(ChannelMessage, message='test'))
     assert a.run.call_count == 1
     assert a.run.call_args[1] == {'message': 'test'}
+
+
+def test_event_dispatch(xanmel, mocker):
+    irc_module = xanmel.modules['xanmel.modules.irc.IRCModule']
+    calls = []
+
+    class SyncHandler(Handler):
+        events = [MentionMessage]
+        synchronous = True
+
+        async def handle(self, event):
+            calls.append('sync')
+
+    class AsyncHandler(Handler):
+        events = [MentionMessage]
+
+        async def handle(self, event):
+            await asyncio.sleep(0)
+            calls.append('async')
+
+    xanmel.handlers[MentionMessage] = [AsyncHandler(irc_module), SyncHandler(irc_module), AsyncHandler(irc_module)]
+    # The queue workers are started with the first event of its type, then no tasks are created per event
+    xanmel.bus.get_queue(MentionMessage)
+    create_task = mocker.spy(xanmel.loop, 'create_task')
+    MentionMessage(irc_module).fire()
+    assert calls == ['sync']
+    xanmel.loop.run_until_complete(xanmel.bus.join())
+    # Only the task run_until_complete wraps join() in
+    assert create_task.call_count == 1
+    assert calls == ['sync', 'async', 'async']
+
+
+def test_startup_phases(xanmel):
+    phases = [i[0] for i in xanmel.startup_phases]
+    assert phases[:2] == ['config', 'db']
+    assert 'xanmel.modules.irc.IRCModule: import' in phases
+    assert phases[-1] == 'after load hooks'
+    assert xanmel._geoip is None
+    assert xanmel.geoip is xanmel.geoip
+    assert xanmel.startup_phases[-1][0] == 'geoip'
@@ -0,0 +1,111 @@
+import asyncio
+
+from xanmel import Handler
+from xanmel.modules.irc.events import MentionMessage
+from xanmel.modules.xonotic.events import NewPlayerActive
+
+
+class SlowHandler(Handler):
+    events = [MentionMessage, NewPlayerActive]
+    running = 0
+    max_running = 0
+
+    async def handle(self, event):
+        SlowHandler.running += 1
+        SlowHandler.max_running = max(SlowHandler.max_running, SlowHandler.running)
+        # asyncio.sleep may be mocked by other tests
+        done = asyncio.get_event_loop().create_future()
+        asyncio.get_event_loop().call_later(0.01, done.set_result, None)
+        await done
+        SlowHandler.running -= 1
+
+
+def test_drop_oldest(xanmel, irc_module):
+    xanmel.bus.config = {'queue_size': 2, 'workers': 1, 'overflow': 'drop_oldest'}
+    xanmel.handlers[MentionMessage] = [SlowHandler(irc_module)]
+    events = [MentionMessage(irc_module, message=str(i)) for i in range(5)]
+    for i in events:
+        xanmel.bus.publish_nowait(i)
+    queue = xanmel.bus.queues[MentionMessage]
+    assert list(queue.events) == events[-2:]
+    xanmel.loop.run_until_complete(xanmel.bus.join())
+    stats = xanmel.bus.stats()['xanmel.modules.irc.events.MentionMessage']
+    assert stats['dropped'] == 3
+    assert stats['processed'] == 2
+    assert stats['depth'] == 0
+    text = xanmel.metrics.render()
+    assert '# TYPE xanmel_event_queue_dropped_total counter\n' in text
+    assert 'xanmel_event_queue_dropped_total{event="xanmel.modules.irc.events.MentionMessage"} 3\n' in text
+    assert 'xanmel_event_queue_max_depth{event="xanmel.modules.irc.events.MentionMessage"} 2\n' in text
+
+
+def test_coalesce(xanmel, xon_module):
+    xanmel.bus.config = {'events': {'NewPlayerActive': {'queue_size': 1, 'overflow': 'coalesce'}}}
+    xanmel.handlers[NewPlayerActive] = [SlowHandler(xon_module)]
+    server = xon_module.servers[0]
+    events = [NewPlayerActive(xon_module, server=server) for _ in range(3)]
+    for i in events:
+        xanmel.bus.publish_nowait(i)
+    queue = xanmel.bus.queues[NewPlayerActive]
+    assert list(queue.events) == events[-1:]
+    assert queue.coalesced == 2
+    assert queue.dropped == 0
+
+
+def test_block_and_concurrency(xanmel, irc_module):
+    xanmel.bus.config = {'queue_size': 1, 'workers': 4, 'handler_concurrency': {'SlowHandler': 2}}
+    xanmel.handlers[MentionMessage] = [SlowHandler(irc_module)]
+
+    async def produce():
+        for i in range(10):
+            await xanmel.bus.publish(MentionMessage(irc_module, message=str(i)))
+        await xanmel.bus.join()
+
+    xanmel.loop.run_until_complete(produce())
+    stats = xanmel.bus.stats()['xanmel.modules.irc.events.MentionMessage']
+    assert stats['processed'] == 10
+    assert stats['dropped'] == 0
+    assert stats['max_depth'] == 1
+    assert SlowHandler.max_running == 2
+
+
+def test_block_nowait(xanmel, irc_module):
+    xanmel.bus.config = {'queue_size': 2, 'workers': 1}
+    received = []
+
+    class RecordingHandler(Handler):
+        events = [MentionMessage]
+
+        async def handle(self, event):
+            received.append(event)
+
+    xanmel.handlers[MentionMessage] = [RecordingHandler(irc_module)]
+    tasks = len(asyncio.all_tasks(xanmel.loop))
+    events = [MentionMessage(irc_module, message=str(i)) for i in range(1000)]
+    for i in events:
+        xanmel.bus.publish_nowait(i)
+    queue = xanmel.bus.queues[MentionMessage]
+    # The queue's worker is the only new task
+    assert len(asyncio.all_tasks(xanmel.loop)) == tasks + 1
+    assert len(queue.events) == 2
+    assert len(queue.backlog) == 2
+    xanmel.loop.run_until_complete(xanmel.bus.join())
+    assert received == events[:2] + events[-2:]
+    stats = xanmel.bus.stats()['xanmel.modules.irc.events.MentionMessage']
+    assert stats['dropped'] == 996
+    assert stats['processed'] == 4
+    assert stats['waiting'] == 0
+
+
+def test_sequential_handlers(xanmel, irc_module):
+    xanmel.bus.config = {'workers': 2}
+    SlowHandler.max_running = 0
+    xanmel.handlers[MentionMessage] = [SlowHandler(irc_module), SlowHandler(irc_module)]
+    xanmel.bus.publish_nowait(MentionMessage(irc_module, message='hello'))
+    xanmel.loop.run_until_complete(xanmel.bus.join())
+    assert SlowHandler.max_running == 1
+    # Two events are handled by two workers at once
+    for i in range(2):
+        xanmel.bus.publish_nowait(MentionMessage(irc_module, message=str(i)))
+    xanmel.loop.run_until_complete(xanmel.bus.join())
+    assert SlowHandler.max_running == 2
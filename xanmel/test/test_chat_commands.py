@@ -225,3 +225,26 @@ def test_version(xanmel, mocker, dummy_chat_user, irc_module):
     assert chat_user.public_reply.call_count == 1
     if not chat_user.public_reply.call_args[0][0].startswith('Unknown'):
         assert re.match('^\d+\.\d+(a|b|rc)\d+$', chat_user.public_reply.call_args[0][0])
+
+
+def test_help_cache(xanmel, dummy_chat_user, irc_module):
+    chat_user = dummy_chat_user(module=irc_module, name='test')
+    chat_user.botnick = irc_module.config['nick']
+    xanmel.loop.run_until_complete(xanmel.cmd_root.run(chat_user, 'help', is_private=True))
+    assert list(xanmel.cmd_root.help_cache) == [('', True)]
+    assert 'cached_cmd' not in chat_user.private_reply.call_args[0][0]
+
+    class CachedContainer(CommandContainer):
+        help_text = 'cached container'
+
+    class CachedCommand(ChatCommand):
+        parent = CachedContainer
+        prefix = 'cached_cmd'
+        help_text = 'cached command'
+
+    xanmel.cmd_root.register_container(CachedContainer(), prefix='')
+    assert xanmel.cmd_root.help_cache == {}
+    xanmel.loop.run_until_complete(xanmel.cmd_root.run(chat_user, 'help', is_private=True))
+    assert 'cached_cmd' in chat_user.private_reply.call_args[0][0]
+    xanmel.loop.run_until_complete(xanmel.cmd_root.run(chat_user, 'help cached_cmd', is_private=True))
+    assert chat_user.private_reply.call_args[0][0] == 'cached_cmd: cached command'
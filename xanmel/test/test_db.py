@@ -0,0 +1,217 @@
+import asyncio
+import logging
+
+import asynctest
+import peewee
+import pytest
+
+from xanmel.db import IdentityMap, XanmelDB, database_proxy
+from xanmel.metrics import Metrics
+from xanmel.modules.xonotic.models import CTSRecord, Map, MapRating, Player, PlayerIdentification, Server
+from xanmel.querylog import InstrumentedManager, QueryLog, pool_wait, query_label
+
+
+@pytest.fixture
+def sqlite_db():
+    db = peewee.SqliteDatabase(':memory:')
+    database_proxy.initialize(db)
+    yield db
+    database_proxy.initialize(None)
+
+
+def up_db(sqlite_db, **write_behind):
+    db = XanmelDB(None, write_behind)
+    db.db = sqlite_db
+    db.mgr = asynctest.MagicMock()
+    db.mgr.pool_stats.return_value = None
+    db.mgr.execute = asynctest.CoroutineMock()
+    return db
+
+
+def test_write_behind(event_loop, sqlite_db):
+    db = up_db(sqlite_db, batch_size=3)
+    db.insert(MapRating, map=1, player=1, vote=1, message='+')
+    db.insert(MapRating, map=1, player=2, vote=-1, message='-')
+    db.insert(CTSRecord, server=1, map=1, time=10, nickname='a', nickname_nocolors='a')
+    assert db.pending_rows == 3
+    rows = db.pending[MapRating, ('map', 'message', 'player', 'timestamp', 'vote')]
+    assert rows[0]['timestamp'] is not None
+    future = event_loop.create_future()
+    event_loop.call_soon(future.set_result, None)
+    event_loop.run_until_complete(future)
+    assert db.mgr.execute.call_count == 2
+    assert db.pending_rows == 0
+    assert db.flushed_rows == 3
+    assert db.flushes == 2
+
+
+def test_write_behind_teardown(event_loop, sqlite_db):
+    db = up_db(sqlite_db)
+    db.insert(MapRating, map=1, player=1, vote=1, message='+')
+    assert db.mgr.execute.call_count == 0
+    db.teardown(event_loop)
+    assert db.mgr.execute.call_count == 1
+    assert ('xanmel_db_pending_rows', 'gauge', 'Rows waiting in the write-behind queue', 0) in db.collect_metrics()
+
+
+def test_write_behind_failure(event_loop, sqlite_db):
+    db = up_db(sqlite_db)
+    db.mgr.execute.side_effect = Exception('connection lost')
+    db.insert(MapRating, map=1, player=1, vote=1, message='+')
+    event_loop.run_until_complete(db.flush())
+    assert db.failed_rows == 1
+    assert not db.pending
+
+
+def test_write_behind_retry(event_loop, sqlite_db):
+    db = up_db(sqlite_db)
+    # The batch and then the second row fail, the first and third rows are retried alone
+    db.mgr.execute.side_effect = [Exception('batch'), None, Exception('bad row'), None]
+    for vote in [1, 2, 3]:
+        db.insert(MapRating, map=1, player=1, vote=vote, message='+')
+    event_loop.run_until_complete(db.flush())
+    assert db.mgr.execute.call_count == 4
+    assert db.failed_rows == 1
+    assert db.flushed_rows == 2
+
+
+def test_db_down():
+    db = XanmelDB(None)
+    db.insert(MapRating, map=1, player=1, vote=1, message='+')
+    assert not db.pending
+
+
+def test_identity_map(event_loop, sqlite_db):
+    db = up_db(sqlite_db)
+    server = Server(id=1, name='test')
+    maps = [Map(id=1, server=server, name='dance'), Map(id=2, server=server, name='afterslime')]
+    db.mgr.get_or_create = asynctest.CoroutineMock(side_effect=[(maps[0], True), (maps[1], False)])
+    assert event_loop.run_until_complete(db.get_or_create(Map, server=server, name='dance')) == (maps[0], True)
+    assert event_loop.run_until_complete(db.get_or_create(Map, server=server, name='dance')) == (maps[0], False)
+    assert db.mgr.get_or_create.call_count == 1
+    assert db.identity_map.get(Map, server=1, name='dance') is maps[0]
+    event_loop.run_until_complete(db.get_or_create(Map, server=server, name='afterslime'))
+    assert db.mgr.get_or_create.call_count == 2
+    assert (db.identity_map.hits, db.identity_map.misses) == (2, 2)
+
+
+def test_identity_map_eviction():
+    identity_map = IdentityMap(size=2)
+    players = [Player(id=i, raw_nickname=str(i)) for i in range(3)]
+    for i in players:
+        identity_map.put(i, raw_nickname=i.raw_nickname)
+    assert identity_map.get(Player, raw_nickname='0') is None
+    assert identity_map.get(Player, raw_nickname='1') is players[1]
+    identity_map.put(players[0], raw_nickname='0')
+    assert identity_map.get(Player, raw_nickname='2') is None
+    assert identity_map.get(Player, raw_nickname='1') is players[1]
+
+
+def test_sqlite(event_loop, xonotic_db):
+    db = xonotic_db
+    mgr = db.mgr
+    assert db.is_sqlite
+    assert db.db.journal_mode == 'wal'
+    server = event_loop.run_until_complete(mgr.create(Server, name='test', config_name='test'))
+    map_obj, created = event_loop.run_until_complete(db.get_or_create(Map, server=server, name='dance'))
+    assert created and map_obj.id
+    assert event_loop.run_until_complete(mgr.get(Map, server=server, name='dance')).id == map_obj.id
+    server.name = 'renamed'
+    event_loop.run_until_complete(mgr.update(server, only=[Server.name]))
+    assert event_loop.run_until_complete(mgr.get(Server.select().where(Server.id == server.id))).name == 'renamed'
+    with pytest.raises(Map.DoesNotExist):
+        event_loop.run_until_complete(mgr.get(Map, name='afterslime'))
+
+
+def test_sqlite_group_commit(event_loop, xonotic_db):
+    db = xonotic_db
+    server = event_loop.run_until_complete(db.mgr.create(Server, name='test', config_name='test'))
+    map_obj = event_loop.run_until_complete(db.mgr.create(Map, server=server, name='dance'))
+    player = event_loop.run_until_complete(db.mgr.create(Player, raw_nickname='a', nickname='a'))
+    commits = db.mgr.commits
+    for i in range(20):
+        db.insert(MapRating, map=map_obj, player=player, vote=1, message='+')
+    bad = db.mgr.create(Map, server=server, name=None)
+    servers = [db.mgr.create(Server, name=str(i), config_name=str(i)) for i in range(10)]
+    results = event_loop.run_until_complete(asyncio.gather(db.flush(), bad, *servers, return_exceptions=True))
+    assert isinstance(results[1], peewee.IntegrityError)
+    assert db.flushed_rows == 20
+    assert db.mgr.commits - commits < 12
+    assert event_loop.run_until_complete(db.mgr.count(MapRating.select())) == 20
+    assert event_loop.run_until_complete(db.mgr.count(Server.select())) == 11
+
+
+def test_sqlite_atomic(event_loop, xonotic_db):
+    mgr = xonotic_db.mgr
+
+    async def fail():
+        async with mgr.atomic():
+            await mgr.create(Server, name='first', config_name='first')
+            async with mgr.atomic():
+                await mgr.create(Server, name='second', config_name='second')
+            raise ValueError
+
+    with pytest.raises(ValueError):
+        event_loop.run_until_complete(fail())
+    assert event_loop.run_until_complete(mgr.count(Server.select())) == 0
+    assert mgr.owner is None and not mgr.lock.locked()
+
+
+def test_query_log(event_loop, xonotic_db, caplog):
+    db = xonotic_db
+    server = event_loop.run_until_complete(db.mgr.create(Server, name='test', config_name='test'))
+    event_loop.run_until_complete(db.mgr.execute(Server.select().where(Server.id == server.id)))
+    event_loop.run_until_complete(db.mgr.execute(Server.update(name='x').where(Server.id == server.id)))
+    queries = db.query_log.queries
+    assert set(queries) == {'Server.insert', 'Server.select', 'Server.update'}
+    assert queries['Server.select'].count == 1
+    assert db.query_log.pool_waits['Server.select'].count == 1
+    db.query_log.slow_threshold = 0
+    with caplog.at_level(logging.WARNING, logger='xanmel.querylog'):
+        event_loop.run_until_complete(db.mgr.count(Server.select()))
+    assert db.query_log.slow_queries == 1
+    assert 'Slow query Server.count' in caplog.text
+    assert 'SELECT' in caplog.text
+    metrics = Metrics(None, {})
+    metrics.histograms.extend(db.query_log.histograms())
+    text = metrics.render()
+    assert 'xanmel_db_query_seconds_count{query="Server.select"} 1\n' in text
+    assert 'xanmel_db_pool_wait_seconds_count{query="Server.count"} 1\n' in text
+
+
+def test_instrumented_manager(event_loop, mocker):
+    query_log = QueryLog(slow_threshold=10)
+    mgr = InstrumentedManager(peewee.SqliteDatabase(':memory:'), query_log)
+
+    async def execute(query):
+        pool_wait.set(pool_wait.get() + 0.25)
+        return 42
+
+    mocker.patch('peewee_async.Manager.execute', side_effect=execute)
+    assert event_loop.run_until_complete(mgr.execute(Map.delete())) == 42
+    assert query_log.queries['Map.delete'].count == 1
+    assert query_log.pool_waits['Map.delete'].sum == 0.25
+    assert query_log.slow_queries == 0
+    assert query_label(Map.select(), 'count') == 'Map.count'
+
+
+def test_write_behind_upsert(event_loop, xonotic_db):
+    db = xonotic_db
+
+    def join(ip_address, nickname):
+        fields = {'crypto_idfp': 'key', 'ip_address': ip_address, 'raw_nickname': nickname, 'nickname': nickname}
+        key_hash = PlayerIdentification.key_hash_for(fields)
+        db.upsert(PlayerIdentification, key_hash, key_hash=key_hash, **fields)
+
+    join('1', 'a')
+    join('1', 'b')
+    join('1', 'a')
+    assert db.pending_rows == 2
+    event_loop.run_until_complete(db.flush())
+    join('1', 'a')
+    event_loop.run_until_complete(db.flush())
+    rows = event_loop.run_until_complete(db.mgr.execute(
+        PlayerIdentification.select().order_by(PlayerIdentification.id)))
+    assert [(i.raw_nickname, i.seen_count) for i in rows] == [('a', 3), ('b', 1)]
+    assert rows[0].last_seen > rows[0].first_seen
+    assert db.flushed_rows == 3
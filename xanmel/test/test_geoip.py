@@ -0,0 +1,20 @@
+def test_geoip_cache(xanmel):
+    xanmel.config['settings']['geoip_cache_size'] = 2
+    geoip = xanmel.geoip
+    assert geoip.city('45.32.238.1').country.iso_code == 'NL'
+    assert geoip.city('45.32.238.1').country.iso_code == 'NL'
+    assert geoip.city('not an ip') is None
+    assert geoip.city('127.0.0.1') is None
+    assert (geoip.hits, geoip.misses) == (1, 3)
+    assert list(geoip.cache) == ['not an ip', '127.0.0.1']
+
+    calls = []
+
+    def country(response):
+        calls.append(response)
+        return response and response.country.iso_code
+
+    assert geoip.memoized('45.32.238.1', country) == 'NL'
+    assert geoip.memoized('45.32.238.1', country) == 'NL'
+    assert len(calls) == 1
+    assert 'xanmel_geoip_cache_hits_total 2\n' in xanmel.metrics.render()
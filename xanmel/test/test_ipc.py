@@ -0,0 +1,129 @@
+import asyncio
+import copy
+import os
+
+import asynctest
+import yaml
+
+from xanmel import Xanmel
+from xanmel.ipc import MAX_WRITE_BUFFER, Channel, RemoteAction, RemoteCommandContainer, RemoteModule, Supervisor, \
+    Worker
+from xanmel.modules.irc import IRCChatUser
+from xanmel.modules.irc.actions import ChannelMessage
+from xanmel.modules.irc.events import ChannelMessage as IRCChannelMessage
+
+
+def write_config(tmpdir, servers):
+    with open('xanmel.yaml') as f:
+        config = yaml.safe_load(f)
+    server = config['modules']['xanmel.modules.xonotic.XonoticModule']['servers'][0]
+    config['modules']['xanmel.modules.xonotic.XonoticModule']['servers'] = []
+    for i in range(servers):
+        server = copy.deepcopy(server)
+        server.update(name='Server %s' % i, unique_id=i, cmd_prefix='xon%s' % i, raw_log=None)
+        config['modules']['xanmel.modules.xonotic.XonoticModule']['servers'].append(server)
+    config['settings']['sharding']['workers'] = 2
+    path = os.path.join(str(tmpdir), 'xanmel.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def wait(loop, condition):
+    async def poll():
+        while not condition():
+            future = loop.create_future()
+            loop.call_later(0.01, future.set_result, None)
+            await future
+
+    loop.run_until_complete(asyncio.wait_for(poll(), 5))
+
+
+def test_shard_modules(event_loop, tmpdir):
+    config_path = write_config(tmpdir, 5)
+    xanmel = Xanmel(event_loop, config_path)
+    worker = Worker(xanmel, xanmel.config['settings']['sharding'], 1, 'unused')
+    servers = xanmel.config['modules']['xanmel.modules.xonotic.XonoticModule']['servers']
+    assert [i['unique_id'] for i in servers] == [1, 3]
+    xanmel.load_modules(event_generators=False)
+    assert [i.config['unique_id'] for i in xanmel.modules['xanmel.modules.xonotic.XonoticModule'].servers] == [1, 3]
+    assert isinstance(xanmel.modules['xanmel.modules.irc.IRCModule'], RemoteModule)
+    assert isinstance(xanmel.actions[ChannelMessage], RemoteAction)
+    assert worker.is_local('xanmel.modules.xonotic.XonoticModule')
+    assert not worker.is_local('xanmel.modules.fun.FunModule')
+
+
+def test_supervisor_worker(event_loop, tmpdir, mocker):
+    config_path = write_config(tmpdir, 2)
+    socket_path = os.path.join(str(tmpdir), 'xanmel.sock')
+    supervisor_xanmel = Xanmel(event_loop, config_path)
+    supervisor = Supervisor(supervisor_xanmel, supervisor_xanmel.config['settings']['sharding'], socket_path)
+    supervisor_xanmel.load_modules(event_generators=False)
+    assert 'xanmel.modules.xonotic.XonoticModule' not in supervisor_xanmel.modules
+    irc_module = supervisor_xanmel.modules['xanmel.modules.irc.IRCModule']
+    mocker.patch.object(irc_module, 'send')
+    event_loop.run_until_complete(supervisor.start_server())
+    assert os.stat(socket_path).st_mode & 0o777 == 0o600
+
+    worker_xanmel = Xanmel(event_loop, config_path)
+    worker = Worker(worker_xanmel, worker_xanmel.config['settings']['sharding'], 0, socket_path)
+    worker_xanmel.load_modules(event_generators=False)
+    xon_module = worker_xanmel.modules['xanmel.modules.xonotic.XonoticModule']
+    server = xon_module.servers[0]
+    server.say = mocker.MagicMock()
+    event_loop.run_until_complete(worker.connect())
+    worker.tasks.append(event_loop.create_task(worker.serve(worker.channel)))
+    wait(event_loop, lambda: 'xon0' in supervisor_xanmel.cmd_root.children and worker.channel.event_types)
+    assert isinstance(supervisor_xanmel.cmd_root.children['xon0'], RemoteCommandContainer)
+    assert 'xon1' not in supervisor_xanmel.cmd_root.children
+
+    # IRC events are handled by the worker's servers
+    chat_user = IRCChatUser(irc_module, 'johndoe', irc_user='~johndoe@127.0.0.1')
+    IRCChannelMessage(irc_module, message='hello', nick='johndoe', chat_user=chat_user).fire()
+    wait(event_loop, lambda: server.say.called)
+    assert server.say.call_args[0][0] == 'hello'
+
+    # Actions of the IRC module are run by the supervisor
+    event_loop.run_until_complete(worker_xanmel.actions[ChannelMessage].run(message='from worker'))
+    wait(event_loop, lambda: irc_module.send.called)
+    assert irc_module.send.call_args[1]['message'] == 'from worker'
+
+    # Commands are run by the worker, replies go back to the IRC module
+    irc_module.send.reset_mock()
+    mocker.patch.object(server.command_container, 'run', asynctest.CoroutineMock())
+    event_loop.run_until_complete(supervisor_xanmel.cmd_root.run(chat_user, 'xon0 who'))
+    wait(event_loop, lambda: server.command_container.run.called)
+    user = server.command_container.run.call_args[0][0]
+    assert user.module is worker_xanmel.modules['xanmel.modules.irc.IRCModule']
+    event_loop.run_until_complete(user.reply('pong', is_private=True))
+    wait(event_loop, lambda: irc_module.send.called)
+    assert irc_module.send.call_args[1] == {'target': 'johndoe', 'message': 'pong'}
+
+    worker.stop()
+    wait(event_loop, lambda: not supervisor.channels)
+    assert 'xon0' not in supervisor_xanmel.cmd_root.children
+    supervisor.stop()
+    for xanmel in (supervisor_xanmel, worker_xanmel):
+        event_loop.run_until_complete(asyncio.gather(*xanmel.bus.stop(), return_exceptions=True))
+
+
+def test_channel_write_buffer(event_loop, mocker):
+    writer = mocker.MagicMock()
+    writer.transport.get_write_buffer_size.return_value = 0
+    channel = Channel(None, None, writer)
+    channel.send('reload')
+    assert writer.write.call_count == 1
+    writer.transport.get_write_buffer_size.return_value = MAX_WRITE_BUFFER + 1
+    channel.send('reload')
+    assert writer.write.call_count == 1
+    assert channel.dropped == 1
+
+
+def test_supervisor_socket_dir(event_loop, tmpdir):
+    xanmel = Xanmel(event_loop, write_config(tmpdir, 1))
+    supervisor = Supervisor(xanmel, xanmel.config['settings']['sharding'])
+    assert os.path.dirname(supervisor.socket_path) == supervisor.socket_dir
+    assert os.stat(supervisor.socket_dir).st_mode & 0o777 == 0o700
+    event_loop.run_until_complete(supervisor.start_server())
+    supervisor.stop()
+    assert not os.path.exists(supervisor.socket_dir)
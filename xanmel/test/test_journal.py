@@ -0,0 +1,45 @@
+from xanmel import Handler
+from xanmel.journal import EventJournal, JournalReader, replay
+from xanmel.modules.xonotic.events import ChatMessage
+from xanmel.modules.xonotic.players import Player
+
+
+class RecordingHandler(Handler):
+    events = [ChatMessage]
+
+    async def handle(self, event):
+        self.module.handled.append(event)
+
+
+def test_journal_roundtrip(xanmel, xon_module, tmpdir):
+    path = str(tmpdir.join('events.journal'))
+    server = xon_module.servers[0]
+    player = Player(server, b'^1test', 3, 4, '45.32.238.1')
+    xanmel.handlers[ChatMessage] = []
+    xanmel.journal = EventJournal(path)
+    events = [ChatMessage(xon_module, server=server, message=b'hello %d' % i, player=player) for i in range(3)]
+    for i in events:
+        i.fire()
+    assert xanmel.journal.recorded == 3
+    xanmel.journal.close()
+    xanmel.journal = None
+
+    records = list(JournalReader(path, xanmel))
+    assert len(records) == 3
+    for (event_type, timestamp, module, properties), event in zip(records, events):
+        assert event_type is ChatMessage
+        assert timestamp == event.timestamp.timestamp()
+        assert module is xon_module
+        assert properties['server'] is server
+        assert properties['message'] == event.properties['message']
+    replayed_player = records[0][3]['player']
+    assert replayed_player.nickname == b'^1test'
+    assert server.players.players_by_number1[3] is replayed_player
+    assert records[1][3]['player'] is replayed_player
+
+    xon_module.handled = []
+    xanmel.handlers[ChatMessage] = [RecordingHandler(xon_module)]
+    count, elapsed = xanmel.loop.run_until_complete(replay(xanmel, path))
+    assert count == 3
+    assert [i.properties['message'] for i in xon_module.handled] == [b'hello 0', b'hello 1', b'hello 2']
+    assert [i.timestamp for i in xon_module.handled] == [i.timestamp for i in events]
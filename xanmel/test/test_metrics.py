@@ -0,0 +1,57 @@
+import asynctest
+
+from xanmel import Handler
+from xanmel.metrics import Histogram
+from xanmel.modules.irc.events import MentionMessage
+
+
+class CountingHandler(Handler):
+    events = [MentionMessage]
+
+    async def handle(self, event):
+        pass
+
+
+def test_histogram():
+    h = Histogram(buckets=(0.1, 1, 10))
+    for i in [0.05, 0.05, 0.5, 20]:
+        h.observe(i)
+    assert h.counts == [2, 1, 0, 1]
+    assert h.count == 4
+    assert h.max == 20
+    assert h.quantile(0.5) == 0.1
+    assert h.quantile(0.75) == 1
+    assert h.quantile(1) == 20
+    assert list(h.cumulative()) == [(0.1, 2), (1, 3), (10, 3), (float('inf'), 4)]
+
+
+def test_handler_metrics(xanmel, irc_module, dummy_chat_user):
+    xanmel.handlers[MentionMessage] = [CountingHandler(irc_module)]
+    for i in range(3):
+        MentionMessage(irc_module, message=str(i)).fire()
+    xanmel.loop.run_until_complete(xanmel.bus.join())
+    metrics = xanmel.metrics
+    assert metrics.events['xanmel.modules.irc.events.MentionMessage'] == 3
+    assert metrics.handlers['xanmel.test.test_metrics.CountingHandler'].count == 3
+    text = metrics.render()
+    assert 'xanmel_handler_seconds_count{handler="xanmel.test.test_metrics.CountingHandler"} 3\n' in text
+    assert 'xanmel_handler_seconds_bucket{handler="xanmel.test.test_metrics.CountingHandler",le="+Inf"} 3\n' in text
+    assert 'xanmel_events_total{event="xanmel.modules.irc.events.MentionMessage"} 3\n' in text
+
+    user = dummy_chat_user(irc_module, 'test')
+    user.public_reply.reset_mock()
+    xanmel.loop.run_until_complete(xanmel.cmd_root.run(user, 'metrics'))
+    replies = [i[0][0] for i in user.public_reply.call_args_list]
+    assert replies[0].startswith('Handler CountingHandler: n=3 ')
+    assert replies[-1] == 'Events fired: 3'
+
+    # Private replies are sent at once
+    user.private_replies = asynctest.CoroutineMock()
+    xanmel.loop.run_until_complete(xanmel.cmd_root.run(user, 'metrics', is_private=True))
+    assert user.private_replies.call_count == 1
+    assert user.private_replies.call_args[0][0] == replies
+
+    user.dummy_admin = False
+    user.public_reply.reset_mock()
+    xanmel.loop.run_until_complete(xanmel.cmd_root.run(user, 'metrics'))
+    assert user.public_reply.call_args[0][0] == 'Access Denied'
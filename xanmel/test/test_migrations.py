@@ -0,0 +1,72 @@
+import datetime
+
+from xanmel.migrations import AppliedMigration, has_column, migrate, pending_migrations
+from xanmel.modules.xonotic import bench_identification
+from xanmel.modules.xonotic.models import PlayerIdentification
+
+XONOTIC = 'xanmel.modules.xonotic'
+MIGRATIONS = [XONOTIC + '.0001_player_identification_indexes', XONOTIC + '.0002_compact_player_identification']
+
+LEGACY_TABLE = '''
+CREATE TABLE playeridentification (
+    id INTEGER NOT NULL PRIMARY KEY, server_id INTEGER, player_id INTEGER, crypto_idfp VARCHAR(255),
+    stats_id INTEGER, ip_address VARCHAR(255) NOT NULL, raw_nickname VARCHAR(255) NOT NULL,
+    nickname VARCHAR(255) NOT NULL, timestamp DATETIME NOT NULL, country VARCHAR(3), city VARCHAR(255),
+    subdivisions VARCHAR(255), continent VARCHAR(255), latitude REAL, longitude REAL, asn VARCHAR(255),
+    asn_cidr VARCHAR(255), asn_country_code VARCHAR(3), network_name VARCHAR(255), network_cidr VARCHAR(255),
+    network_country_code VARCHAR(3))
+'''
+
+
+def index_names(db):
+    return {i.name for i in db.run_sync(lambda: db.db.get_indexes('playeridentification'))}
+
+
+def test_new_tables(sqlite_xanmel_db):
+    db = sqlite_xanmel_db
+    db.create_tables(XONOTIC)
+    assert db.run_sync(lambda: [i.name for i in AppliedMigration.select()]) == MIGRATIONS
+    assert pending_migrations(db, [XONOTIC, 'xanmel.modules.irc']) == []
+    assert index_names(db) == {'playeridentification_%s' % i for i in [
+        'crypto_idfp_last_seen', 'ip_address_last_seen', 'nickname_last_seen', 'last_seen', 'key_hash', 'player_id',
+        'server_id']}
+
+
+def test_migrate_legacy_table(sqlite_xanmel_db):
+    db = sqlite_xanmel_db
+    db.run_sync(lambda: db.db.execute_sql(LEGACY_TABLE))
+    for column in ['crypto_idfp', 'country', 'latitude']:
+        db.run_sync(lambda: db.db.execute_sql('CREATE INDEX playeridentification_%s ON playeridentification (%s)' %
+                                              (column, column)))
+    started = datetime.datetime(2020, 1, 1)
+    for i, (key, ip, server) in enumerate([('a', '1', 1), ('b', '1', 1), ('a', '1', 2), ('a', '2', 1), ('a', '1', 3)]):
+        db.run_sync(lambda: db.db.execute_sql(
+            "INSERT INTO playeridentification (server_id, crypto_idfp, ip_address, raw_nickname, nickname, timestamp) "
+            "VALUES (?, ?, ?, 'n', 'n', ?)", (server, key, ip, started + datetime.timedelta(days=i))))
+    assert [i[0] for i in pending_migrations(db, [XONOTIC])] == MIGRATIONS
+    # Migrations are not applied at startup, only the missing tables are created
+    db.create_tables(XONOTIC)
+    assert [i[0] for i in pending_migrations(db, [XONOTIC])] == MIGRATIONS
+    assert db.run_sync(lambda: has_column(db.db, 'playeridentification', 'timestamp'))
+    assert 'map_rating' in db.run_sync(db.db.get_tables)
+    assert migrate(db, [XONOTIC]) == MIGRATIONS
+    db.create_tables(XONOTIC)
+    rows = db.run_sync(lambda: list(PlayerIdentification.select().order_by(PlayerIdentification.id)))
+    assert [(i.crypto_idfp, i.ip_address, i.server_id, i.seen_count, i.first_seen.day, i.last_seen.day)
+            for i in rows] == [('b', '1', 1, 1, 2, 2), ('a', '2', 1, 1, 4, 4), ('a', '1', 3, 3, 1, 5)]
+    assert rows[0].key_hash == PlayerIdentification.key_hash_for(
+        {'crypto_idfp': 'b', 'ip_address': '1', 'raw_nickname': 'n'})
+    assert 'playeridentification_country' not in index_names(db)
+    assert 'playeridentification_key_hash' in index_names(db)
+    assert migrate(db, [XONOTIC]) == []
+
+
+def test_bench_identification(sqlite_xanmel_db):
+    db = sqlite_xanmel_db
+    db.create_tables(XONOTIC)
+    result = db.run_sync(lambda: bench_identification.benchmark(rows=200, batch_size=50, lookups=5))
+    assert list(result['before']) == list(result['after']) == [
+        'rows', 'inserts_per_second', 'crypto_idfp_lookup_ms', 'ip_address_lookup_ms', 'nickname_lookup_ms']
+    assert result['before']['rows'] == 200
+    assert result['after']['rows'] < 200
+    assert 'bench_identification_before' not in db.run_sync(db.db.get_tables)
@@ -0,0 +1,59 @@
+import time
+
+from xanmel import ChatConfirmations
+from xanmel.ratelimit import RateLimiter
+
+
+def test_token_bucket(mocker):
+    time_mock = mocker.patch.object(time, 'time')
+    time_mock.return_value = 1000
+    limiter = RateLimiter(burst=2, rate=0.5, penalty=60)
+    assert limiter.allow('a')
+    assert limiter.allow('a')
+    time_mock.return_value = 1002
+    assert limiter.allow('a')
+    assert not limiter.allow('a')
+    time_mock.return_value = 1050
+    assert not limiter.allow('a')
+    assert limiter.allow('b')
+    time_mock.return_value = 1063
+    assert limiter.allow('a')
+
+
+def test_eviction(mocker):
+    time_mock = mocker.patch.object(time, 'time')
+    time_mock.return_value = 1000
+    limiter = RateLimiter(burst=2, rate=1, penalty=60, max_users=3)
+    for i in range(5):
+        limiter.allow(i)
+    assert list(limiter.buckets) == [2, 3, 4]
+    time_mock.return_value = 1001
+    limiter.allow(2)
+    assert list(limiter.buckets) == [3, 4, 2]
+    time_mock.return_value = 1003
+    limiter.allow(5)
+    assert list(limiter.buckets) == [5]
+
+
+def test_user_type_limits(xanmel):
+    xanmel.config['settings']['throttling'] = {'burst': 3, 'user_types': {'xonotic': {'burst': 1, 'penalty': 5}}}
+    assert xanmel.cmd_root.get_rate_limiter('irc').burst == 3
+    assert xanmel.cmd_root.get_rate_limiter('irc').penalty == 60
+    assert xanmel.cmd_root.get_rate_limiter('xonotic').burst == 1
+    assert xanmel.cmd_root.get_rate_limiter('xonotic').penalty == 5
+
+
+def test_confirmations_expire(xanmel, mocker, dummy_chat_user, irc_module):
+    time_mock = mocker.patch.object(time, 'time')
+    time_mock.return_value = 1000
+    confirmations = ChatConfirmations()
+    users = [dummy_chat_user(irc_module, str(i)) for i in range(2)]
+    xanmel.loop.run_until_complete(confirmations.ask(users[0], 'Sure?', 'yes', 'no'))
+    time_mock.return_value = 1100
+    xanmel.loop.run_until_complete(confirmations.ask(users[1], 'Sure?', 'yes', 'no'))
+    assert users[0].unique_id() in confirmations
+    assert confirmations[users[0].unique_id()] == ('yes', 'no')
+    time_mock.return_value = 1150
+    assert users[0].unique_id() not in confirmations
+    assert users[1].unique_id() in confirmations
+    assert len(confirmations.confirmations) == 1
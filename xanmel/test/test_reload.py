@@ -0,0 +1,80 @@
+from xanmel.modules.irc.actions import ChannelMessage
+from xanmel.modules.irc.events import MentionMessage
+
+
+def use_config(xanmel, tmpdir, text):
+    config = tmpdir.join('xanmel.yaml')
+    config.write(text)
+    xanmel.config_path = str(config)
+
+
+def test_reload_unchanged(xanmel, tmpdir):
+    modules = dict(xanmel.modules)
+    use_config(xanmel, tmpdir, open('xanmel.yaml').read())
+    assert xanmel.loop.run_until_complete(xanmel.reload()) == []
+    assert xanmel.modules == modules
+
+
+def test_reload_servers(xanmel, xon_module, irc_module, tmpdir):
+    server = xon_module.servers[0]
+    text = open('xanmel.yaml').read()
+    second = text[text.index('      - name: Local Xonotic Server'):text.index('  xanmel.modules.fun.FunModule')]
+    second = second.replace('Local Xonotic Server', 'Second Server').replace('unique_id: 1', 'unique_id: 2')\
+        .replace('cmd_prefix: xon', 'cmd_prefix: xon2')
+    text = text.replace('  xanmel.modules.fun.FunModule', second + '  xanmel.modules.fun.FunModule')
+    use_config(xanmel, tmpdir, text)
+    assert xanmel.loop.run_until_complete(xanmel.reload()) == [
+        'xanmel.modules.xonotic.XonoticModule: added server Second Server']
+    assert xanmel.modules['xanmel.modules.xonotic.XonoticModule'] is xon_module
+    assert xanmel.modules['xanmel.modules.irc.IRCModule'] is irc_module
+    assert xon_module.servers[0] is server
+    assert xanmel.cmd_root.children['xon2'] is xon_module.servers[1].command_container
+
+    use_config(xanmel, tmpdir, text.replace("out_prefix: 'exe > '", "out_prefix: 'new > '", 1))
+    assert xanmel.loop.run_until_complete(xanmel.reload()) == [
+        'xanmel.modules.xonotic.XonoticModule: reloaded server Local Xonotic Server']
+    new_server = xon_module.servers[0]
+    assert new_server is not server
+    assert new_server.config['out_prefix'] == 'new > '
+    assert xanmel.cmd_root.children['xon'] is new_server.command_container
+    assert xon_module.config['servers'][0]['out_prefix'] == 'new > '
+
+    use_config(xanmel, tmpdir, open('xanmel.yaml').read())
+    assert xanmel.loop.run_until_complete(xanmel.reload()) == [
+        'xanmel.modules.xonotic.XonoticModule: reloaded server Local Xonotic Server',
+        'xanmel.modules.xonotic.XonoticModule: removed server Second Server']
+    assert len(xon_module.servers) == 1
+    assert 'xon2' not in xanmel.cmd_root.children
+
+
+def test_reload_module(xanmel, irc_module, tmpdir):
+    use_config(xanmel, tmpdir, open('xanmel.yaml').read().replace("channel: '#xanmel'", "channel: '#other'"))
+    assert xanmel.loop.run_until_complete(xanmel.reload()) == ['reloaded xanmel.modules.irc.IRCModule']
+    new_module = xanmel.modules['xanmel.modules.irc.IRCModule']
+    assert new_module is not irc_module
+    assert new_module.config['channel'] == '#other'
+    assert all(i.module is not irc_module for i in xanmel.handlers[MentionMessage])
+    assert xanmel.actions[ChannelMessage].module is new_module
+    assert 'excuse' in xanmel.cmd_root.children
+
+
+def test_reload_local_cmd_roots(xanmel, xon_module, tmpdir):
+    server = xon_module.servers[0]
+    fun_commands = xanmel.modules['xanmel.modules.fun.FunModule'].command_containers[0]
+    assert fun_commands in server.local_cmd_root.merged_containers
+    limiter = server.local_cmd_root.get_rate_limiter('xonotic')
+    assert limiter.burst == 5
+
+    text = open('xanmel.yaml').read()
+    use_config(xanmel, tmpdir, text.replace('  xanmel.modules.fun.FunModule: {}\n', ''))
+    assert xanmel.loop.run_until_complete(xanmel.reload()) == ['unloaded xanmel.modules.fun.FunModule']
+    assert xon_module.servers[0] is server
+    assert fun_commands not in server.local_cmd_root.merged_containers
+    assert server.local_cmd_root.get_rate_limiter('xonotic') is limiter
+
+    use_config(xanmel, tmpdir, text.replace('user_types: {}', 'user_types: {xonotic: {burst: 3}}'))
+    assert xanmel.loop.run_until_complete(xanmel.reload()) == ['settings', 'loaded xanmel.modules.fun.FunModule']
+    new_fun_commands = xanmel.modules['xanmel.modules.fun.FunModule'].command_containers[0]
+    assert new_fun_commands in server.local_cmd_root.merged_containers
+    assert server.local_cmd_root.get_rate_limiter('xonotic').burst == 3
+    assert xanmel.cmd_root.get_rate_limiter('xonotic').burst == 3